@@ -784,11 +784,28 @@ class bdist_esky_patch(Command):
                      "directory to put final built distributions in"),
                     ('from-version=', None,
                      "version against which to produce patch"),
+                    ('jobs=', 'j',
+                     "number of worker processes to use for diffing"),
+                    ('exhaustive', None,
+                     "try every encoding to get the smallest patch"),
+                    ('verify-files', None,
+                     "verify each file as it's patched"),
+                    ('no-bcj', None,
+                     "don't filter x86 executables before diffing"),
+                    ('no-bytecode', None,
+                     "don't treat .pyc files specially when diffing"),
                    ]
 
+    boolean_options = ['exhaustive','verify-files','no-bcj','no-bytecode']
+
     def initialize_options(self):
         self.dist_dir = None
         self.from_version = None
+        self.jobs = None
+        self.exhaustive = False
+        self.verify_files = False
+        self.no_bcj = False
+        self.no_bytecode = False
 
     def finalize_options(self):
         self.set_undefined_options('bdist',('dist_dir', 'dist_dir'))
@@ -822,7 +839,18 @@ class bdist_esky_patch(Command):
             print "patching", target_esky, "against", source_esky, "=>", patchfile
             if not self.dry_run:
                 try:
-                    esky.patch.main(["-Z","diff",source_esky,target_esky,patchfile])
+                    args = ["-Z","diff",source_esky,target_esky,patchfile]
+                    if self.jobs:
+                        args = ["--jobs",str(self.jobs)] + args
+                    if self.exhaustive:
+                        args = ["--exhaustive"] + args
+                    if self.verify_files:
+                        args = ["--verify-files"] + args
+                    if self.no_bcj:
+                        args = ["--no-bcj"] + args
+                    if self.no_bytecode:
+                        args = ["--no-bytecode"] + args
+                    esky.patch.main(args)
                 except:
                     import traceback
                     traceback.print_exc()
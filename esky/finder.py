@@ -14,12 +14,13 @@ specified URL to look for new versions.
 from __future__ import with_statement
 
 import os
+import sys
 import re
+import json
 import urllib
 import urllib2
 import zipfile
 import shutil
-import tempfile
 import errno
 from urlparse import urlparse, urljoin
 
@@ -27,7 +28,8 @@ from esky.bootstrap import join_app_version
 from esky.errors import *
 from esky.util import deep_extract_zipfile, copy_ownership_info, \
                       ESKY_CONTROL_DIR, ESKY_APPDATA_DIR, \
-                      really_rmtree, really_rename
+                      really_rmtree, really_rename, fcntl, \
+                      link_or_copy_file, link_or_copy_tree
 from esky.patch import apply_patch, PatchError
 
 
@@ -295,23 +297,51 @@ class DefaultVersionFinder(VersionFinder):
         This method is responsible for unzipping downloaded versions, applying
         patches and so-forth, and making the result available as a local
         directory ready for renaming into the appdir.
+
+        Progress is recorded as we go.  If we're interrupted part-way through
+        then the partially-prepared version is kept, and the next attempt
+        along the same path picks up where this one left off, even in the
+        middle of a patch.  If anything goes wrong, it is all thrown away.
+
+        The state dir has a fixed name so that it can be found again, so
+        two attempts to prepare the same version must never run at once.
+        We rely on holding the lock from _lock_statedir for that, rather
+        than on the caller holding the app lock.  A second attempt raises
+        EskyLockedError instead of touching the first one's files.
         """
-        uppath = tempfile.mkdtemp(dir=self._workdir(app,"unpack"))
+        statedir = os.path.join(self._workdir(app,"unpack"),
+                                join_app_version(app.name,version,app.platform))
+        lock = self._lock_statedir(statedir)
         try:
-            if not path:
-                #  There's nothing to prepare, just copy the current version.
-                self._copy_best_version(app,uppath)
-            else:
-                if path[0][0].endswith(".patch"):
-                    #  We're direcly applying a series of patches.
-                    #  Copy the current version across and go from there.
+            self._prepare_version_locked(app,version,path,statedir)
+        finally:
+            self._unlock_statedir(statedir,lock)
+
+    def _prepare_version_locked(self,app,version,path,statedir):
+        """Prepare the requested version, holding the lock on its state dir."""
+        uppath = os.path.join(statedir,"unpack")
+        checkpoint = os.path.join(statedir,"checkpoint.txt")
+        urls = [url for (_,url) in path]
+        num_done = self._load_progress(statedir,urls)
+        try:
+            if num_done is None:
+                if os.path.exists(statedir):
+                    really_rmtree(statedir)
+                os.mkdir(statedir)
+                os.mkdir(uppath)
+                if not path or path[0][0].endswith(".patch"):
+                    #  We're directly applying a series of patches, or there's
+                    #  nothing to prepare.  Copy the current version across
+                    #  and go from there.
                     try:
                         self._copy_best_version(app,uppath)
                     except EnvironmentError, e:
+                        if not path:
+                            raise
                         self.version_graph.remove_all_links(path[0][1])
                         err = "couldn't copy current version: %s" % (e,)
                         raise PatchError(err)
-                    patches = path
+                    num_done = 0
                 else:
                     #  We're starting from a zipfile.  Extract the first dir
                     #  containing more than a single item and go from there.
@@ -324,17 +354,21 @@ class DefaultVersionFinder(VersionFinder):
                         except EnvironmentError:
                             pass
                         raise
-                    patches = path[1:]
+                    num_done = 1
+                self._save_progress(statedir,urls,num_done)
+            if path:
                 # TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
                 # If a patch fails to apply because we've put an appdata dir
                 # where it doesn't expect one, try again with old layout. 
                 for _ in xrange(2):
-                    #  Apply any patches in turn.
-                    for (patchfile,patchurl) in patches:
+                    #  Apply any remaining patches in turn.
+                    for (i,(patchfile,patchurl)) in enumerate(path):
+                        if i < num_done:
+                            continue
                         try:
                             try:
                                 with open(patchfile,"rb") as f:
-                                    apply_patch(uppath,f)
+                                    apply_patch(uppath,f,checkpoint=checkpoint)
                             except EnvironmentError, e:
                                 if e.errno not in (errno.ENOENT,):
                                     raise
@@ -342,7 +376,11 @@ class DefaultVersionFinder(VersionFinder):
                                     raise
                                 really_rmtree(uppath)
                                 os.mkdir(uppath)
+                                if os.path.exists(checkpoint):
+                                    os.unlink(checkpoint)
                                 self._copy_best_version(app,uppath,False)
+                                num_done = 0
+                                self._save_progress(statedir,urls,num_done)
                                 break
                         except (PatchError,EnvironmentError):
                             self.version_graph.remove_all_links(patchurl)
@@ -351,6 +389,8 @@ class DefaultVersionFinder(VersionFinder):
                             except EnvironmentError:
                                 pass
                             raise
+                        num_done = i + 1
+                        self._save_progress(statedir,urls,num_done)
                     else:
                         break
             # Find the actual version dir that we're unpacking.
@@ -395,8 +435,100 @@ class DefaultVersionFinder(VersionFinder):
             #  Clean up any downloaded files now that we've used them.
             for (filenm,_) in path:
                 os.unlink(filenm)
-        finally:
-            really_rmtree(uppath)
+        except Exception:
+            #  Only a genuine failure throws away our progress; if we've
+            #  been interrupted, the next attempt will resume from here.
+            really_rmtree(statedir)
+            raise
+        else:
+            really_rmtree(statedir)
+
+    def _lock_statedir(self,statedir):
+        """Lock the given state dir for preparing a version.
+
+        The lock is taken on a file next to the state dir, since the dir
+        itself is deleted when starting afresh.  It's an OS-level lock that
+        is released if the process dies, so an attempt that was killed
+        never stops the next one from resuming.  The open lock file is
+        returned; pass it to _unlock_statedir to release the lock.
+        """
+        lockfile = statedir + ".lock"
+        while True:
+            f = open(lockfile,"a+")
+            try:
+                if sys.platform == "win32":
+                    import msvcrt
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(),msvcrt.LK_NBLCK,1)
+                else:
+                    fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except EnvironmentError, e:
+                f.close()
+                if e.errno not in (errno.EACCES,errno.EAGAIN,errno.EDEADLK):
+                    raise
+                err = "already preparing %s" % (os.path.basename(statedir),)
+                raise EskyLockedError(err)
+            #  The previous holder removes the file before unlocking it, so
+            #  we may have locked a file that no longer exists.  Try again.
+            if sys.platform == "win32":
+                return f
+            try:
+                st = os.stat(lockfile)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    f.close()
+                    raise
+            else:
+                f_st = os.fstat(f.fileno())
+                if (st.st_dev,st.st_ino) == (f_st.st_dev,f_st.st_ino):
+                    return f
+            f.close()
+
+    def _unlock_statedir(self,statedir,f):
+        """Release the lock taken by _lock_statedir, removing the lock file.
+
+        On posix the file is removed while we still hold the lock, so that
+        nobody can lock it in between.  Windows can't remove a file that
+        is open, so there we unlock it first and don't mind if another
+        attempt has opened it already.
+        """
+        lockfile = statedir + ".lock"
+        if sys.platform == "win32":
+            f.close()
+            try:
+                os.unlink(lockfile)
+            except EnvironmentError:
+                pass
+        else:
+            os.unlink(lockfile)
+            f.close()
+
+    def _load_progress(self,statedir,urls):
+        """Load the progress of a previous attempt at preparing a version.
+
+        This returns the number of items from the given list of download urls
+        that have already been applied, or None if we must start afresh.
+        """
+        if not os.path.isdir(os.path.join(statedir,"unpack")):
+            return None
+        try:
+            with open(os.path.join(statedir,"progress.txt"),"r") as f:
+                progress = json.load(f)
+        except (EnvironmentError,ValueError):
+            return None
+        try:
+            if progress["urls"] != urls:
+                return None
+            return progress["done"]
+        except (KeyError,TypeError):
+            return None
+
+    def _save_progress(self,statedir,urls,num_done):
+        """Record that the first num_done download urls have been applied."""
+        progfile = os.path.join(statedir,"progress.txt")
+        with open(progfile + ".new","w") as f:
+            json.dump({"urls":urls,"done":num_done},f)
+        really_rename(progfile + ".new",progfile)
 
     def _copy_best_version(self,app,uppath,force_appdata_dir=True):
         """Copy the best version directory from the given app.
@@ -404,6 +536,13 @@ class DefaultVersionFinder(VersionFinder):
         This copies the best version directory from the given app into the
         unpacking path.  It's useful for applying patches against an existing
         version.
+
+        Files are hard-linked or cloned from the installed version where the
+        filesystem allows, so the cost of an update scales with the size of
+        the patch rather than the size of the app.  This is safe because the
+        patcher always replaces files rather than modifying them in-place.
+        The control dir is always copied since its lockfile is locked by
+        the running version.
         """
         best_vdir = join_app_version(app.name,app.version,app.platform)
         #  TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
@@ -419,7 +558,8 @@ class DefaultVersionFinder(VersionFinder):
         except OSError, e:
             if e.errno not in (errno.EEXIST,183):
                 raise
-        shutil.copytree(source,os.path.join(dest,best_vdir))
+        link_or_copy_tree(source,os.path.join(dest,best_vdir),
+                          copy_dirs=(ESKY_CONTROL_DIR,))
         mfstnm = os.path.join(source,ESKY_CONTROL_DIR,"bootstrap-manifest.txt")
         with open(mfstnm,"r") as manifest:
             for nm in manifest:
@@ -427,11 +567,11 @@ class DefaultVersionFinder(VersionFinder):
                 bspath = os.path.join(app.appdir,nm)
                 dstpath = os.path.join(uppath,nm)
                 if os.path.isdir(bspath):
-                    shutil.copytree(bspath,dstpath)
+                    link_or_copy_tree(bspath,dstpath)
                 else:
                     if not os.path.isdir(os.path.dirname(dstpath)):
                         os.makedirs(os.path.dirname(dstpath))
-                    shutil.copy2(bspath,dstpath)
+                    link_or_copy_file(bspath,dstpath)
 
     def has_version(self,app,version):
         path = self._ready_name(app,version)
@@ -22,6 +22,18 @@ the following functions:
       applied *in-situ*.  If you want to guard against patches that fail to
       apply, patch a copy then copy it back over the original.
 
+  read_patch_toc(stream):
+
+      read the table of contents from the patch in file-like object
+      "stream", giving the path, size and expected digests of each file
+      that it patches.
+
+  squash_patches(patches,stream):
+
+      combine the patches read from the sequence of file-like objects
+      "patches" into a single equivalent patch, written to the file-like
+      object "stream".  The intermediate versions are not needed.
+
 
 This module can also be executed as a script (e.g. "python -m esky.patch ...")
 to calculate or apply patches from the command-line:
@@ -29,12 +41,42 @@ to calculate or apply patches from the command-line:
   python -m esky.patch diff <source> <target> <patch>
 
       generate a patch to transform <source> into <target>, and write it into
-      file <patch> (or stdout if not specified).
+      file <patch> (or stdout if not specified).  Pass "--jobs N" to diff
+      files using N worker processes; the patch produced is identical.
+      Pass "--chunked" to match up content-defined chunks of large files
+      before diffing, which helps when data has been inserted or removed.
+      Pass "--patch-version N" to generate a patch that can be applied by
+      older versions of esky, at the cost of not using newer features.
+      Pass "--exhaustive" to try every possible encoding of each file
+      rather than skipping those that are unlikely to be any good, and
+      "--report" to see how often such shortcuts were taken.  Pass
+      "--verify-files" to check the digest of each file as it's patched,
+      so a bad file is found straight away rather than at the very end.
+      Pass "--hash NAME" to pick the hash algorithm used for verification,
+      e.g. "sha256" or "sha256-tree"; see get_hash() for the choices.
+      Pass "--no-bcj" to diff executables as plain data, without making
+      the targets of their calls and jumps absolute first, and
+      "--no-bytecode" to diff .pyc files as plain data too.
 
   python -m esky.patch patch <source> <patch>
 
       transform <source> by applying the patches in the file <patch> (or
-      stdin if not specified.  The modifications are made in-place.
+      stdin if not specified.  The modifications are made in-place.  Pass
+      "--jobs N" to patch files using N worker threads.  Pass "--checkpoint
+      FILE" to record progress in FILE, so that an interrupted patch can be
+      resumed by running the same command again.
+
+  python -m esky.patch list <patch>
+
+      list the files patched by the file <patch> (or stdin if not
+      specified), along with their source and target digests and the size
+      of their patch data.  This only reads the table of contents.
+
+  python -m esky.patch squash <patch> <patch>... -o <output>
+
+      combine several patches, to be applied one after the other, into a
+      single patch written to file <output> (or stdout if not specified).
+      Each file is written only once, in its final state.
 
 To patch or diff zipfiles as though they were a directory, pass the "-z" or
 "--zipped" option on the command-line, e.g:
@@ -60,7 +102,12 @@ except NameError:
 
 import os
 import sys
+import re
+import imp
+import types
+import marshal
 import bz2
+import zlib
 import time
 import shutil
 import hashlib
@@ -68,6 +115,11 @@ import optparse
 import zipfile
 import tempfile
 import json
+import collections
+import bisect
+import stat
+import struct
+import threading
 if sys.version_info[0] < 3:
     try:
         from cStringIO import StringIO as BytesIO
@@ -76,6 +128,27 @@ if sys.version_info[0] < 3:
 else:
     from io import BytesIO
 
+#  Use scandir to list directories if it's available.  On Windows it gets
+#  us the stat info for each entry along with the listing, for free.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+#  The lzma module is only in the stdlib for python3.3 and later, and not
+#  always even then.  Without it we can't generate or apply patches that
+#  use the lzma-compressed commands.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 
 #  Try to get code for working with bsdiff4-format patches.
 #
@@ -153,7 +226,202 @@ else:
                 ))
             #  Actually do the patching.
             return _cx_bsdiff.Patch(source,l_target,tcontrol,bdiff,bextra)
-    
+
+
+#  The core of bsdiff4 patching is adding diff bytes to source bytes, modulo
+#  256.  Doing this one byte at a time in python is painfully slow, so we
+#  add whole runs at once.  If numpy is available we let it do the work;
+#  otherwise we treat each run as a big integer and use the usual SWAR trick
+#  to add all the bytes in parallel without carrying between them.
+
+_ADD_CHUNK_SIZE = 1024 * 64
+
+#  Amount of compressed data to feed to a decompressor at once.
+_DECOMPRESS_CHUNK_SIZE = 1024 * 8
+
+#  Amount of data to read from the command stream at once.
+_COMMAND_BUFFER_SIZE = 1024 * 64
+
+#  Amount of data to read at once when calculating file digests.  The hash
+#  functions release the GIL for big updates, so bigger is better here.
+_DIGEST_READ_SIZE = 1024 * 1024
+
+#  Amount of data to filter at once when converting x86 branch targets.
+_BCJ_CHUNK_SIZE = 1024 * 1024
+
+#  Opcodes of the x86 call and jump instructions with a 32-bit relative
+#  target, whose targets are made absolute by the PF_BCJ_X86 filter.
+_BCJ_X86_OPCODE = re.compile(b"[\\xe8\\xe9]")
+
+#  Amount of data to read at once when replacing bytes with PF_REPLACE.
+_REPLACE_CHUNK_SIZE = 1024 * 1024
+
+#  When applying sections in parallel, they're handed to the worker threads
+#  in batches of up to this many sections or bytes of patch data, so that
+#  patching lots of small files isn't swamped by the cost of the handoff.
+_SECTION_BATCH_COUNT = 64
+_SECTION_BATCH_SIZE = 1024 * 1024
+
+#  Size of the blocks hashed independently by the "tree" hash algorithms.
+_TREE_HASH_BLOCK_SIZE = 1024 * 1024
+
+#  Hash algorithms that can be used to verify files, keyed by the id used
+#  for them in the patch stream.  Setting the _HASH_TREE bit in the id
+#  selects the "tree" version of the algorithm; see _TreeHash for details.
+#  Like the commands, these ids must never be changed.
+_HASH_IDS = {"md5":0,"sha1":1,"sha256":2,"sha512":3,"blake2b":4}
+_HASH_TREE = 0x40
+
+_numpy = None
+
+def _get_numpy():
+    """Lazily import numpy, returning False if it's not available.
+
+    We don't want to pay the cost of importing numpy unless we're actually
+    going to apply a patch with the pure-python code.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            _numpy = False
+        else:
+            _numpy = numpy
+    return _numpy
+
+
+if sys.version_info[0] < 3:
+    from binascii import hexlify as _hexlify, unhexlify as _unhexlify
+    def _bytes_to_long(data):
+        return long(_hexlify(data),16)
+    def _long_to_bytes(x,size):
+        return _unhexlify("%0*x" % (size*2,x))
+else:
+    def _bytes_to_long(data):
+        return int.from_bytes(data,"big")
+    def _long_to_bytes(x,size):
+        return x.to_bytes(size,"big")
+
+_ADD_MASKS = {}
+
+def _get_add_masks(size):
+    """Get the (low-seven-bits,high-bit) masks for adding size-byte runs."""
+    try:
+        return _ADD_MASKS[size]
+    except KeyError:
+        masks = (_bytes_to_long(b"\x7f"*size),_bytes_to_long(b"\x80"*size))
+        if size == _ADD_CHUNK_SIZE:
+            _ADD_MASKS[size] = masks
+        return masks
+
+
+def _add_bytes(diff_data,orig_data):
+    """Add two equal-length bytestrings together bytewise, modulo 256."""
+    size = len(diff_data)
+    if size != len(orig_data):
+        raise PatchError("insufficient source data for bsdiff4 patch")
+    #  Runs of zeros are very common in the diff data, so check for
+    #  them before we do anything clever.
+    if diff_data.count(b"\x00") == size:
+        return orig_data
+    numpy = _get_numpy()
+    if numpy:
+        diff_arr = numpy.frombuffer(diff_data,dtype=numpy.uint8)
+        orig_arr = numpy.frombuffer(orig_data,dtype=numpy.uint8)
+        return (diff_arr + orig_arr).tobytes()
+    if size <= _ADD_CHUNK_SIZE:
+        (lo,hi) = _get_add_masks(size)
+        x = _bytes_to_long(diff_data)
+        y = _bytes_to_long(orig_data)
+        return _long_to_bytes(((x & lo) + (y & lo)) ^ ((x ^ y) & hi),size)
+    result = bytearray(size)
+    for i in xrange(0,size,_ADD_CHUNK_SIZE):
+        j = i + _ADD_CHUNK_SIZE
+        result[i:j] = _add_bytes(diff_data[i:j],orig_data[i:j])
+    return bytes(result)
+
+
+class _DecompressReader(object):
+    """File-like object lazily decompressing a slice of a bytestring.
+
+    This lets us pull data out of a compressed block a piece at a time,
+    rather than holding the whole decompressed block in memory.  Subclasses
+    provide the _new_decompressor() method for a particular format.
+    """
+
+    def __init__(self,data,start=0,end=None):
+        if end is None:
+            end = len(data)
+        self._data = data
+        self._pos = start
+        self._end = end
+        self._decompressor = self._new_decompressor()
+        self._buffer = b""
+        self._bufpos = 0
+
+    def _fill(self):
+        """Decompress more data into the buffer, returning False at EOF."""
+        decompressor = self._decompressor
+        #  Newer versions of python let us limit the amount of output
+        #  produced, which bounds memory use for very compressible data.
+        bounded = hasattr(decompressor,"needs_input")
+        while not getattr(decompressor,"eof",False):
+            if bounded and not decompressor.needs_input:
+                chunk = b""
+            elif self._pos < self._end:
+                chunk = self._data[self._pos:min(self._pos+_DECOMPRESS_CHUNK_SIZE,self._end)]
+                self._pos += len(chunk)
+            else:
+                break
+            try:
+                if bounded:
+                    self._buffer = decompressor.decompress(chunk,_ADD_CHUNK_SIZE)
+                else:
+                    self._buffer = decompressor.decompress(chunk)
+            except EOFError:
+                #  Trailing garbage after the end of the stream.
+                break
+            self._bufpos = 0
+            if self._buffer:
+                return True
+        return False
+
+    def read(self,size):
+        """Read up to size bytes of decompressed data."""
+        pieces = []
+        while size > 0:
+            if self._bufpos >= len(self._buffer):
+                if not self._fill():
+                    break
+            piece = self._buffer[self._bufpos:self._bufpos+size]
+            self._bufpos += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        if len(pieces) == 1:
+            return pieces[0]
+        return b"".join(pieces)
+
+
+class _BZ2Reader(_DecompressReader):
+    """File-like object lazily decompressing a slice of a bz2 bytestring."""
+    def _new_decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class _ZlibReader(_DecompressReader):
+    """File-like object lazily decompressing a slice of a zlib bytestring."""
+    def _new_decompressor(self):
+        return zlib.decompressobj()
+
+
+class _LZMAReader(_DecompressReader):
+    """File-like object lazily decompressing a slice of a lzma bytestring."""
+    def _new_decompressor(self):
+        if lzma is None:
+            raise PatchError("lzma support is not available")
+        return lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+
 
 class bsdiff4_py(object):
     """Pure-python version of bsdiff4 module that can only patch, not diff.
@@ -176,42 +444,67 @@ class bsdiff4_py(object):
         diff = None
     @staticmethod
     def patch(source,patch):
+        result = BytesIO()
+        bsdiff4_py.patch_stream(BytesIO(source),len(source),patch,result)
+        return result.getvalue()
+    @staticmethod
+    def patch_stream(infile,n,patch,outfile,reader=_BZ2Reader):
+        """Apply a bsdiff4 patch to n bytes from infile, writing to outfile.
+
+        The three data blocks are decompressed lazily and the result is
+        written out as it is generated, so memory use is bounded no matter
+        how much data is being patched.  The infile must be seekable; on
+        return its position will be just past the n bytes of source data.
+
+        The blocks are normally bz2-compressed; pass a different reader
+        class to handle patches whose blocks are compressed differently.
+        """
         #  Read the length headers
         l_bcontrol = _decode_offt(patch[8:16])
         l_bdiff = _decode_offt(patch[16:24])
         l_target = _decode_offt(patch[24:32])
-        #  Read the three data blocks
+        #  Prepare to read the three data blocks
         e_bcontrol = 32 + l_bcontrol
         e_bdiff = e_bcontrol + l_bdiff
-        bcontrol = bz2.decompress(patch[32:e_bcontrol])
-        bdiff = bz2.decompress(patch[e_bcontrol:e_bdiff])
-        bextra = bz2.decompress(patch[e_bdiff:])
-        #  Decode the control tuples 
-        tcontrol = []
-        for i in xrange(0,len(bcontrol),24):
-            tcontrol.append((
-                _decode_offt(bcontrol[i:i+8]),
-                _decode_offt(bcontrol[i+8:i+16]),
-                _decode_offt(bcontrol[i+16:i+24]),
-            ))
+        bcontrol = reader(patch,32,e_bcontrol)
+        bdiff = reader(patch,e_bcontrol,e_bdiff)
+        bextra = reader(patch,e_bdiff,len(patch))
         #  Actually do the patching.
-        #  This is the bdiff4 patch algorithm in slow, pure python.
-        source = BytesIO(source)
-        result = BytesIO()
-        bdiff = BytesIO(bdiff)
-        bextra = BytesIO(bextra)
-        for (x,y,z) in tcontrol:
-            diff_data = bdiff.read(x)
-            orig_data = source.read(x)
-            if sys.version_info[0] < 3:
-                for i in xrange(len(diff_data)):
-                    result.write(chr((ord(diff_data[i])+ord(orig_data[i]))%256))
-            else:
-                for i in xrange(len(diff_data)):
-                    result.write(bytes([(diff_data[i]+orig_data[i])%256]))
-            result.write(bextra.read(y))
-            source.seek(z,os.SEEK_CUR)
-        return result.getvalue()
+        #  This is the bdiff4 patch algorithm in pure python.  Each control
+        #  tuple is handled in runs of up to _ADD_CHUNK_SIZE bytes.
+        s_base = infile.tell()
+        s_pos = r_pos = 0
+        ctrl = bcontrol.read(24)
+        while ctrl:
+            if len(ctrl) != 24:
+                raise PatchError("corrupted bsdiff4 patch")
+            x = _decode_offt(ctrl[0:8])
+            y = _decode_offt(ctrl[8:16])
+            z = _decode_offt(ctrl[16:24])
+            if x < 0 or y < 0 or r_pos + x + y > l_target:
+                raise PatchError("corrupted bsdiff4 patch")
+            if x:
+                if s_pos < 0 or s_pos + x > n:
+                    raise PatchError("corrupted bsdiff4 patch")
+                infile.seek(s_base + s_pos)
+                while x > 0:
+                    sz = min(x,_ADD_CHUNK_SIZE)
+                    diff_data = bdiff.read(sz)
+                    orig_data = infile.read(sz)
+                    outfile.write(_add_bytes(diff_data,orig_data))
+                    x -= sz; s_pos += sz; r_pos += sz
+            while y > 0:
+                sz = min(y,_ADD_CHUNK_SIZE)
+                extra_data = bextra.read(sz)
+                if len(extra_data) != sz:
+                    raise PatchError("corrupted bsdiff4 patch")
+                outfile.write(extra_data)
+                y -= sz; r_pos += sz
+            s_pos += z
+            ctrl = bcontrol.read(24)
+        if r_pos != l_target:
+            raise PatchError("corrupted bsdiff4 patch")
+        infile.seek(s_base + n)
 
 
 if bsdiff4_native is not None:
@@ -222,13 +515,138 @@ else:
     bsdiff4 = bsdiff4_py
 
 
+def _bsdiff4_diff_blocks(source,target):
+    """Calculate the uncompressed control, diff and extra bsdiff4 blocks.
+
+    The control tuples are encoded as a string of offts, as in the final
+    patch.  Working from the raw blocks lets us compress them in several
+    different ways without running the expensive diff more than once.  If
+    there's no module capable of diffing, None is returned.
+    """
+    if bsdiff4 is bsdiff4_cx:
+        (tcontrol,bdiff,bextra) = _cx_bsdiff.Diff(source,target)
+    elif bsdiff4_native is not None:
+        (tcontrol,bdiff,bextra) = bsdiff4_native.core.diff(source,target)
+    elif bsdiff4_cx is not None:
+        (tcontrol,bdiff,bextra) = _cx_bsdiff.Diff(source,target)
+    else:
+        return None
+    bcontrol = b"".join([_encode_offt(x) for c in tcontrol for x in c])
+    return (bcontrol,bdiff,bextra)
+
+
+def _bsdiff4_pack(blocks,l_target,compress):
+    """Compress raw bsdiff4 blocks into a patch, minus the header magic."""
+    (bcontrol,bdiff,bextra) = [compress(block) for block in blocks]
+    return b"".join((
+        _encode_offt(len(bcontrol)),
+        _encode_offt(len(bdiff)),
+        _encode_offt(l_target),
+        bcontrol,
+        bdiff,
+        bextra,
+    ))
+
+
+def _bsdiff4_patch_blocks(source,patch,decompress):
+    """Apply a bsdiff4 patch whose blocks use the given decompression.
+
+    This uses the native bsdiff4 or cx-bsdiff module to do the actual
+    patching, so it's only suitable for data that fits in memory.
+    """
+    l_bcontrol = _decode_offt(patch[8:16])
+    l_bdiff = _decode_offt(patch[16:24])
+    l_target = _decode_offt(patch[24:32])
+    e_bcontrol = 32 + l_bcontrol
+    e_bdiff = e_bcontrol + l_bdiff
+    bcontrol = decompress(patch[32:e_bcontrol])
+    bdiff = decompress(patch[e_bcontrol:e_bdiff])
+    bextra = decompress(patch[e_bdiff:])
+    tcontrol = []
+    for i in xrange(0,len(bcontrol),24):
+        tcontrol.append((
+            _decode_offt(bcontrol[i:i+8]),
+            _decode_offt(bcontrol[i+8:i+16]),
+            _decode_offt(bcontrol[i+16:i+24]),
+        ))
+    if bsdiff4 is bsdiff4_cx:
+        return _cx_bsdiff.Patch(source,l_target,tcontrol,bdiff,bextra)
+    return bsdiff4_native.core.patch(source,l_target,tcontrol,bdiff,bextra)
+
+
+def _lzma_compress(data):
+    """Compress data into the lzma format used by our patch commands.
+
+    This is the simple "alone" format, which has less overhead than xz.
+    We size the dictionary to fit the data, since the decompressor must
+    allocate the full dictionary size given in the header.
+    """
+    dict_size = 1024 * 4
+    while dict_size < len(data):
+        dict_size *= 2
+    filters = [{"id":lzma.FILTER_LZMA1,"preset":6,"dict_size":dict_size}]
+    return lzma.compress(data,format=lzma.FORMAT_ALONE,filters=filters)
+
+
+def _lzma_decompress(data):
+    """Decompress data produced by _lzma_compress."""
+    if lzma is None:
+        raise PatchError("lzma support is not available")
+    try:
+        return lzma.decompress(data,format=lzma.FORMAT_ALONE)
+    except lzma.LZMAError:
+        raise PatchError("corrupted lzma data")
+
+
 #  Default size of blocks to use when diffing a file.  4M seems reasonable.
 #  Setting this higher generates smaller patches at the cost of higher
-#  memory use (and bsdiff is a memory hog at the best of times...)
+#  memory use when diffing (and bsdiff is a memory hog at the best of times...)
+#  Memory use when patching is bounded by BSDIFF4_STREAM_SIZE below.
 DIFF_WINDOW_SIZE = 1024 * 1024 * 4
 
+#  Blocks of bsdiff4 data bigger than this are applied in a streaming
+#  fashion rather than being loaded into memory all at once.  Streaming is
+#  slower than the native bsdiff4 module, so we only use it on big blocks.
+BSDIFF4_STREAM_SIZE = 1024 * 1024 * 16
+
+#  Inserted data no bigger than SOLID_FILE_SIZE is gathered up and compressed
+#  together in blocks of about SOLID_BLOCK_SIZE bytes.  Compressing lots of
+#  small files as a single "solid" block is much more effective than doing
+#  each one separately.  The patch data is held back while a block is being
+#  filled, which is limited to _SOLID_MAX_PENDING bytes.
+SOLID_FILE_SIZE = 1024 * 64
+SOLID_BLOCK_SIZE = 1024 * 1024 * 4
+_SOLID_MAX_PENDING = 1024 * 1024 * 16
+
+#  When applying a patch with a checkpoint file, progress is recorded at
+#  least this often (in seconds) so that an interrupted patch can resume.
+CHECKPOINT_INTERVAL = 5
+
+#  Size of blocks used when looking for common prefixes and suffixes.
+_COMPARE_BLOCK_SIZE = 1024 * 64
+
+#  Parameters for content-defined chunking of large files in chunked mode.
+#  The size of each chunk is between the minimum and maximum, with the
+#  average determined by the number of bits in the hash mask.  We use the
+#  high bits of the hash, since the low bits depend on fewer input bytes.
+CHUNK_MIN_SIZE = 1024 * 4
+CHUNK_MAX_SIZE = 1024 * 128
+_CHUNK_MASK = ((1 << 14) - 1) << 18
+_CHUNK_GEAR = [int(hashlib.md5(bytes(bytearray([i]))).hexdigest()[:8],16)
+               for i in xrange(256)]
+
 #  Highest patch version that can be processed by this module.
-HIGHEST_VERSION = 1
+#  The versions, and the features they added, are:
+#    1:  the original protocol
+#    2:  COPY_FROM_ROOT command, for files moved between directories
+#    3:  PF_INS_ZLIB, PF_INS_LZMA and PF_BSDIFF4_LZMA commands
+#    4:  SOLID_BLOCK and PF_INS_SOLID commands, for small files
+#    5:  PF_REC_ZIP_RAW command, copying unchanged zip members raw
+#    6:  table of contents after the header, and SECTION command
+#    7:  VERIFY command and choice of hash algorithm for digests
+#    8:  PF_BCJ_X86 command, for diffing x86 executables
+#    9:  PF_SET_HEADER and PF_REPLACE commands, for diffing .pyc files
+HIGHEST_VERSION = 9
 
 #  Header bytes included in the patch file
 PATCH_HEADER = "ESKYPTCH".encode("ascii")
@@ -240,10 +658,13 @@ ESKY_FILELIST = "esky_filelist.txt"
 
 from esky.errors import Error
 from esky.util import extract_zipfile, create_zipfile, deep_extract_zipfile,\
-                      zipfile_common_prefix_dir, really_rmtree, really_rename
+                      zipfile_common_prefix_dir, really_rmtree, really_rename,\
+                      copy_file, copy_tree, copy_file_data, \
+                      ESKY_CONTROL_DIR, ESKY_APPDATA_DIR
 
-__all__ = ["PatchError","DiffError","main","write_patch","apply_patch",
-           "Differ","Patcher"]
+__all__ = ["PatchError","PatchVerifyError","DiffError","main","write_patch",
+           "apply_patch","squash_patches","get_hash","Differ","Patcher",
+           "Squasher"]
 
 
 
@@ -251,6 +672,19 @@ class PatchError(Error):
     """Error raised when a patch fails to apply."""
     pass
 
+class PatchVerifyError(PatchError):
+    """Error raised when files don't match the digests given in a patch.
+
+    The 'paths' attribute lists the bad files, relative to the root of the
+    patch and with "/" as separator, so they can be fetched individually.
+    The 'hash_name' attribute names the hash algorithm of the digests.
+    """
+    def __init__(self,paths,hash_name="md5"):
+        self.paths = paths
+        self.hash_name = hash_name
+        msg = "incorrect %s digest for %s" % (hash_name,", ".join(paths),)
+        super(PatchVerifyError,self).__init__(msg)
+
 class DiffError(Error):
     """Error raised when a diff can't be generated."""
     pass
@@ -282,12 +716,29 @@ _COMMANDS = [
  "PF_BSDIFF4",    # PF_BSDIFF4(n,p):     patch file; bsdiff4 from n input bytes
  "PF_REC_ZIP",    # PF_REC_ZIP(m,cs):    patch file; recurse into zipfile
  "CHMOD",         # CHMOD(mode):         set mode of current target
+ "COPY_FROM_ROOT",# COPY_FROM_ROOT(path): copy item at root-relative path
+ "PF_INS_ZLIB",   # PF_INS_ZLIB(bytes):  patch file; insert unzlib'd bytes
+ "PF_INS_LZMA",   # PF_INS_LZMA(bytes):  patch file; insert unlzma'd bytes
+ "PF_BSDIFF4_LZMA",# PF_BSDIFF4_LZMA(n,p): PF_BSDIFF4 with lzma'd blocks
+ "SOLID_BLOCK",   # SOLID_BLOCK(c,bytes): begin block of data for PF_INS_SOLID
+ "PF_INS_SOLID",  # PF_INS_SOLID(n):     patch file; insert n bytes from block
+ "PF_REC_ZIP_RAW",# PF_REC_ZIP_RAW(ns,m,cs): PF_REC_ZIP extracting only ns
+ "SECTION",       # SECTION(i):          apply section i of table of contents
+ "VERIFY",        # VERIFY(h,dgst):      check digest of target using hash h
+ "PF_BCJ_X86",    # PF_BCJ_X86(cs):      patch file; with x86 branches filtered
+ "PF_SET_HEADER", # PF_SET_HEADER(bytes): patch file; new header, copy the rest
+ "PF_REPLACE",    # PF_REPLACE(a,b,cs):  patch file; with bytes a replaced by b
 ]
 
 # Make commands available as global variables
 for i,cmd in enumerate(_COMMANDS):
     globals()[cmd] = i
 
+#  Commands that can be processed while sections are being applied in
+#  parallel, since they don't touch the filesystem.
+_PARALLEL_COMMANDS = frozenset((SECTION,SET_PATH,JOIN_PATH,POP_PATH,
+                                POP_JOIN_PATH,SOLID_BLOCK))
+
 
 def apply_patch(target,stream,**kwds):
     """Apply patch commands from the given stream to the given target.
@@ -310,6 +761,134 @@ def write_patch(source,target,stream,**kwds):
     Differ(stream,**kwds).diff(source,target)
 
 
+def read_patch_toc(stream):
+    """Read the table of contents from the patch in the given stream.
+
+    This returns a list of PatchSection objects, one for each file patched
+    by the sections of the patch, without reading any further than the
+    table itself.  Patches older than version 6 have no table of contents,
+    and None is returned for them.  The name of the hash algorithm used for
+    the digests is given by the 'hash_name' attribute of each section.
+    """
+    header = stream.read(len(PATCH_HEADER))
+    if header != PATCH_HEADER:
+        raise PatchError("not an esky patch file [%s]" % (header,))
+    version = _read_vint(stream)
+    if version > HIGHEST_VERSION:
+        raise PatchError("esky patch version %d not supported"%(version,))
+    if version < 6:
+        return None
+    hash_name = "md5"
+    if version >= 7:
+        hash_name = _read_hash(stream)
+    return _read_sections(stream,hash_name)
+
+
+def squash_patches(patches,stream):
+    """Combine a sequence of patches into a single patch.
+
+    'patches' must be a sequence of objects supporting the read() method,
+    containing patches that would be applied one after the other.  A single
+    patch making the same changes is written to 'stream', an object
+    supporting the write() method.
+    """
+    squasher = Squasher()
+    for patch in patches:
+        squasher.add_patch(patch)
+    squasher.write_patch(stream)
+
+
+class PatchSection(object):
+    """An entry in the table of contents of a patch.
+
+    Each section contains the commands to patch a single file, given by
+    its path relative to the root of the patch.  Its position in the patch
+    is given as the offset of its SECTION command relative to the end of
+    the table of contents, and the length up to and including its final
+    END command.  The number of bytes it takes from solid blocks is also
+    recorded, so that a section can be skipped without being interpreted.
+    The source digest is empty if the file is new in the target.
+    """
+
+    def __init__(self,path,offset,length,solid_size,source_digest,
+                 target_digest,target_mode,hash_name="md5"):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.solid_size = solid_size
+        self.source_digest = source_digest
+        self.target_digest = target_digest
+        self.target_mode = target_mode
+        self.hash_name = hash_name
+
+
+def _read_sections(stream,hash_name="md5"):
+    """Read a table of contents, as a list of PatchSection objects."""
+    def read_bytes():
+        l = _read_vint(stream)
+        data = stream.read(l)
+        if len(data) != l:
+            raise PatchError("corrupted table of contents")
+        return data
+    sections = []
+    try:
+        for _ in xrange(_read_vint(stream)):
+            path = read_bytes().decode("utf8")
+            offset = _read_vint(stream)
+            length = _read_vint(stream)
+            solid_size = _read_vint(stream)
+            source_digest = read_bytes()
+            target_digest = read_bytes()
+            target_mode = _read_vint(stream)
+            sections.append(PatchSection(path,offset,length,solid_size,
+                                         source_digest,target_digest,
+                                         target_mode,hash_name))
+    except EOFError:
+        raise PatchError("corrupted table of contents")
+    return sections
+
+
+def _read_hash(stream):
+    """Read the id of a hash algorithm, returning the algorithm's name."""
+    id = _read_vint(stream)
+    name = None
+    for (nm,base_id) in _HASH_IDS.iteritems():
+        if id == base_id:
+            name = nm
+        elif id == base_id | _HASH_TREE:
+            name = nm + "-tree"
+    if name is None:
+        raise PatchError("unknown hash algorithm: %d" % (id,))
+    try:
+        get_hash(name)
+    except ValueError, e:
+        raise PatchError(str(e))
+    return name
+
+
+def _hash_id(name):
+    """Get the id used in the patch stream for the named hash algorithm."""
+    if name.endswith("-tree"):
+        return _HASH_IDS[name[:-len("-tree")]] | _HASH_TREE
+    return _HASH_IDS[name]
+
+
+def _write_sections(stream,sections):
+    """Write a table of contents from a list of PatchSection objects."""
+    def write_bytes(data):
+        _write_vint(stream,len(data))
+        stream.write(data)
+    _write_vint(stream,len(sections))
+    for section in sections:
+        write_bytes(section.path.encode("utf8"))
+        _write_vint(stream,section.offset)
+        _write_vint(stream,section.length)
+        _write_vint(stream,section.solid_size)
+        write_bytes(section.source_digest)
+        write_bytes(section.target_digest)
+        _write_vint(stream,section.target_mode)
+
+
 def _read_vint(stream):
     """Read a vint-encoded integer from the given stream."""
     b = stream.read(1)
@@ -329,22 +908,131 @@ def _read_vint(stream):
     x += (b << e)
     return x
 
+#  Encodings of the single-byte vints, which make up most of a patch.
+_VINT_BYTES = [bytes(bytearray([i])) for i in range(128)]
+
+def _encode_vint(x):
+    """Get the vint encoding of the given integer, as a bytestring."""
+    if x < 128:
+        return _VINT_BYTES[x]
+    data = bytearray()
+    while x >= 128:
+        data.append((x & 127) | 128)
+        x = x >> 7
+    data.append(x)
+    return bytes(data)
+
+
+def _write_vint(stream,x):
+    """Write a vint-encoded integer to the given stream."""
+    stream.write(_encode_vint(x))
+
+
+def _vint_size(x):
+    """Get the number of bytes in the vint encoding of the given integer."""
+    n = 1
+    while x >= 128:
+        x = x >> 7
+        n += 1
+    return n
+
+
 if sys.version_info[0] > 2:
-    def _write_vint(stream,x):
-        """Write a vint-encoded integer to the given stream."""
-        while x >= 128:
-            b = x & 127
-            stream.write(bytes([b | 128]))
-            x = x >> 7
-        stream.write(bytes([x]))
+    def _byte_value(b):
+        return b
 else:
-    def _write_vint(stream,x):
-        """Write a vint-encoded integer to the given stream."""
-        while x >= 128:
-            b = x & 127
-            stream.write(chr(b | 128))
-            x = x >> 7
-        stream.write(chr(x))
+    _byte_value = ord
+
+
+class _CommandReader(object):
+    """Buffered reader for a stream of patch commands.
+
+    Patch commands are mostly tiny vints and paths, and reading them a byte
+    at a time is painfully slow when the patch comes from an unbuffered
+    file or a socket.  This reads the underlying stream in large blocks
+    and decodes from the buffer.  Like a file, read() only returns short
+    at the end of the stream.
+    """
+
+    def __init__(self,stream,buffer_size=_COMMAND_BUFFER_SIZE):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self._buf = "".encode("ascii")
+        self._pos = 0
+        #  Offset in the stream of the start of the buffer.
+        self._base = 0
+
+    def _fill(self):
+        """Read another block into the buffer, returning False at EOF."""
+        data = self.stream.read(self.buffer_size)
+        if not data:
+            return False
+        if self._pos < len(self._buf):
+            data = self._buf[self._pos:] + data
+        self._base += self._pos
+        self._buf = data
+        self._pos = 0
+        return True
+
+    def tell(self):
+        """Get the number of bytes consumed from the stream so far."""
+        return self._base + self._pos
+
+    def read(self,size):
+        """Read up to the given number of bytes."""
+        pos = self._pos
+        end = pos + size
+        if end <= len(self._buf):
+            self._pos = end
+            return self._buf[pos:end]
+        data = self._buf[pos:]
+        self._base += len(self._buf)
+        self._buf = "".encode("ascii")
+        self._pos = 0
+        size -= len(data)
+        if size >= self.buffer_size:
+            more = self.stream.read(size)
+            self._base += len(more)
+            return data + more
+        if not self._fill():
+            return data
+        return data + self.read(size)
+
+    def read_vint(self):
+        """Read a vint-encoded integer."""
+        pos = self._pos
+        if pos < len(self._buf):
+            b = _byte_value(self._buf[pos])
+            if b < 128:
+                self._pos = pos + 1
+                return b
+        x = e = 0
+        while True:
+            if self._pos >= len(self._buf) and not self._fill():
+                raise EOFError
+            b = _byte_value(self._buf[self._pos])
+            self._pos += 1
+            if b < 128:
+                return x + (b << e)
+            x += (b - 128) << e
+            e += 7
+
+    def seek(self,offset,whence=os.SEEK_CUR):
+        """Skip forward over the given number of bytes.
+
+        Only relative seeks are supported.  If the underlying stream can't
+        seek then the error is raised without consuming any data.
+        """
+        if whence != os.SEEK_CUR:
+            raise IOError("only relative seeks are supported")
+        avail = len(self._buf) - self._pos
+        if offset <= avail:
+            self._pos += offset
+        else:
+            self.stream.seek(offset - avail,os.SEEK_CUR)
+            self._base += self._pos + offset
+            self._buf = "".encode("ascii")
+            self._pos = 0
 
 
 def _read_zipfile_metadata(stream):
@@ -369,6 +1057,66 @@ def _write_zipfile_metadata(stream,zfin):
         zfout.close()
 
 
+def _zip_member_key(name):
+    """Get the bytes identifying a zipfile member in the patch stream."""
+    if isinstance(name,unicode):
+        return name.encode("utf8")
+    return name
+
+
+def _zip_members_match(s_zinfo,t_zinfo):
+    """Check whether a target zipfile member can be copied from the source.
+
+    This is the case if the member data is identical and is stored in the
+    same way, so that its raw compressed bytes can be reused.  The data is
+    compared using the size and CRC from the central directory, so there's
+    no need to decompress either member.
+    """
+    if s_zinfo is None:
+        return False
+    if s_zinfo.compress_type != t_zinfo.compress_type:
+        return False
+    if (s_zinfo.flag_bits ^ t_zinfo.flag_bits) & 0x01:
+        return False
+    if s_zinfo.file_size != t_zinfo.file_size:
+        return False
+    return s_zinfo.CRC == t_zinfo.CRC
+
+
+def _changed_zip_members(s_zf,t_zf):
+    """Find the members that need diffing between a pair of zipfiles.
+
+    Target members that match a source member of the same name can be
+    copied across unchanged, so only the remaining members need to be
+    diffed.  Source members that are missing from the target are also
+    included, as candidates for moved files.  Returns a pair of sets of
+    source and target member names.
+    """
+    s_infos = {}
+    for zinfo in s_zf.infolist():
+        s_infos[zinfo.filename] = zinfo
+    s_names = set()
+    t_names = set()
+    for zinfo in t_zf.infolist():
+        s_zinfo = s_infos.pop(zinfo.filename,None)
+        if not _zip_members_match(s_zinfo,zinfo):
+            t_names.add(zinfo.filename)
+            if s_zinfo is not None:
+                s_names.add(zinfo.filename)
+    s_names.update(s_infos)
+    return (s_names,t_names)
+
+
+def _extract_zipfile_members(source,target,names):
+    """Extract just the named members of a zipfile into a directory."""
+    if names:
+        def name_filter(nm):
+            if nm in names:
+                return nm
+            return None
+        extract_zipfile(source,target,name_filter)
+
+
 def paths_differ(path1,path2):
     """Check whether two paths differ."""
     if os.path.isdir(path1):
@@ -385,68 +1133,513 @@ def paths_differ(path1,path2):
             return True
         if os.stat(path1).st_size != os.stat(path2).st_size:
             return True
-        with open(path1,"rb") as f1:
-            with open(path2,"rb") as f2:
-                data1 = f1.read(1024*16)
-                data2 = f2.read(1024*16)
-                while data1:
-                    if data1 != data2:
-                        return True
-                    data1 = f1.read(1024*16)
-                    data2 = f2.read(1024*16)
-                if data1 != data2:
-                    return True
+        return _file_contents_differ(path1,path2)
     elif os.path.exists(path2):
         return True
     return False
 
+
+def _file_contents_differ(path1,path2):
+    """Check whether the contents of two files differ."""
+    with open(path1,"rb") as f1:
+        with open(path2,"rb") as f2:
+            data1 = f1.read(1024*16)
+            data2 = f2.read(1024*16)
+            while data1:
+                if data1 != data2:
+                    return True
+                data1 = f1.read(1024*16)
+                data2 = f2.read(1024*16)
+            if data1 != data2:
+                return True
+    return False
+
     
 
-def calculate_digest(target,hash=hashlib.md5):
+def calculate_digest(target,hash=hashlib.md5,jobs=None):
     """Calculate the digest of the given path.
 
     If the target is a file, its digest is calculated as normal.  If it is
     a directory, it is calculated from the names and digests of its contents.
+    Files are hashed using 'jobs' worker threads, by default one per CPU.
     """
-    d = hash()
-    if os.path.isdir(target):
-        for nm in sorted(os.listdir(target)):
-            d.update(nm.encode("utf8"))
-            d.update(calculate_digest(os.path.join(target,nm)))
-    else:
-        with open(target,"rb") as f:
-            data = f.read(1024*16)
-            while data:
-                d.update(data)
-                data = f.read(1024*16)
-    return d.digest()
+    if jobs is None:
+        jobs = _cpu_count()
+    return _Digester(hash,jobs).digest(target)
 
 
-def calculate_patch_digest(target, hash=hashlib.md5):
+def calculate_patch_digest(target, hash=hashlib.md5, jobs=None):
     """Calculate the digest of the entire project based on the files listed
     in the esky_filelist. This will ensure that patches don't break if any
     superfluous files have been added to the application folder"""
-    filelist = load_filelist(target)
-    if filelist is None:
-        # No filelist found, fall back to hashing entire directory
-        return calculate_digest(target, hash)
-    d = hash()
-    for f in filelist:
-        file_path = os.path.join(target, f)
-        d.update(os.path.basename(file_path).encode("utf8"))
-        d.update(calculate_digest(file_path, hash))
-    return d.digest()
+    if jobs is None:
+        jobs = _cpu_count()
+    return _Digester(hash,jobs).patch_digest(target)
+
+
+def _cpu_count():
+    """Get the number of CPUs, or 1 if it can't be determined."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+        return 1
+
+
+def _is_x86_executable(path):
+    """Check whether the given file is an x86 or x86-64 executable.
+
+    ELF, PE and Mach-O files are recognised by their headers, which give
+    the machine type that the code is for.
+    """
+    try:
+        with open(path,"rb") as f:
+            header = f.read(4096)
+    except EnvironmentError:
+        return False
+    if header[:4] == b"\x7fELF" and len(header) >= 20:
+        if header[5:6] == b"\x01":
+            (machine,) = struct.unpack("<H",header[18:20])
+        else:
+            (machine,) = struct.unpack(">H",header[18:20])
+        return machine in (3,62)
+    if header[:2] == b"MZ" and len(header) >= 64:
+        (offset,) = struct.unpack("<I",header[60:64])
+        if header[offset:offset+4] != b"PE\x00\x00":
+            return False
+        if len(header) < offset + 6:
+            return False
+        (machine,) = struct.unpack("<H",header[offset+4:offset+6])
+        return machine in (0x14c,0x8664)
+    if header[:4] in (b"\xce\xfa\xed\xfe",b"\xcf\xfa\xed\xfe"):
+        if len(header) < 8:
+            return False
+        (cputype,) = struct.unpack("<I",header[4:8])
+        return cputype in (7,0x01000007)
+    return False
+
+
+def _bcj_x86_copy(infile,outfile,encode):
+    """Copy data between files, converting x86 branch targets.
+
+    When encoding, the 32-bit relative target of each call and jump
+    instruction is replaced with its absolute offset in the file; decoding
+    does the reverse.  A small change to the code shifts the relative
+    targets of all the branches that span it, but leaves most absolute
+    targets alone, so the encoded data diffs much better.  This is the same
+    idea as the BCJ filter used by xz and 7-zip.
+
+    Only targets within 16MB either way are converted, since anything else
+    is probably not code.  They are converted modulo 2**25, so that the
+    result is also within that range and decoding finds exactly the same
+    instructions to convert back.  The operand of each instruction is
+    skipped when looking for the next one, so no operand is ever changed
+    other than by converting its own instruction.
+    """
+    buf = bytearray()
+    offset = 0
+    start = 0
+    while True:
+        data = infile.read(_BCJ_CHUNK_SIZE)
+        buf.extend(data)
+        #  Instructions at or after the limit need more data to convert.
+        limit = max(len(buf) - 4,0)
+        m = _BCJ_X86_OPCODE.search(buf,start,limit)
+        while m is not None:
+            i = m.start()
+            (target,) = struct.unpack_from("<i",buf,i+1)
+            if -0x1000000 <= target < 0x1000000:
+                if encode:
+                    target += offset + i
+                else:
+                    target -= offset + i
+                target = ((target + 0x1000000) & 0x1FFFFFF) - 0x1000000
+                struct.pack_into("<i",buf,i+1,target)
+            start = i + 5
+            m = _BCJ_X86_OPCODE.search(buf,start,limit)
+        if not data:
+            outfile.write(bytes(buf))
+            return
+        done = max(start,limit)
+        outfile.write(bytes(buf[:done]))
+        del buf[:done]
+        offset += done
+        start = 0
+
+
+def _replace_copy(infile,outfile,old,new):
+    """Copy data between files, replacing each occurrence of old with new.
+
+    This gives the same result as data.replace(old,new) but reads the data
+    a chunk at a time.  Anything in which an occurrence might start once
+    more data is read is held back until the next chunk.
+    """
+    buf = b""
+    while True:
+        data = infile.read(_REPLACE_CHUNK_SIZE)
+        buf += data
+        if not data:
+            outfile.write(buf.replace(old,new))
+            return
+        start = 0
+        i = buf.find(old)
+        while i != -1:
+            outfile.write(buf[start:i])
+            outfile.write(new)
+            start = i + len(old)
+            i = buf.find(old,start)
+        done = max(start,len(buf) - len(old) + 1)
+        outfile.write(buf[start:done])
+        buf = buf[done:]
+
+
+def _pyc_header_size(data):
+    """Get the size of the header at the start of the given .pyc file data.
+
+    The header is a magic number followed by the mtime of the source file
+    and, in newer versions of python, its size and some flags.  None is
+    returned if the data doesn't look like a .pyc file.
+    """
+    if data[2:4] != b"\r\n":
+        return None
+    (magic,) = struct.unpack("<H",data[:2])
+    if 3390 <= magic < 20000:
+        size = 16
+    elif 3190 <= magic < 20000:
+        size = 12
+    else:
+        size = 8
+    if len(data) < size:
+        return None
+    return size
+
+
+def _pyc_filename_change(sdata,tdata,header_size):
+    """Find how the source filename changed between two .pyc files.
+
+    The filename is recorded in every code object in the file, so compiling
+    the same source from a different directory changes bytes all through
+    it.  If each file names a single source file, this returns the strings
+    (old,new) to replace as they appear in the marshalled data.  Otherwise
+    None is returned.  Only files for this version of python can be loaded.
+    """
+    magic = imp.get_magic()
+    if sdata[:len(magic)] != magic or tdata[:len(magic)] != magic:
+        return None
+    s_names = _code_filenames(sdata[header_size:])
+    t_names = _code_filenames(tdata[header_size:])
+    if len(s_names) != 1 or len(t_names) != 1 or s_names == t_names:
+        return None
+    (s_name,) = s_names
+    (t_name,) = t_names
+    if not isinstance(s_name,bytes) or not isinstance(t_name,bytes):
+        return None
+    #  Strings are marshalled as a type code ("s", or "t" if interned) and a
+    #  32-bit length, then the data.  Matching the type code as well means
+    #  only whole string objects are replaced.  A string constant equal to
+    #  the filename is replaced too, but the diff that follows puts it back.
+    for type_code in (b"s",b"t"):
+        old = type_code + struct.pack("<i",len(s_name)) + s_name
+        if old in sdata:
+            new = type_code + struct.pack("<i",len(t_name)) + t_name
+            return (old,new)
+    return None
+
+
+def _code_filenames(data):
+    """Get the filenames of all code objects in the given marshalled data."""
+    try:
+        code = marshal.loads(data)
+    except (EOFError,ValueError,TypeError):
+        return set()
+    filenames = set()
+    todo = [code]
+    while todo:
+        obj = todo.pop()
+        if isinstance(obj,types.CodeType):
+            filenames.add(obj.co_filename)
+            todo.extend(obj.co_consts)
+    return filenames
+
+
+def get_hash(name):
+    """Get a constructor for the named hash algorithm.
+
+    The algorithms that can be used in patches are "md5", "sha1", "sha256",
+    "sha512" and "blake2b" (where the hashlib module provides it), plus a
+    "tree" version of each, such as "sha256-tree", that hashes large files
+    in blocks so that they can be hashed by several threads at once.
+    ValueError is raised if the algorithm is unknown or unavailable.
+    """
+    base = name
+    if name.endswith("-tree"):
+        base = name[:-len("-tree")]
+    if base not in _HASH_IDS:
+        raise ValueError("unknown hash algorithm: %s" % (name,))
+    hash = getattr(hashlib,base,None)
+    if hash is None:
+        raise ValueError("hash algorithm not available: %s" % (name,))
+    if base != name:
+        return lambda: _TreeHash(hash,name)
+    return hash
+
+
+class _TreeHash(object):
+    """Hash calculated over fixed-size blocks of the data.
+
+    Each block of _TREE_HASH_BLOCK_SIZE bytes is hashed on its own, and the
+    digest is the hash of the digests of all the blocks.  Since the blocks
+    don't depend on each other, _Digester can hash the blocks of a large file
+    on several threads at once.  This supports enough of the interface of
+    the hashlib objects to be used in their place within this module.
+    """
+
+    def __init__(self,leaf_hash,name):
+        self.leaf_hash = leaf_hash
+        self.name = name
+        self.digest_size = leaf_hash().digest_size
+        self._root = leaf_hash()
+        self._block = leaf_hash()
+        self._block_used = 0
+
+    def update(self,data):
+        while data:
+            n = _TREE_HASH_BLOCK_SIZE - self._block_used
+            if len(data) < n:
+                self._block.update(data)
+                self._block_used += len(data)
+                return
+            self._block.update(data[:n])
+            self._root.update(self._block.digest())
+            self._block = self.leaf_hash()
+            self._block_used = 0
+            data = data[n:]
+
+    def digest(self):
+        root = self._root.copy()
+        if self._block_used:
+            root.update(self._block.digest())
+        return root.digest()
 
 
 def load_filelist(root):
-    '''locates the esky file list, reads it and returns it as a sorted list'''
-    for path, dirs, files in os.walk(root):
-        for f in files:
-            if f == ESKY_FILELIST:
-                file_path = os.path.join(path, f)
-                with open(file_path) as list_file:
-                    filelist = json.loads(list_file.read())
-                    return sorted(filelist)
+    """Find the esky file list for the given app dir, and read it.
+
+    The file list lives in the control dir of the version being patched,
+    so we look for it there rather than searching the whole tree.  This
+    returns a sorted list of the paths it contains, or None if there's no
+    file list.
+    """
+    candidates = [os.path.join(root,ESKY_CONTROL_DIR,ESKY_FILELIST)]
+    for subdir in (root,os.path.join(root,ESKY_APPDATA_DIR)):
+        try:
+            names = sorted(os.listdir(subdir))
+        except EnvironmentError:
+            continue
+        for nm in names:
+            path = os.path.join(subdir,nm,ESKY_CONTROL_DIR,ESKY_FILELIST)
+            candidates.append(path)
+    for file_path in candidates:
+        if os.path.isfile(file_path):
+            with open(file_path) as list_file:
+                filelist = json.loads(list_file.read())
+                return sorted(filelist)
+
+
+def _stat_signature(st):
+    """Get the details of a stat result that change when a file is written.
+
+    The ctime is included since, unlike the mtime, it can't be copied over
+    from another file; a copy that happens to reuse the inode of a file we
+    have hashed will still look different.
+    """
+    return (st.st_size,st.st_mtime,st.st_ctime,st.st_ino,st.st_dev)
+
+
+class _Digester(object):
+    """Calculates the digests of files and directories.
+
+    Files are read in big chunks and hashed on a pool of 'jobs' worker
+    threads, or in the calling thread if 'jobs' is 1.  If a dict is given
+    as the 'cache' argument, digests are remembered in it along with the
+    size, timestamps and inode of the file, and are reused for as long as
+    these stay the same.  A Patcher uses this to avoid reading back the
+    files it has written when verifying the result.
+
+    With a "tree" hash the work is split up by blocks rather than by files,
+    so that large files are also hashed in parallel.
+    """
+
+    def __init__(self,hash=hashlib.md5,jobs=1,cache=None):
+        self.hash = hash
+        h = hash()
+        self.hash_name = h.name
+        self._leaf_hash = getattr(h,"leaf_hash",None)
+        self.jobs = jobs
+        self.cache = cache
+
+    def digest(self,target):
+        """Calculate the digest of the given file or directory."""
+        return self.digests([target])[0]
+
+    def digests(self,targets):
+        """Calculate the digests of each of the given files or directories."""
+        files = []
+        trees = [self._scan(target,files) for target in targets]
+        digests = self._hash_files(files)
+        return [self._combine(tree,digests) for tree in trees]
+
+    def patch_digest(self,target):
+        """Calculate the digest of the files in the esky file list.
+
+        If there's no file list then this is the digest of the whole target.
+        """
+        filelist = load_filelist(target)
+        if filelist is None:
+            return self.digest(target)
+        paths = [os.path.join(target,f) for f in filelist]
+        d = self.hash()
+        for (file_path,digest) in zip(paths,self.digests(paths)):
+            d.update(os.path.basename(file_path).encode("utf8"))
+            d.update(digest)
+        return d.digest()
+
+    def remember(self,path,digest):
+        """Remember that the file at the given path has the given digest."""
+        if self.cache is not None:
+            sig = (self.hash_name,) + _stat_signature(os.stat(path))
+            self.cache[path] = (sig,digest)
+
+    def _scan(self,target,files):
+        """Scan the given target, adding any files to be hashed to a list.
+
+        This returns a nested structure describing the target, for use by
+        the _combine() method once the files have been hashed.
+        """
+        st = os.stat(target)
+        if stat.S_ISDIR(st.st_mode):
+            children = []
+            for nm in sorted(os.listdir(target)):
+                child = self._scan(os.path.join(target,nm),files)
+                children.append((nm,child))
+            return children
+        files.append((target,st))
+        return target
+
+    def _hash_files(self,files):
+        """Get a dict mapping each of the given files to its digest."""
+        digests = {}
+        todo = []
+        for (path,st) in files:
+            sig = (self.hash_name,) + _stat_signature(st)
+            if self.cache is not None:
+                try:
+                    (c_sig,digest) = self.cache[path]
+                except KeyError:
+                    pass
+                else:
+                    if c_sig == sig:
+                        digests[path] = digest
+                        continue
+            todo.append((path,sig))
+        if self._leaf_hash is None:
+            results = self._map(self._hash_file,[path for (path,_) in todo])
+        else:
+            results = self._hash_trees([(path,sig[1]) for (path,sig) in todo])
+        for ((path,sig),digest) in zip(todo,results):
+            digests[path] = digest
+            if self.cache is not None:
+                self.cache[path] = (sig,digest)
+        return digests
+
+    def _map(self,func,items):
+        """Call func on each of the given items, using the worker threads."""
+        if self.jobs > 1 and len(items) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.jobs,len(items)))
+            try:
+                return pool.map(func,items)
+            finally:
+                pool.close()
+                pool.join()
+        return map(func,items)
+
+    def _hash_trees(self,files):
+        """Calculate the tree hash digests of a list of (path,size) tuples."""
+        blocks = []
+        for (path,size) in files:
+            for offset in xrange(0,size,_TREE_HASH_BLOCK_SIZE):
+                blocks.append((path,offset))
+        leaf_digests = iter(self._map(self._hash_block,blocks))
+        results = []
+        for (path,size) in files:
+            d = self._leaf_hash()
+            for _ in xrange(0,size,_TREE_HASH_BLOCK_SIZE):
+                d.update(leaf_digests.next())
+            results.append(d.digest())
+        return results
+
+    def _hash_block(self,block):
+        """Calculate the digest of a (path,offset) block of a file."""
+        (path,offset) = block
+        with open(path,"rb") as f:
+            f.seek(offset)
+            return self._leaf_hash(f.read(_TREE_HASH_BLOCK_SIZE)).digest()
+
+    def _hash_file(self,path):
+        """Calculate the digest of the contents of a single file."""
+        d = self.hash()
+        with open(path,"rb") as f:
+            data = f.read(_DIGEST_READ_SIZE)
+            while data:
+                d.update(data)
+                data = f.read(_DIGEST_READ_SIZE)
+        return d.digest()
+
+    def _combine(self,tree,digests):
+        """Calculate the digest of a scanned target from its file digests."""
+        if not isinstance(tree,list):
+            return digests[tree]
+        d = self.hash()
+        for (nm,child) in tree:
+            d.update(nm.encode("utf8"))
+            d.update(self._combine(child,digests))
+        return d.digest()
+
+
+class _DigestingWriter(object):
+    """File-like wrapper calculating the digest of the data written to it.
+
+    The digest is abandoned, setting the 'hash' attribute to None, if the
+    file is written other than by appending through write() - for example
+    by seeking, or by handing its fileno() to the kernel to copy data.
+    """
+
+    def __init__(self,file,hash=hashlib.md5):
+        self.file = file
+        self.hash = hash()
+
+    def write(self,data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.file.write(data)
+
+    def fileno(self):
+        self.hash = None
+        return self.file.fileno()
+
+    def seek(self,*args):
+        self.hash = None
+        self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
 
 
 class Patcher(object):
@@ -455,19 +1648,47 @@ class Patcher(object):
     Instances of this class can be used to apply a sequence of patch commands
     to a target file or directory.  You can think of it as a little automaton
     that edits a directory in-situ.
+
+    If the 'checkpoint' argument names a file, progress through the patch
+    is periodically recorded in it.  Should patching be interrupted, a new
+    Patcher given the same target, patch and checkpoint file will pick up
+    from the last checkpoint rather than starting again.  The patch stream
+    must be seekable (or will be read through to the checkpoint) and the
+    checkpoint file is removed once the patch has been applied.
     """
 
-    def __init__(self,target,commands,dry_run=False):
+    def __init__(self,target,commands,dry_run=False,jobs=None,checkpoint=None):
         target = os.path.abspath(target)
         self.target = target
         self.new_target = None
-        self.commands = commands
+        self.commands = _CommandReader(commands)
         self.root_dir = self.target
         self.infile = None
         self.outfile = None
         self.dry_run = dry_run
-        self._workdir = tempfile.mkdtemp()
+        self._workdir = None
         self._context_stack = []
+        self._solid = None
+        self._sections = None
+        self._done_sections = set()
+        if not jobs:
+            jobs = 1
+        self.jobs = jobs
+        self._pool = None
+        self._jobs = {}
+        self._batch = []
+        self._batch_size = 0
+        self._workers = threading.local()
+        self.checkpoint = checkpoint
+        self._resumed = False
+        #  Suffix for the temp files that new file contents are written to.
+        self._new_suffix = ".new"
+        self._replay_unsafe = False
+        self._checkpoint_time = 0
+        self._finished_sections = []
+        self._solid_offset = None
+        self._solid_used = 0
+        self._digester = _Digester(hashlib.md5,self.jobs,cache={})
 
     def __del__(self):
         if self.infile:
@@ -477,27 +1698,37 @@ class Patcher(object):
         if self._workdir and shutil:
             really_rmtree(self._workdir)
 
+    def _context_workdir(self):
+        """Get a temp directory path for the context being entered.
+
+        The directory itself isn't created, but the temp directory that
+        holds it is made on first use.
+        """
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp()
+        return os.path.join(self._workdir,str(len(self._context_stack)))
+
     def _read(self,size):
         """Read the given number of bytes from the command stream."""
         return self.commands.read(size)
 
     def _read_int(self):
         """Read an integer from the command stream."""
-        i = _read_vint(self.commands)
+        i = self.commands.read_vint()
         if self.dry_run:
             print "  ", i
         return i
 
     def _read_command(self):
         """Read the next command to be processed."""
-        cmd = _read_vint(self.commands)
+        cmd = self.commands.read_vint()
         if self.dry_run:
             print _COMMANDS[cmd]
         return cmd
 
     def _read_bytes(self):
         """Read a bytestring from the command stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted bytestring")
@@ -507,7 +1738,7 @@ class Patcher(object):
 
     def _read_path(self):
         """Read a unicode path from the given stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted path")
@@ -525,14 +1756,22 @@ class Patcher(object):
         if not self.outfile and not self.dry_run:
             if os.path.exists(self.target) and not os.path.isfile(self.target):
                 really_rmtree(self.target)
-            self.new_target = self.target + ".new"
+            self.new_target = self.target + self._new_suffix
+            #  When resuming, a file with the suffix recorded in the
+            #  checkpoint was left over from the interrupted attempt at
+            #  this same file.  Anything else is left alone.
+            if self._resumed and os.path.isfile(self.new_target):
+                os.unlink(self.new_target)
             while os.path.exists(self.new_target):
                 self.new_target += ".new"
             if os.path.exists(self.target):
                 self.infile = open(self.target,"rb")
             else:
                 self.infile = BytesIO("".encode("ascii"))
-            self.outfile = open(self.new_target,"wb")
+            #  Hash the new file as it's written, so that verifying the
+            #  result doesn't have to read it back in again.
+            self.outfile = _DigestingWriter(open(self.new_target,"wb"),
+                                            self._digester.hash)
             if os.path.isfile(self.target):
                 mod = os.stat(self.target).st_mode
                 os.chmod(self.new_target,mod)
@@ -546,6 +1785,7 @@ class Patcher(object):
         if self.outfile and not self.dry_run:
             self.infile.close()
             self.infile = None
+            digest = self.outfile.hash
             self.outfile.close()
             self.outfile = None
             if os.path.exists(self.target):
@@ -554,6 +1794,9 @@ class Patcher(object):
                     time.sleep(0.01)
             really_rename(self.new_target,self.target)
             self.new_target = None
+            self._replay_unsafe = True
+            if digest is not None:
+                self._digester.remember(self.target,digest.digest())
 
     def _check_path(self,path=None):
         """Check that we're not traversing outside the root."""
@@ -615,6 +1858,12 @@ class Patcher(object):
         This is a simple command loop that dispatches to the _do_<CMD>
         methods defined below.  It keeps processing until one of them
         raises EOFError.
+
+        If the patch has a table of contents and more than one job is
+        requested, the sections of the patch are applied in parallel by a
+        pool of threads.  Any other command that touches the filesystem
+        waits for all outstanding sections to be applied, so the result is
+        the same as applying them one at a time.
         """
         header = self._read(len(PATCH_HEADER))
         if header != PATCH_HEADER:
@@ -622,14 +1871,42 @@ class Patcher(object):
         version = self._read_int()
         if version > HIGHEST_VERSION:
             raise PatchError("esky patch version %d not supported"%(version,))
+        self._patch_version = version
         try:
-            while True:
-                cmd = self._read_command()
-                getattr(self,"_do_" + _COMMANDS[cmd])()
-        except EOFError:
-            self._check_end_patch()
+            hash_name = "md5"
+            if version >= 7:
+                hash_name = _read_hash(self.commands)
+                hash = get_hash(hash_name)
+                self._digester = _Digester(hash,self.jobs,
+                                           cache=self._digester.cache)
+            if version >= 6:
+                self._sections = _read_sections(self.commands,hash_name)
+                if self.jobs > 1 and not self.dry_run:
+                    from multiprocessing.pool import ThreadPool
+                    self._pool = ThreadPool(self.jobs)
+            if self.checkpoint is not None and not self.dry_run:
+                if os.path.exists(self.checkpoint):
+                    self._resume_from_checkpoint()
+                else:
+                    #  Give our temp files a name of their own, so that any
+                    #  left over by an interruption can be recognised.
+                    (suffix,) = struct.unpack("<I",os.urandom(4))
+                    self._new_suffix = ".%08x.new" % (suffix,)
+            if self._sections is not None and not self.dry_run:
+                self._check_sections()
+            if self.checkpoint is not None and not self.dry_run:
+                #  Record the suffix before any temp files are written.
+                self._write_checkpoint()
+            self._process_commands()
             self._cleanup_patch()
+            if self.checkpoint is not None and not self.dry_run:
+                if os.path.exists(self.checkpoint):
+                    os.unlink(self.checkpoint)
         finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
             if self.infile:
                 self.infile.close()
                 self.infile = None
@@ -637,6 +1914,184 @@ class Patcher(object):
                 self.outfile.close()
                 self.outfile = None
 
+    def _process_commands(self):
+        """Process commands until the end of the stream or a final END."""
+        #  Look up the handlers once, rather than for every command.  They're
+        #  unbound so that we don't create a reference cycle via self.
+        dispatch = [getattr(type(self),"_do_" + nm) for nm in _COMMANDS]
+        checkpoint = self.checkpoint is not None and not self.dry_run
+        try:
+            while True:
+                cmd = self._read_command()
+                if cmd >= len(dispatch):
+                    raise PatchError("unknown patch command %d" % (cmd,))
+                if self._pool is not None and cmd not in _PARALLEL_COMMANDS:
+                    self._wait_for_jobs()
+                dispatch[cmd](self)
+                if checkpoint:
+                    self._maybe_checkpoint()
+        except EOFError:
+            if self._pool is not None:
+                self._wait_for_jobs()
+            self._check_end_patch()
+
+    def _wait_for_jobs(self,path=None):
+        """Wait for sections being applied in parallel to complete.
+
+        If a path is given, this waits only for the section patching that
+        path; otherwise it waits for all outstanding sections.  Any errors
+        from applying the sections are raised here.
+        """
+        if self._batch:
+            self._start_batch()
+        if path is not None:
+            #  Only the main thread calls get() on the jobs, since on some
+            #  versions of python it only wakes up a single waiter.
+            try:
+                (job,done) = self._jobs[path]
+            except KeyError:
+                pass
+            else:
+                done.wait()
+        else:
+            for (job,done) in self._jobs.values():
+                job.get()
+            self._jobs.clear()
+
+    def _maybe_checkpoint(self):
+        """Write a checkpoint, if one is due and it's safe to do so.
+
+        Checkpoints are only written between files at the top level of the
+        patch.  Most commands can simply be applied again after resuming,
+        but those that copy or move files, or replace a file outside of a
+        section, can't; a checkpoint is written straight after them.
+        Otherwise one is written every CHECKPOINT_INTERVAL seconds.
+        """
+        if self.outfile is not None or self._context_stack:
+            return
+        if not self._replay_unsafe:
+            if time.time() - self._checkpoint_time < CHECKPOINT_INTERVAL:
+                return
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        """Record our progress through the patch in the checkpoint file."""
+        if self._pool is not None:
+            self._wait_for_jobs()
+        if self.target == self.root_dir:
+            target = ""
+        else:
+            target = os.path.relpath(self.target,self.root_dir)
+        state = {
+            "version": self._patch_version,
+            "offset": self.commands.tell(),
+            "target": target.replace(os.sep,"/"),
+            "sections": self._finished_sections,
+            "solid": None,
+            "suffix": self._new_suffix,
+        }
+        if self._solid is not None:
+            state["solid"] = [self._solid_offset,self._solid_used]
+        tmpfile = self.checkpoint + ".new"
+        with open(tmpfile,"w") as f:
+            json.dump(state,f)
+        really_rename(tmpfile,self.checkpoint)
+        self._replay_unsafe = False
+        self._checkpoint_time = time.time()
+
+    def _resume_from_checkpoint(self):
+        """Skip over the commands that were applied before the checkpoint."""
+        try:
+            with open(self.checkpoint,"r") as f:
+                state = json.load(f)
+            version = state["version"]
+            offset = state["offset"]
+            target = state["target"]
+            sections = state["sections"]
+            solid = state["solid"]
+            suffix = state["suffix"]
+        except (ValueError,KeyError,TypeError):
+            raise PatchError("corrupted checkpoint: %s" % (self.checkpoint,))
+        if version != self._patch_version or offset < self.commands.tell():
+            raise PatchError("checkpoint doesn't match patch")
+        if solid is not None:
+            (solid_offset,solid_used) = solid
+            self._skip_commands(solid_offset - self.commands.tell())
+            self._do_SOLID_BLOCK()
+            self._skip_solid(solid_used)
+        self._skip_commands(offset - self.commands.tell())
+        if target:
+            self.target = os.path.join(self.root_dir,target.replace("/",os.sep))
+            self._check_path()
+        self._finished_sections = list(sections)
+        self._new_suffix = suffix
+        self._resumed = True
+
+    def _skip_commands(self,n):
+        """Skip over the next n bytes of the command stream."""
+        try:
+            self.commands.seek(n,os.SEEK_CUR)
+        except (AttributeError,IOError):
+            while n > 0:
+                data = self._read(min(n,_ADD_CHUNK_SIZE))
+                if not data:
+                    raise EOFError
+                n -= len(data)
+
+    def _read_solid(self,size):
+        """Read up to the given number of bytes from the solid block."""
+        data = self._solid.read(size)
+        self._solid_used += len(data)
+        return data
+
+    def _skip_solid(self,n):
+        """Skip over the next n bytes of the solid block."""
+        if n and self._solid is None:
+            raise PatchError("section without a solid block")
+        while n > 0:
+            data = self._read_solid(min(n,_ADD_CHUNK_SIZE))
+            if not data:
+                raise PatchError("insufficient data in solid block")
+            n -= len(data)
+
+    def _check_sections(self):
+        """Check the files to be patched against the table of contents.
+
+        This is done before any changes are made.  Each file that exists in
+        the source must match either the source digest of its section, in
+        which case it will be patched, or the target digest, in which case
+        the section will be skipped.  Anything else is an error, and all
+        the files in error are reported together.
+        """
+        checks = []
+        bad_paths = []
+        finished = set(self._finished_sections)
+        for (i,section) in enumerate(self._sections):
+            if not section.source_digest or i in finished:
+                continue
+            path = self._section_path(section)
+            if not os.path.isfile(path):
+                bad_paths.append(section.path)
+            else:
+                checks.append((i,section,path))
+        paths = [path for (_,_,path) in checks]
+        digests = self._digester.digests(paths)
+        for ((i,section,path),digest) in zip(checks,digests):
+            if digest == section.target_digest:
+                self._done_sections.add(i)
+            elif digest != section.source_digest:
+                bad_paths.append(section.path)
+        if bad_paths:
+            hash_name = self._sections[0].hash_name
+            raise PatchVerifyError(sorted(bad_paths),hash_name)
+
+    def _section_path(self,section):
+        """Get the path of the file patched by the given section."""
+        path = os.path.join(self.root_dir,section.path.replace("/",os.sep))
+        path = os.path.normpath(path)
+        self._check_path(path)
+        return path
+
     def _do_END(self):
         """Execute the END command.
 
@@ -700,14 +2155,42 @@ class Patcher(object):
 
         This reads 16 bytes from the command stream, and compares them to
         the calculated digest for the current target path.  If they differ,
-        a PatchError is raised.
+        a PatchVerifyError is raised.
         """
         self._check_end_patch()
         digest = self._read(16)
         assert len(digest) == 16
-        if not self.dry_run:
-            if digest != calculate_patch_digest(self.target,hashlib.md5):
-                raise PatchError("incorrect MD5 digest for %s" % (self.target,))
+        self._verify("md5",digest)
+
+    def _do_VERIFY(self):
+        """Execute the VERIFY command.
+
+        This reads the id of a hash algorithm and a digest from the command
+        stream, and compares the digest to the one calculated for the current
+        target path using that algorithm.  If they differ, a PatchVerifyError
+        is raised.
+        """
+        self._check_end_patch()
+        hash_name = _read_hash(self.commands)
+        size = get_hash(hash_name)().digest_size
+        digest = self._read(size)
+        if len(digest) != size:
+            raise PatchError("corrupted patch: truncated digest")
+        self._verify(hash_name,digest)
+
+    def _verify(self,hash_name,digest):
+        """Check the current target against the given digest."""
+        if self.dry_run:
+            return
+        digester = self._digester
+        hash = get_hash(hash_name)
+        if hash().name != digester.hash_name:
+            digester = _Digester(hash,digester.jobs,cache=digester.cache)
+        if digest != digester.patch_digest(self.target):
+            path = os.path.relpath(self.target,self.root_dir)
+            if path == os.curdir:
+                path = ""
+            raise PatchVerifyError([path.replace(os.sep,"/")],hash_name)
 
     def _do_MAKEDIR(self):
         """Execute the MAKEDIR command.
@@ -748,6 +2231,7 @@ class Patcher(object):
         self._check_end_patch()
         source_path = os.path.join(os.path.dirname(self.target),self._read_path())
         self._check_path(source_path)
+        self._replay_unsafe = True
         if not self.dry_run:
             if os.path.exists(self.target):
                 if os.path.isdir(self.target):
@@ -755,32 +2239,60 @@ class Patcher(object):
                 else:
                     os.unlink(self.target)
             if os.path.isfile(source_path):
-                shutil.copy2(source_path,self.target)
+                copy_file(source_path,self.target)
             else:
-                shutil.copytree(source_path,self.target)
+                copy_tree(source_path,self.target)
 
-    def _do_MOVE_FROM(self):
-        """Execute the MOVE_FROM command.
+    def _do_COPY_FROM_ROOT(self):
+        """Execute the COPY_FROM_ROOT command.
 
-        This reads a path from the command stream, and moves whatever is
-        at that path to the current target path.  The source path is
-        interpreted relative to the directory containing the current path;
-        this caters for the common case of moving a file within the same
-        directory.
+        This reads a path from the command stream, and copies whatever is
+        at that path to the current target path.  Unlike COPY_FROM, the
+        source path is interpreted relative to the root directory; this
+        caters for files that have moved between directories.
         """
         self._check_end_patch()
-        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
+        source_path = self._read_path().replace("/",os.sep)
+        source_path = os.path.normpath(os.path.join(self.root_dir,source_path))
         self._check_path(source_path)
+        self._replay_unsafe = True
+        #  The source may be a file written by a section that is still
+        #  being applied in parallel.
+        self._wait_for_jobs(source_path)
         if not self.dry_run:
             if os.path.exists(self.target):
                 if os.path.isdir(self.target):
                     really_rmtree(self.target)
                 else:
                     os.unlink(self.target)
-                if sys.platform == "win32":
-                    time.sleep(0.01)
-            really_rename(source_path,self.target)
-
+            if os.path.isfile(source_path):
+                copy_file(source_path,self.target)
+            else:
+                copy_tree(source_path,self.target)
+
+    def _do_MOVE_FROM(self):
+        """Execute the MOVE_FROM command.
+
+        This reads a path from the command stream, and moves whatever is
+        at that path to the current target path.  The source path is
+        interpreted relative to the directory containing the current path;
+        this caters for the common case of moving a file within the same
+        directory.
+        """
+        self._check_end_patch()
+        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
+        self._check_path(source_path)
+        self._replay_unsafe = True
+        if not self.dry_run:
+            if os.path.exists(self.target):
+                if os.path.isdir(self.target):
+                    really_rmtree(self.target)
+                else:
+                    os.unlink(self.target)
+                if sys.platform == "win32":
+                    time.sleep(0.01)
+            really_rename(source_path,self.target)
+
     def _do_PF_COPY(self):
         """Execute the PF_COPY command.
 
@@ -791,7 +2303,7 @@ class Patcher(object):
         self._check_begin_patch()
         n = self._read_int()
         if not self.dry_run:
-            self.outfile.write(self.infile.read(n))
+            copy_file_data(self.infile,self.outfile,n)
 
     def _do_PF_SKIP(self):
         """Execute the PF_SKIP command.
@@ -802,7 +2314,7 @@ class Patcher(object):
         self._check_begin_patch()
         n = self._read_int()
         if not self.dry_run:
-            self.infile.read(n)
+            self.infile.seek(n,os.SEEK_CUR)
 
     def _do_PF_INS_RAW(self):
         """Execute the PF_INS_RAW command.
@@ -824,9 +2336,33 @@ class Patcher(object):
         bz2 and and write the result into the target file.
         """
         self._check_begin_patch()
-        data = bz2.decompress(self._read_bytes())
+        self._write_decompressed(_BZ2Reader(self._read_bytes()))
+
+    def _do_PF_INS_ZLIB(self):
+        """Execute the PF_INS_ZLIB command.
+
+        This is just like PF_INS_BZ2, except that the data is compressed
+        using zlib.  It's much faster to decompress.
+        """
+        self._check_begin_patch()
+        self._write_decompressed(_ZlibReader(self._read_bytes()))
+
+    def _do_PF_INS_LZMA(self):
+        """Execute the PF_INS_LZMA command.
+
+        This is just like PF_INS_BZ2, except that the data is compressed
+        using lzma.  It's usually smaller and faster to decompress.
+        """
+        self._check_begin_patch()
+        self._write_decompressed(_LZMAReader(self._read_bytes()))
+
+    def _write_decompressed(self,data):
+        """Copy decompressed data from the given reader into the target."""
         if not self.dry_run:
-            self.outfile.write(data)
+            chunk = data.read(_ADD_CHUNK_SIZE)
+            while chunk:
+                self.outfile.write(chunk)
+                chunk = data.read(_ADD_CHUNK_SIZE)
 
     def _do_PF_BSDIFF4(self):
         """Execute the PF_BSDIFF4 command.
@@ -835,16 +2371,100 @@ class Patcher(object):
         the command stream.  It then reads N bytes from the source file,
         applies the patch to these bytes, and writes the result into the
         target file.
+
+        Large patches are applied in a streaming fashion, so that we never
+        hold the full source or result data in memory.
         """
         self._check_begin_patch()
         n = self._read_int()
         # Restore the standard bsdiff header bytes
         patch = "BSDIFF40".encode("ascii") + self._read_bytes()
         if not self.dry_run:
-            source = self.infile.read(n)
-            if len(source) != n:
-                raise PatchError("insufficient source data in %s" % (self.target,))
-            self.outfile.write(bsdiff4.patch(source,patch))
+            l_target = _decode_offt(patch[24:32])
+            if bsdiff4 is bsdiff4_py or max(n,l_target) > BSDIFF4_STREAM_SIZE:
+                self._bsdiff4_stream(n,patch,_BZ2Reader)
+            else:
+                source = self._read_source(n)
+                self.outfile.write(bsdiff4.patch(source,patch))
+
+    def _do_PF_BSDIFF4_LZMA(self):
+        """Execute the PF_BSDIFF4_LZMA command.
+
+        This is just like PF_BSDIFF4, except that the three data blocks in
+        the patch are compressed using lzma rather than bz2.
+        """
+        self._check_begin_patch()
+        n = self._read_int()
+        patch = "BSDIFF40".encode("ascii") + self._read_bytes()
+        if not self.dry_run:
+            if lzma is None:
+                raise PatchError("lzma support is not available")
+            l_target = _decode_offt(patch[24:32])
+            if bsdiff4 is bsdiff4_py or max(n,l_target) > BSDIFF4_STREAM_SIZE:
+                self._bsdiff4_stream(n,patch,_LZMAReader)
+            else:
+                source = self._read_source(n)
+                result = _bsdiff4_patch_blocks(source,patch,_lzma_decompress)
+                self.outfile.write(result)
+
+    def _read_source(self,n):
+        """Read exactly n bytes of data from the source file."""
+        source = self.infile.read(n)
+        if len(source) != n:
+            raise PatchError("insufficient source data in %s" % (self.target,))
+        return source
+
+    def _bsdiff4_stream(self,n,patch,reader):
+        """Apply a bsdiff4 patch to n bytes of source in a streaming fashion."""
+        s_start = self.infile.tell()
+        self.infile.seek(0,os.SEEK_END)
+        if self.infile.tell() - s_start < n:
+            raise PatchError("insufficient source data in %s" % (self.target,))
+        self.infile.seek(s_start)
+        bsdiff4_py.patch_stream(self.infile,n,patch,self.outfile,reader)
+
+    def _do_SOLID_BLOCK(self):
+        """Execute the SOLID_BLOCK command.
+
+        This reads a PF_INS_* command number and a bytestring compressed
+        in the manner of that command.  Subsequent PF_INS_SOLID commands
+        take their data from the decompressed bytes, in order.
+
+        Since the block may begin partway through the commands for a file,
+        this doesn't finish patching the current file.
+        """
+        self._solid_offset = self.commands.tell()
+        self._solid_used = 0
+        cmd = self._read_int()
+        data = self._read_bytes()
+        if cmd == PF_INS_RAW:
+            self._solid = BytesIO(data)
+        elif cmd == PF_INS_BZ2:
+            self._solid = _BZ2Reader(data)
+        elif cmd == PF_INS_ZLIB:
+            self._solid = _ZlibReader(data)
+        elif cmd == PF_INS_LZMA:
+            self._solid = _LZMAReader(data)
+        else:
+            raise PatchError("unknown solid block compression: %d" % (cmd,))
+
+    def _do_PF_INS_SOLID(self):
+        """Execute the PF_INS_SOLID command.
+
+        This reads an integer N from the command stream, then copies the
+        next N bytes from the current solid block into the target file.
+        """
+        self._check_begin_patch()
+        n = self._read_int()
+        if self._solid is None:
+            raise PatchError("PF_INS_SOLID without a solid block")
+        while n > 0:
+            data = self._read_solid(min(n,_ADD_CHUNK_SIZE))
+            if not data:
+                raise PatchError("insufficient data in solid block")
+            if not self.dry_run:
+                self.outfile.write(data)
+            n -= len(data)
 
     def _do_PF_REC_ZIP(self):
         """Execute the PF_REC_ZIP command.
@@ -858,12 +2478,111 @@ class Patcher(object):
         actual contents of the zipfile.
         """
         self._check_begin_patch()
+        self._patch_zipfile(None)
+
+    def _do_PF_REC_ZIP_RAW(self):
+        """Execute the PF_REC_ZIP_RAW command.
+
+        This is just like PF_REC_ZIP, except that it first reads a list of
+        member names from the command stream.  Only those members are
+        extracted from the source zipfile.  Any members of the target that
+        are not produced by the sub-commands are copied from the source
+        zipfile without being decompressed.
+        """
+        self._check_begin_patch()
+        n = self._read_int()
+        members = set()
+        for _ in xrange(n):
+            members.add(self._read_bytes())
+        self._patch_zipfile(members)
+
+    def _do_PF_BCJ_X86(self):
+        """Execute the PF_BCJ_X86 command.
+
+        This patches the current target with the branch targets of its x86
+        code made absolute; see _bcj_x86_copy for details.  The source file
+        is filtered into a temp file, which is patched by the END-terminated
+        block of sub-commands that follow.  The result is then converted back
+        into the target file.
+        """
+        self._check_begin_patch()
+        def encode(infile,outfile):
+            _bcj_x86_copy(infile,outfile,True)
+        def decode(infile,outfile):
+            _bcj_x86_copy(infile,outfile,False)
+        self._begin_filter(encode,decode)
+
+    def _do_PF_SET_HEADER(self):
+        """Execute the PF_SET_HEADER command.
+
+        This generates new data for the file currently being patched.  It
+        reads a bytestring from the command stream and writes it into the
+        target file in place of the same number of bytes from the source
+        file, then copies the rest of the source file.  It's used for .pyc
+        files that differ only in their header.
+        """
+        self._check_begin_patch()
+        header = self._read_bytes()
         if not self.dry_run:
-            workdir = os.path.join(self._workdir,str(len(self._context_stack)))
+            self._read_source(len(header))
+            self.outfile.write(header)
+            copy_file_data(self.infile,self.outfile)
+
+    def _do_PF_REPLACE(self):
+        """Execute the PF_REPLACE command.
+
+        This reads two bytestrings from the command stream, and patches the
+        current target with every occurrence of the first replaced by the
+        second.  Like PF_BCJ_X86 the source file is filtered into a temp file
+        and patched by the END-terminated block of sub-commands that follow,
+        but the result is copied into the target file unchanged.
+        """
+        self._check_begin_patch()
+        old = self._read_bytes()
+        new = self._read_bytes()
+        if not old:
+            raise PatchError("corrupted patch: nothing to replace")
+        def encode(infile,outfile):
+            _replace_copy(infile,outfile,old,new)
+        self._begin_filter(encode,copy_file_data)
+
+    def _begin_filter(self,encode,decode):
+        """Begin patching a filtered copy of the current target.
+
+        The source file is passed through the 'encode' function into a temp
+        file, which the following sub-commands patch.  At their END the
+        result is passed through 'decode' into the target file.
+        """
+        if not self.dry_run:
+            workdir = self._context_workdir()
+            os.mkdir(workdir)
+            f_temp = os.path.join(workdir,"data")
+            with open(f_temp,"wb") as f:
+                encode(self.infile,f)
+        cur_state = self._blank_state()
+        def end_filter():
+            self._restore_state(cur_state)
+            if not self.dry_run:
+                with open(f_temp,"rb") as f:
+                    decode(f,self.outfile)
+                really_rmtree(workdir)
+        self._context_stack.append(end_filter)
+        if not self.dry_run:
+            self.root_dir = workdir
+            self.target = f_temp
+
+    def _patch_zipfile(self,members):
+        """Recurse into the current target as a zipfile.
+
+        If 'members' is None then the entire source zipfile is extracted
+        for patching; otherwise only the named members are extracted, and
+        the rest are copied raw from the source into the target.
+        """
+        if not self.dry_run:
+            workdir = self._context_workdir()
             os.mkdir(workdir)
             t_temp = os.path.join(workdir,"contents")
             m_temp = os.path.join(workdir,"meta")
-            z_temp = os.path.join(workdir,"result.zip")
         cur_state = self._blank_state()
         zfmeta = [None]  # stupid lack of mutable closure variables...
         #  First we process a set of commands to generate the zipfile metadata.
@@ -875,12 +2594,16 @@ class Patcher(object):
         def end_contents():
             self._restore_state(cur_state)
             if not self.dry_run:
-                create_zipfile(t_temp,z_temp,members=zfmeta[0].infolist())
-                with open(z_temp,"rb") as f:
-                    data = f.read(1024*16)
-                    while data:
-                        self.outfile.write(data)
-                        data = f.read(1024*16)
+                infolist = zfmeta[0].infolist()
+                if members is None:
+                    create_zipfile(t_temp,self.outfile,members=infolist)
+                else:
+                    zf = zipfile.ZipFile(self.target,"r")
+                    try:
+                        create_zipfile(t_temp,self.outfile,members=infolist,
+                                       raw_source=zf)
+                    finally:
+                        zf.close()
                 zfmeta[0].close()
                 really_rmtree(workdir)
         self._context_stack.append(end_contents)
@@ -894,10 +2617,142 @@ class Patcher(object):
                     _write_zipfile_metadata(f,zf)
                 finally:
                     zf.close()
-            extract_zipfile(self.target,t_temp)
+            os.mkdir(t_temp)
+            if members is None:
+                extract_zipfile(self.target,t_temp)
+            else:
+                def name_filter(nm):
+                    if _zip_member_key(nm) in members:
+                        return nm
+                    return None
+                extract_zipfile(self.target,t_temp,name_filter)
             self.root_dir = workdir
             self.target = m_temp
 
+    def _do_SECTION(self):
+        """Execute the SECTION command.
+
+        This reads the index of an entry in the table of contents.  The
+        commands for that section follow, terminated by an END command, and
+        are applied to the path given in the table of contents.
+
+        If the file at that path already matches the target digest, the
+        section is skipped without interpreting any of its commands.
+        """
+        self._check_end_patch()
+        i = self._read_int()
+        try:
+            section = self._sections[i]
+        except (IndexError,TypeError):
+            raise PatchError("unknown section: %d" % (i,))
+        path = self._section_path(section)
+        if self.dry_run:
+            print "  ", section.path
+        elif self._section_is_done(i,section,path):
+            self._skip_section(i,section,path)
+            self._finished_sections.append(i)
+            return
+        elif self._pool is not None:
+            self._start_section(i,section,path)
+            return
+        cur_state = self._save_state()
+        replay_unsafe = self._replay_unsafe
+        def end_section():
+            self._restore_state(cur_state)
+            #  A section can safely be applied again after resuming, since
+            #  it's skipped if the file has already been patched.
+            self._replay_unsafe = replay_unsafe
+            self._finished_sections.append(i)
+        self._context_stack.append(end_section)
+        self.target = path
+
+    def _section_is_done(self,i,section,path):
+        """Check whether the given section has already been applied."""
+        if i in self._done_sections:
+            return True
+        if section.source_digest or not os.path.isfile(path):
+            return False
+        return self._digester.digest(path) == section.target_digest
+
+    def _skip_section(self,i,section,path):
+        """Skip over the commands for a section that is already applied."""
+        if os.stat(path).st_mode != section.target_mode:
+            self._unshare_file(path)
+            os.chmod(path,section.target_mode)
+        #  The section's length includes the SECTION command we just read.
+        self._skip_commands(section.length-_vint_size(SECTION)-_vint_size(i))
+        self._skip_solid(section.solid_size)
+
+    def _start_section(self,i,section,path):
+        """Queue a section to be applied in the thread pool.
+
+        The commands and solid block data for the section are read here,
+        in order, and added to the batch of sections for the next job.
+        """
+        n = section.length - _vint_size(SECTION) - _vint_size(i)
+        data = self._read(n)
+        if len(data) != n:
+            raise PatchError("corrupted section: %s" % (section.path,))
+        solid = b""
+        if section.solid_size:
+            if self._solid is None:
+                raise PatchError("section without a solid block")
+            solid = self._read_solid(section.solid_size)
+            if len(solid) != section.solid_size:
+                raise PatchError("insufficient data in solid block")
+        self._batch.append((i,path,data,solid,threading.Event()))
+        self._batch_size += len(data) + len(solid)
+        if len(self._batch) >= _SECTION_BATCH_COUNT:
+            self._start_batch()
+        elif self._batch_size >= _SECTION_BATCH_SIZE:
+            self._start_batch()
+
+    def _start_batch(self):
+        """Start applying the current batch of sections in the thread pool."""
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        job = self._pool.apply_async(self._apply_sections,(batch,))
+        for (i,path,data,solid,done) in batch:
+            self._jobs[path] = (job,done)
+
+    def _apply_sections(self,batch):
+        """Apply a batch of sections in a worker thread.
+
+        Each worker thread keeps a Patcher of its own to apply sections
+        with.  The event for each section is set once it has been applied,
+        or has failed to apply, and only then is it counted as finished.
+        """
+        patcher = getattr(self._workers,"patcher",None)
+        if patcher is None:
+            patcher = Patcher(self.root_dir,BytesIO())
+            patcher._jobs = self._jobs
+            patcher._resumed = self._resumed
+            patcher._new_suffix = self._new_suffix
+            patcher._digester = self._digester
+            self._workers.patcher = patcher
+        try:
+            for (i,path,data,solid,done) in batch:
+                patcher.commands = _CommandReader(BytesIO(data))
+                patcher.root_dir = self.root_dir
+                patcher.target = path
+                patcher._solid = BytesIO(solid)
+                try:
+                    patcher._process_commands()
+                finally:
+                    if patcher.infile:
+                        patcher.infile.close()
+                        patcher.infile = None
+                    if patcher.outfile:
+                        patcher.outfile.close()
+                        patcher.outfile = None
+                    done.set()
+                self._finished_sections.append(i)
+        finally:
+            #  Don't leave anyone waiting on sections that won't be applied.
+            for (i,path,data,solid,done) in batch:
+                done.set()
+
     def _do_CHMOD(self):
         """Execute the CHMOD command.
 
@@ -907,8 +2762,952 @@ class Patcher(object):
         self._check_end_patch()
         mod = self._read_int()
         if not self.dry_run:
+            self._unshare_file(self.target)
             os.chmod(self.target,mod)
 
+    def _unshare_file(self,path):
+        """Ensure the file at the given path is not a hard link.
+
+        Files are normally patched by writing a new file and renaming it
+        into place, so the target tree can be built from hard links into
+        the installed version.  Anything that modifies a file in-place must
+        call this first so the installed version is left untouched.
+        """
+        if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+            new_path = path + ".new"
+            while os.path.exists(new_path):
+                new_path += ".new"
+            copy_file(path,new_path)
+            os.unlink(path)
+            really_rename(new_path,path)
+
+
+#  Name of the scratch directory used by squashed patches to hold copies of
+#  source entries that are needed somewhere else in the tree.
+_SQUASH_STASH = ".esky-squash-tmp"
+
+
+class _VOrig(object):
+    """Virtual tree entry that is a copy of an entry in the base tree.
+
+    The entry is whatever the base tree has at path 'ref' (a tuple of path
+    components), possibly with a new mode.  It may be a file or directory.
+    """
+    __slots__ = ("ref","mode")
+    def __init__(self,ref,mode=None):
+        self.ref = ref
+        self.mode = mode
+
+
+class _VDir(object):
+    """Virtual tree entry for a newly-created directory."""
+    __slots__ = ("mode",)
+    def __init__(self,mode=None):
+        self.mode = mode
+
+
+class _VFile(object):
+    """Virtual tree entry for a file with new contents.
+
+    The contents are a list of segments, each of which is either a bytestring
+    or a tuple (ref,start,length,diff) giving a range of the base file at
+    path 'ref' and optional bytes to add to it, as in a bsdiff4 patch.  A
+    length of None means the rest of the file.  If 'mode' is None, the mode
+    is that of the base file at path 'mode_origin', if any.
+    """
+    __slots__ = ("segments","mode","mode_origin")
+    def __init__(self,segments,mode=None,mode_origin=None):
+        self.segments = segments
+        self.mode = mode
+        self.mode_origin = mode_origin
+
+
+class _VZip(object):
+    """Virtual tree entry for a zipfile patched by recursing into it.
+
+    The zipfile starts out as the file entry 'base', and its extracted
+    contents are then patched as the virtual tree 'tree'.
+    """
+    __slots__ = ("base","tree","mode")
+    def __init__(self,base,tree,mode=None):
+        self.base = base
+        self.tree = tree
+        self.mode = mode
+
+
+class _VFilter(object):
+    """Virtual tree entry for a file patched through a filter.
+
+    The file starts out as the file entry 'base'.  Its filtered contents are
+    then patched as the file at path ("data",) in the virtual tree 'tree'.
+    The filter is given by a tuple of the filter command and its arguments,
+    e.g. (PF_BCJ_X86,) or (PF_REPLACE,old,new).
+    """
+    __slots__ = ("base","filter","tree","mode")
+    def __init__(self,base,filter,tree,mode=None):
+        self.base = base
+        self.filter = filter
+        self.tree = tree
+        self.mode = mode
+
+
+class _VTree(object):
+    """Virtual directory tree, used when squashing patches.
+
+    Only entries that have been changed are stored, keyed by tuples of path
+    components.  Everything else is implicitly the same as the entry at the
+    same place in the base tree, unless one of its parents has changed.
+    """
+
+    def __init__(self,nodes=None,counts=None):
+        if nodes is None:
+            nodes = {}
+        if counts is None:
+            counts = {}
+        self.nodes = nodes
+        #  Number of stored entries below each path, for quick pruning.
+        self._counts = counts
+
+    def copy(self):
+        return _VTree(dict(self.nodes),dict(self._counts))
+
+    def get(self,key):
+        """Get the entry at the given path, or None if it doesn't exist."""
+        for i in xrange(len(key),-1,-1):
+            prefix = key[:i]
+            if prefix in self.nodes:
+                node = self.nodes[prefix]
+                if i == len(key):
+                    return node
+                if isinstance(node,_VOrig):
+                    return _VOrig(node.ref + key[i:])
+                return None
+        return _VOrig(key)
+
+    def base_ref(self,key):
+        """Get the base entry that will be at the given path, if any.
+
+        This is the entry found at that path once all of its parents have
+        been put into place, but before the path itself is changed.
+        """
+        for i in xrange(len(key)-1,-1,-1):
+            prefix = key[:i]
+            if prefix in self.nodes:
+                node = self.nodes[prefix]
+                if isinstance(node,_VOrig):
+                    return node.ref + key[i:]
+                return None
+        return key
+
+    def below(self,key):
+        """List the (key,node) pairs of stored entries below the given path."""
+        if not self._counts.get(key):
+            return []
+        n = len(key)
+        return [(k,v) for (k,v) in self.nodes.iteritems()
+                      if len(k) > n and k[:n] == key]
+
+    def set(self,key,node,keep_children=False):
+        """Set the entry at the given path.
+
+        Any stored entries below that path are discarded, unless the
+        'keep_children' argument is true.
+        """
+        if not keep_children:
+            for (k,_) in self.below(key):
+                self._remove(k)
+        if key not in self.nodes:
+            for i in xrange(len(key)):
+                self._counts[key[:i]] = self._counts.get(key[:i],0) + 1
+        self.nodes[key] = node
+
+    def _remove(self,key):
+        del self.nodes[key]
+        for i in xrange(len(key)):
+            self._counts[key[:i]] -= 1
+
+    def copy_entry(self,source,target):
+        """Copy the entry at path 'source' to path 'target'."""
+        children = self.below(source)
+        self.set(target,self.get(source))
+        n = len(source)
+        for (k,v) in children:
+            self.set(target + k[n:],v)
+
+
+def _segment_size(segment):
+    if isinstance(segment,bytes):
+        return len(segment)
+    return segment[2]
+
+
+def _add_segment_diff(segments,diff):
+    """Add bsdiff4 diff bytes to the data described by a list of segments."""
+    result = []
+    pos = 0
+    for seg in segments:
+        size = _segment_size(seg)
+        piece = diff[pos:pos+size]
+        pos += size
+        if isinstance(seg,bytes):
+            result.append(_add_bytes(piece,seg))
+        else:
+            (ref,start,length,s_diff) = seg
+            if s_diff is not None:
+                piece = _add_bytes(piece,s_diff)
+            if piece.count(b"\x00") == len(piece):
+                piece = None
+            result.append((ref,start,length,piece))
+    return result
+
+
+def _normalize_segments(segments):
+    """Merge adjacent segments of a list where possible."""
+    result = []
+    data = []
+    for seg in segments:
+        if isinstance(seg,bytes):
+            if seg:
+                data.append(seg)
+            continue
+        if data:
+            result.append(b"".join(data))
+            data = []
+        if result and not isinstance(result[-1],bytes):
+            (ref,start,length,diff) = result[-1]
+            if ref == seg[0] and length is not None and \
+               start + length == seg[1] and (diff is None) == (seg[3] is None):
+                if seg[2] is None:
+                    new_length = None
+                else:
+                    new_length = length + seg[2]
+                if diff is not None:
+                    diff = diff + seg[3]
+                result[-1] = (ref,start,new_length,diff)
+                continue
+        result.append(seg)
+    if data:
+        result.append(b"".join(data))
+    return result
+
+
+class _SegmentReader(object):
+    """Stand-in for the source file being patched, when squashing.
+
+    Rather than returning bytes, this returns lists of segments describing
+    where the bytes come from.
+    """
+
+    def __init__(self,segments):
+        self.segments = segments
+        self._starts = []
+        self._size = 0
+        for seg in segments:
+            self._starts.append(self._size)
+            size = _segment_size(seg)
+            if size is None:
+                self._size = None
+                break
+            self._size += size
+        self._pos = 0
+
+    def tell(self):
+        return self._pos
+
+    def seek(self,offset,whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            if self._size is None:
+                raise PatchError("can't squash patch: unknown file size")
+            offset += self._size
+        self._pos = offset
+
+    def slice(self,start,n):
+        """Get the segments describing n bytes from the given position."""
+        result = []
+        i = max(bisect.bisect_right(self._starts,start) - 1,0)
+        while n > 0 and i < len(self._starts):
+            seg = self.segments[i]
+            offset = start - self._starts[i]
+            size = _segment_size(seg)
+            if size is not None:
+                size -= offset
+                if size <= 0:
+                    i += 1
+                    continue
+            if size is None or size > n:
+                size = n
+            if isinstance(seg,bytes):
+                result.append(seg[offset:offset+size])
+            else:
+                (ref,s_start,_,diff) = seg
+                if diff is not None:
+                    diff = diff[offset:offset+size]
+                result.append((ref,s_start+offset,size,diff))
+            start += size
+            n -= size
+            i += 1
+        return result
+
+    def read_segments(self,n):
+        result = self.slice(self._pos,n)
+        self._pos += sum(_segment_size(seg) for seg in result)
+        return result
+
+    def read_rest(self):
+        """Get the segments describing the data from here to the end."""
+        if self._size is not None:
+            return self.read_segments(max(self._size - self._pos,0))
+        #  Only the last segment can have an unknown size.
+        start = self._starts[-1]
+        result = []
+        if self._pos < start:
+            result = self.slice(self._pos,start - self._pos)
+        (ref,s_start,_,diff) = self.segments[-1]
+        offset = max(self._pos - start,0)
+        result.append((ref,s_start+offset,None,diff))
+        self._pos = max(self._pos,start)
+        return result
+
+    def close(self):
+        pass
+
+
+class _SegmentWriter(object):
+    """Stand-in for the target file being patched, when squashing."""
+
+    def __init__(self):
+        self.segments = []
+
+    def write(self,data):
+        self.segments.append(data)
+
+    def write_segments(self,segments):
+        self.segments.extend(segments)
+
+    def close(self):
+        pass
+
+
+class Squasher(Patcher):
+    """Class combining several patches into one.
+
+    This interprets the commands of each patch in turn, but rather than
+    applying them to the filesystem it builds up a virtual description
+    of the changes made to the tree.  Files are described in terms of the
+    ranges of the original source files that they contain, so no source
+    or intermediate trees are needed.  Once all the patches have been added,
+    call write_patch() to write out a single patch that makes the same
+    changes, with each file written only once.
+    """
+
+    def __init__(self):
+        root = os.path.join(os.path.abspath(os.sep),"esky-squash")
+        super(Squasher,self).__init__(root,BytesIO())
+        self.version = 2
+        self._tree = self._root_tree = _VTree()
+        self._new_mode = None
+        self._changes = 0
+        self._verifies = []
+        #  Whether commands that need the version of the patches were used.
+        self._new_commands = False
+
+    def add_patch(self,stream):
+        """Add the patch in the given file-like object."""
+        self.commands = _CommandReader(stream)
+        header = self._read(len(PATCH_HEADER))
+        if header != PATCH_HEADER:
+            raise PatchError("not an esky patch file [%s]" % (header,))
+        version = self._read_int()
+        if version > HIGHEST_VERSION:
+            raise PatchError("esky patch version %d not supported"%(version,))
+        self.version = max(self.version,version)
+        self._sections = None
+        if version >= 7:
+            _read_hash(self.commands)
+        if version >= 6:
+            self._sections = _read_sections(self.commands)
+        self._solid = None
+        self._context_stack = []
+        self.target = self.root_dir
+        #  Only digests checked at the end of the final patch remain valid.
+        self._verifies = []
+        self._process_commands()
+
+    def write_patch(self,stream):
+        """Write out a single patch making all the changes added so far."""
+        #  A table of contents needs digests of the source and target files,
+        #  which we don't have.  The newest version without one is used,
+        #  unless the patch needs the VERIFY command or commands added after
+        #  it; in that case an empty table of contents is written.
+        verifies = [(key,hash_name,digest)
+                    for (key,hash_name,digest,changes) in self._verifies
+                    if changes == self._changes]
+        hash_names = [nm for (_,nm,_) in verifies if nm is not None]
+        if hash_names or self._new_commands:
+            version = self.version
+        else:
+            version = min(self.version,5)
+        writer = _SquashWriter(stream,version)
+        stream.write(PATCH_HEADER)
+        _write_vint(stream,version)
+        if version >= 7:
+            _write_vint(stream,_hash_id((hash_names + ["md5"])[0]))
+        if version >= 6:
+            _write_sections(stream,[])
+        writer.write_tree(self._root_tree)
+        for (key,hash_name,digest) in verifies:
+            writer.set_path(key)
+            if hash_name is None:
+                writer.command(VERIFY_MD5)
+            else:
+                writer.command(VERIFY)
+                _write_vint(stream,_hash_id(hash_name))
+            stream.write(digest)
+
+    def _key(self,path=None):
+        """Get the virtual tree key for the given path."""
+        if path is None:
+            path = self.target
+        path = os.path.relpath(path,self.root_dir)
+        if path == os.curdir:
+            return ()
+        return tuple(path.split(os.sep))
+
+    def _set(self,key,node,keep_children=False):
+        self._tree.set(key,node,keep_children)
+        self._changes += 1
+
+    def _save_state(self):
+        return (super(Squasher,self)._save_state(),self._tree)
+
+    def _restore_state(self,state):
+        super(Squasher,self)._restore_state(state[0])
+        self._tree = state[1]
+
+    def _cleanup_patch(self):
+        pass
+
+    def _section_is_done(self,i,section,path):
+        return False
+
+    def _check_begin_patch(self):
+        if self.outfile is None:
+            node = self._tree.get(self._key())
+            if isinstance(node,_VOrig):
+                segments = [(node.ref,0,None,None)]
+                self._new_mode = (node.mode,node.ref)
+            elif isinstance(node,_VFile):
+                segments = node.segments
+                self._new_mode = (node.mode,node.mode_origin)
+            elif isinstance(node,_VZip):
+                err = "can't squash patch: %s is patched as both a zipfile"\
+                      " and a plain file" % (self.target,)
+                raise PatchError(err)
+            elif isinstance(node,_VFilter):
+                err = "can't squash patch: %s is patched both with and"\
+                      " without filtering" % (self.target,)
+                raise PatchError(err)
+            else:
+                segments = []
+                self._new_mode = (None,None)
+            self.infile = _SegmentReader(segments)
+            self.outfile = _SegmentWriter()
+
+    def _check_end_patch(self):
+        if self.outfile is not None:
+            segments = _normalize_segments(self.outfile.segments)
+            (mode,mode_origin) = self._new_mode
+            self._set(self._key(),_VFile(segments,mode,mode_origin))
+            self.infile = None
+            self.outfile = None
+
+    def _do_VERIFY_MD5(self):
+        self._check_end_patch()
+        digest = self._read(16)
+        if self._tree is self._root_tree:
+            self._verifies.append((self._key(),None,digest,self._changes))
+
+    def _do_VERIFY(self):
+        self._check_end_patch()
+        hash_name = _read_hash(self.commands)
+        digest = self._read(get_hash(hash_name)().digest_size)
+        if self._tree is self._root_tree:
+            self._verifies.append((self._key(),hash_name,digest,self._changes))
+
+    def _do_MAKEDIR(self):
+        self._check_end_patch()
+        key = self._key()
+        for i in xrange(len(key)):
+            node = self._tree.get(key[:i])
+            if not isinstance(node,(_VOrig,_VDir)):
+                self._set(key[:i],_VDir(),keep_children=True)
+        self._set(key,_VDir())
+
+    def _do_REMOVE(self):
+        self._check_end_patch()
+        self._set(self._key(),None)
+
+    def _copy_from(self,source_path,move=False):
+        self._check_path(source_path)
+        source = self._key(source_path)
+        target = self._key()
+        if source != target:
+            if self._tree.get(source) is None:
+                raise PatchError("can't copy missing item %s" % (source_path,))
+            self._tree.copy_entry(source,target)
+            if move:
+                self._tree.set(source,None)
+            self._changes += 1
+
+    def _do_COPY_FROM(self):
+        self._check_end_patch()
+        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
+        self._copy_from(source_path)
+
+    def _do_COPY_FROM_ROOT(self):
+        self._check_end_patch()
+        source_path = self._read_path().replace("/",os.sep)
+        source_path = os.path.normpath(os.path.join(self.root_dir,source_path))
+        self._copy_from(source_path)
+
+    def _do_MOVE_FROM(self):
+        self._check_end_patch()
+        source_path = os.path.join(os.path.dirname(self.target),self._read_path())
+        self._copy_from(source_path,move=True)
+
+    def _do_CHMOD(self):
+        self._check_end_patch()
+        mode = self._read_int()
+        key = self._key()
+        node = self._tree.get(key)
+        if isinstance(node,_VOrig):
+            node = _VOrig(node.ref,mode)
+        elif isinstance(node,_VDir):
+            node = _VDir(mode)
+        elif isinstance(node,_VFile):
+            node = _VFile(node.segments,mode)
+        elif isinstance(node,_VZip):
+            node = _VZip(node.base,node.tree,mode)
+        elif isinstance(node,_VFilter):
+            node = _VFilter(node.base,node.filter,node.tree,mode)
+        else:
+            raise PatchError("can't chmod missing item %s" % (self.target,))
+        self._set(key,node,keep_children=True)
+
+    def _do_PF_COPY(self):
+        self._check_begin_patch()
+        n = self._read_int()
+        self.outfile.write_segments(self.infile.read_segments(n))
+
+    def _do_PF_SKIP(self):
+        self._check_begin_patch()
+        n = self._read_int()
+        self.infile.seek(n,os.SEEK_CUR)
+
+    def _do_PF_SET_HEADER(self):
+        self._check_begin_patch()
+        header = self._read_bytes()
+        self.infile.seek(len(header),os.SEEK_CUR)
+        self.outfile.write(header)
+        self.outfile.write_segments(self.infile.read_rest())
+        self._new_commands = True
+
+    def _do_PF_BSDIFF4(self):
+        self._check_begin_patch()
+        n = self._read_int()
+        patch = "BSDIFF40".encode("ascii") + self._read_bytes()
+        self._squash_bsdiff4(n,patch,_BZ2Reader)
+
+    def _do_PF_BSDIFF4_LZMA(self):
+        self._check_begin_patch()
+        n = self._read_int()
+        patch = "BSDIFF40".encode("ascii") + self._read_bytes()
+        self._squash_bsdiff4(n,patch,_LZMAReader)
+
+    def _squash_bsdiff4(self,n,patch,reader):
+        """Describe the result of a bsdiff4 patch in terms of segments.
+
+        This follows the same steps as bsdiff4_py.patch_stream, but adds
+        the diff bytes to segments of the source rather than its data.
+        """
+        l_bcontrol = _decode_offt(patch[8:16])
+        l_bdiff = _decode_offt(patch[16:24])
+        e_bcontrol = 32 + l_bcontrol
+        e_bdiff = e_bcontrol + l_bdiff
+        bcontrol = reader(patch,32,e_bcontrol)
+        bdiff = reader(patch,e_bcontrol,e_bdiff)
+        bextra = reader(patch,e_bdiff,len(patch))
+        s_base = self.infile.tell()
+        s_pos = 0
+        ctrl = bcontrol.read(24)
+        while ctrl:
+            if len(ctrl) != 24:
+                raise PatchError("corrupted bsdiff4 patch")
+            x = _decode_offt(ctrl[0:8])
+            y = _decode_offt(ctrl[8:16])
+            z = _decode_offt(ctrl[16:24])
+            if x < 0 or y < 0 or s_pos < 0 or s_pos + x > n:
+                raise PatchError("corrupted bsdiff4 patch")
+            if x:
+                segments = self.infile.slice(s_base + s_pos,x)
+                diff = bdiff.read(x)
+                self.outfile.write_segments(_add_segment_diff(segments,diff))
+                s_pos += x
+            if y:
+                extra = bextra.read(y)
+                if len(extra) != y:
+                    raise PatchError("corrupted bsdiff4 patch")
+                self.outfile.write(extra)
+            s_pos += z
+            ctrl = bcontrol.read(24)
+        self.infile.seek(s_base + n)
+
+    def _do_PF_REC_ZIP(self):
+        self._squash_zipfile()
+
+    def _do_PF_REC_ZIP_RAW(self):
+        #  Members are extracted as needed when the squashed patch is applied.
+        n = self._read_int()
+        for _ in xrange(n):
+            self._read_bytes()
+        self._squash_zipfile()
+
+    def _squash_zipfile(self):
+        """Recurse into the current target as a zipfile.
+
+        The extracted contents of the zipfile are described by a virtual
+        tree of their own, layed out just like the working directory used
+        by Patcher._patch_zipfile.
+        """
+        if self.outfile is not None:
+            err = "can't squash patch: %s is patched as both a zipfile"\
+                  " and a plain file" % (self.target,)
+            raise PatchError(err)
+        key = self._key()
+        node = self._tree.get(key)
+        if isinstance(node,_VZip):
+            base = node.base
+            tree = node.tree.copy()
+            mode = node.mode
+        elif isinstance(node,(_VOrig,_VFile)):
+            base = node
+            tree = _VTree()
+            mode = node.mode
+        else:
+            raise PatchError("can't patch missing zipfile %s" % (self.target,))
+        workdir = self._context_workdir()
+        cur_state = self._blank_state()
+        def end_metadata():
+            self.target = os.path.join(workdir,"contents")
+        def end_contents():
+            self._restore_state(cur_state)
+            self._set(key,_VZip(base,tree,mode))
+        self._context_stack.append(end_contents)
+        self._context_stack.append(end_metadata)
+        self._tree = tree
+        self.root_dir = workdir
+        self.target = os.path.join(workdir,"meta")
+
+    def _do_PF_BCJ_X86(self):
+        self._squash_filter((PF_BCJ_X86,))
+
+    def _do_PF_REPLACE(self):
+        old = self._read_bytes()
+        new = self._read_bytes()
+        self._squash_filter((PF_REPLACE,old,new))
+
+    def _squash_filter(self,filter):
+        """Recurse into the filtered contents of the current target.
+
+        These are described by a virtual tree of their own, containing the
+        single file used by Patcher._begin_filter.  Since decoding and then
+        encoding x86 code gives back the same data, later patches that also
+        filter it that way just keep patching that tree.  Otherwise, the
+        filter is applied on top of the file as patched so far.
+        """
+        if self.outfile is not None:
+            err = "can't squash patch: %s is patched both with and"\
+                  " without filtering" % (self.target,)
+            raise PatchError(err)
+        key = self._key()
+        node = self._tree.get(key)
+        if isinstance(node,_VFilter) and node.filter == filter == (PF_BCJ_X86,):
+            base = node.base
+            tree = node.tree.copy()
+            mode = node.mode
+        elif isinstance(node,(_VOrig,_VFile,_VFilter)):
+            base = node
+            tree = _VTree()
+            mode = node.mode
+        elif node is None:
+            base = _VFile([])
+            tree = _VTree()
+            mode = None
+        else:
+            raise PatchError("can't squash patch: %s is not a file"
+                             % (self.target,))
+        self._new_commands = True
+        workdir = self._context_workdir()
+        cur_state = self._blank_state()
+        def end_filter():
+            self._restore_state(cur_state)
+            self._set(key,_VFilter(base,filter,tree,mode))
+        self._context_stack.append(end_filter)
+        self._tree = tree
+        self.root_dir = workdir
+        self.target = os.path.join(workdir,"data")
+
+
+class _SquashWriter(object):
+    """Writes out the changes described by a virtual tree, as patch commands.
+
+    Base entries that are needed at some other place in the tree are first
+    copied into a scratch directory, so that they're available no matter
+    what else has been changed.  Each changed entry is then written in turn,
+    parents before children.
+    """
+
+    def __init__(self,stream,version):
+        self.stream = stream
+        self.version = version
+
+    def command(self,cmd):
+        _write_vint(self.stream,cmd)
+
+    def int(self,i):
+        _write_vint(self.stream,i)
+
+    def bytes(self,data):
+        _write_vint(self.stream,len(data))
+        self.stream.write(data)
+
+    def path(self,key):
+        self.bytes(u"/".join(key).encode("utf8"))
+
+    def set_path(self,key):
+        self.command(SET_PATH)
+        self.path(key)
+
+    def write_tree(self,tree,prefix=()):
+        """Write commands to make the changes in the given virtual tree.
+
+        If a prefix is given, only changes at or below that path are made.
+        """
+        n = len(prefix)
+        nodes = sorted((k,v) for (k,v) in tree.nodes.iteritems()
+                              if k[:n] == prefix)
+        #  Work out which base entries are needed where, and stash away
+        #  any that aren't already in place.
+        stash = {}
+        for (key,node) in nodes:
+            ref = self._base_ref(node)
+            if ref is not None and ref != tree.base_ref(key):
+                if ref not in stash:
+                    stash[ref] = (_SQUASH_STASH,str(len(stash)))
+        if stash:
+            self.set_path((_SQUASH_STASH,))
+            self.command(MAKEDIR)
+            for (ref,s_key) in sorted(stash.iteritems(),key=lambda i: i[1]):
+                self.set_path(s_key)
+                self.command(COPY_FROM_ROOT)
+                self.path(ref)
+        #  Now make the changes, parents first.  Entries below anything
+        #  that's been removed or replaced don't need removing themselves.
+        for (key,node) in nodes:
+            if node is None:
+                if tree.base_ref(key) is not None:
+                    self.set_path(key)
+                    self.command(REMOVE)
+                continue
+            if isinstance(node,_VOrig) and node.mode is None:
+                if node.ref == tree.base_ref(key):
+                    continue
+            self.set_path(key)
+            if isinstance(node,_VDir):
+                self.command(MAKEDIR)
+            else:
+                self._write_file(tree,key,node,stash)
+            if node.mode is not None:
+                self.command(CHMOD)
+                self.int(node.mode)
+        if stash:
+            self.set_path((_SQUASH_STASH,))
+            self.command(REMOVE)
+
+    def _base_ref(self,node):
+        """Get the path of the base entry needed to create the given entry."""
+        if isinstance(node,_VOrig):
+            return node.ref
+        if isinstance(node,(_VZip,_VFilter)):
+            return self._base_ref(node.base)
+        if isinstance(node,_VFile):
+            refs = set(seg[0] for seg in node.segments
+                              if not isinstance(seg,bytes))
+            if not refs and node.mode is None and node.mode_origin is not None:
+                refs.add(node.mode_origin)
+            if len(refs) > 1:
+                raise PatchError("can't squash patch: multiple sources")
+            if refs:
+                return refs.pop()
+        return None
+
+    def _write_base(self,tree,key,ref,stash):
+        """Write commands to put a base entry at the current path.
+
+        If there's no base entry then anything at the current path is
+        removed, so that new files don't pick up the mode of old ones.
+        """
+        base_ref = tree.base_ref(key)
+        if ref is None:
+            if base_ref is not None:
+                self.command(REMOVE)
+        elif ref != base_ref:
+            self.command(COPY_FROM_ROOT)
+            self.path(stash[ref])
+
+    def _write_file(self,tree,key,node,stash):
+        """Write commands to create the given entry at the current path."""
+        if isinstance(node,_VZip):
+            self._write_file(tree,key,node.base,stash)
+            #  Finish writing the base file before recursing into it.
+            self.set_path(key)
+            self._write_zipfile(node.tree)
+            return
+        if isinstance(node,_VFilter):
+            self._write_file(tree,key,node.base,stash)
+            self.set_path(key)
+            self.command(node.filter[0])
+            for arg in node.filter[1:]:
+                self.bytes(arg)
+            self.write_tree(node.tree,("data",))
+            self.command(END)
+            return
+        ref = self._base_ref(node)
+        self._write_base(tree,key,ref,stash)
+        if isinstance(node,_VOrig):
+            return
+        segments = node.segments
+        if segments == [(ref,0,None,None)]:
+            return
+        if not segments:
+            self.command(PF_INS_RAW)
+            self.bytes(b"")
+        elif len(segments) == 2 and isinstance(segments[0],bytes) and \
+             segments[1] == (ref,len(segments[0]),None,None):
+            self.command(PF_SET_HEADER)
+            self.bytes(segments[0])
+        elif not self._write_linear_segments(segments):
+            self._write_bsdiff4_segments(segments)
+
+    def _write_linear_segments(self,segments):
+        """Write segments using PF_COPY/PF_SKIP/PF_INS_* commands.
+
+        This is only possible if the segments take data from the source in
+        order, without modifying it.  If not, False is returned and nothing
+        is written.
+        """
+        pos = 0
+        for seg in segments:
+            if not isinstance(seg,bytes):
+                (_,start,length,diff) = seg
+                if diff is not None or length is None or start < pos:
+                    return False
+                pos = start + length
+        pos = 0
+        for seg in segments:
+            if isinstance(seg,bytes):
+                (cmd,cdata) = _compress_payload(seg,self.version)
+                self.command(cmd)
+                self.bytes(cdata)
+            else:
+                (_,start,length,_) = seg
+                if start > pos:
+                    self.command(PF_SKIP)
+                    self.int(start - pos)
+                self.command(PF_COPY)
+                self.int(length)
+                pos = start + length
+        return True
+
+    def _write_bsdiff4_segments(self,segments):
+        """Write segments as a single bsdiff4 patch of the source file."""
+        control = []
+        diff = []
+        extra = []
+        s_pos = 0
+        s_end = 0
+        cur = None
+        for seg in segments:
+            if isinstance(seg,bytes):
+                if cur is None:
+                    cur = [0,0]
+                cur[1] += len(seg)
+                extra.append(seg)
+            else:
+                (_,start,length,s_diff) = seg
+                if length is None:
+                    raise PatchError("can't squash patch: unknown file size")
+                if cur is not None:
+                    control.append((cur[0],cur[1],start - s_pos))
+                elif start != s_pos:
+                    control.append((0,0,start - s_pos))
+                cur = [length,0]
+                if s_diff is None:
+                    s_diff = b"\x00" * length
+                diff.append(s_diff)
+                s_pos = start + length
+                s_end = max(s_end,s_pos)
+        control.append((cur[0],cur[1],0))
+        bcontrol = b"".join(_encode_offt(x) for c in control for x in c)
+        blocks = (bcontrol,b"".join(diff),b"".join(extra))
+        l_target = sum(len(seg) if isinstance(seg,bytes) else seg[2]
+                       for seg in segments)
+        options = [(PF_BSDIFF4,_bsdiff4_pack(blocks,l_target,bz2.compress))]
+        if lzma is not None and PF_BSDIFF4_LZMA in _file_patch_commands(self.version):
+            options.append((PF_BSDIFF4_LZMA,
+                            _bsdiff4_pack(blocks,l_target,_lzma_compress)))
+        (cmd,patch) = min(options,key=lambda o: len(o[1]))
+        self.command(cmd)
+        self.int(s_end)
+        self.bytes(patch)
+
+    def _write_zipfile(self,tree):
+        """Write commands to patch the current file as a zipfile."""
+        members = self._zipfile_members(tree)
+        if members is None:
+            self.command(PF_REC_ZIP)
+        else:
+            self.command(PF_REC_ZIP_RAW)
+            self.int(len(members))
+            for name in sorted(members):
+                self.bytes(name)
+        self.write_tree(tree,("meta",))
+        self.command(END)
+        self.write_tree(tree,("contents",))
+        self.command(END)
+
+    def _zipfile_members(self,tree):
+        """Get the names of zipfile members that must be extracted.
+
+        This returns None if the whole zipfile must be extracted, either
+        because the patch version is too old to do anything else or because
+        the changes need directories from the original zipfile.
+        """
+        if self.version < 5:
+            return None
+        members = set()
+        for (key,node) in tree.nodes.iteritems():
+            if isinstance(node,_VOrig):
+                if node.ref != tree.base_ref(key) or node.mode is not None:
+                    return None
+            elif isinstance(node,(_VFile,_VZip,_VFilter)):
+                ref = self._base_ref(node)
+                if ref is not None and ref[:1] == ("contents",):
+                    members.add(u"/".join(ref[1:]).encode("utf8"))
+        return members
+
 
 class Differ(object):
     """Class generating our patch protocol.
@@ -917,16 +3716,92 @@ class Differ(object):
     commands to transform one file/directory into another.
     """
 
-    def __init__(self,outfile,diff_window_size=None):
+    def __init__(self,outfile,diff_window_size=None,jobs=None,chunked=False,
+                 version=None,exhaustive=False,verify_files=False,
+                 hash_name=None,filter_executables=True,diff_bytecode=True):
         if not diff_window_size:
             diff_window_size = DIFF_WINDOW_SIZE
         self.diff_window_size = diff_window_size
+        self.chunked = chunked
+        self.exhaustive = exhaustive
+        #  Verify each changed file as it's patched, rather than only
+        #  verifying the whole tree at the end.
+        self.verify_files = verify_files
+        #  Diff x86 executables with their branch targets made absolute.
+        self.filter_executables = filter_executables
+        #  Diff .pyc files allowing for changes to their header and filename.
+        self.diff_bytecode = diff_bytecode
+        self.shortcut_stats = {}
+        #  Generate patches for the given protocol version.  Features from
+        #  later versions are only used if this allows them.
+        if not version:
+            version = HIGHEST_VERSION
+        if version > HIGHEST_VERSION:
+            raise DiffError("esky patch version %d not supported"%(version,))
+        self.version = version
+        #  Digests are calculated using the given hash algorithm, which can
+        #  only be chosen from version 7.
+        if not hash_name:
+            hash_name = "md5"
+        if hash_name != "md5" and version < 7:
+            raise DiffError("hash %s needs patch version 7" % (hash_name,))
+        try:
+            self._hash = get_hash(hash_name)
+        except ValueError, e:
+            raise DiffError(str(e))
+        self.hash_name = hash_name
+        self._moved_files = {}
+        self._source_root = None
+        self._target_root = None
+        self._written_files = {}
+        self._tree = _TreeSnapshot(self._hash)
+        if not jobs:
+            jobs = 1
+        self.jobs = jobs
         self.outfile = outfile
         self._pending_pop_path = 0
+        self._sequencer = None
+        self._solid = None
+        self._sections = None
 
     def _write(self,data):
         self.outfile.write(data)
 
+    def _write_pending_pop_path(self):
+        """Write out any POP_PATH commands that are being held back."""
+        for _ in xrange(self._pending_pop_path):
+            _write_vint(self.outfile,POP_PATH)
+        self._pending_pop_path = 0
+
+    def _write_call(self,func,*args):
+        """Write the data returned by func(*args) to the stream.
+
+        When diffing in parallel, the call is deferred until all previously
+        submitted diff jobs have been written out.  This lets func depend on
+        state that is updated as those jobs complete.
+        """
+        self._write_pending_pop_path()
+        if self._sequencer is None:
+            self._write(func(*args))
+        else:
+            self._sequencer.add_call(func,*args)
+
+    def _write_job(self,func,args,callback):
+        """Write the data produced by a diff job to the stream.
+
+        The function func must return a tuple (result,data); the data
+        is written to the stream and then callback(result) is called.
+        When diffing in parallel, the job is run in a worker process and
+        its data written out in order once it completes.
+        """
+        self._write_pending_pop_path()
+        if self._sequencer is None:
+            (result,data) = func(*args)
+            self._write(data)
+            callback(result)
+        else:
+            self._sequencer.add_job(func,args,callback)
+
     def _write_int(self,i):
         _write_vint(self.outfile,i)
 
@@ -974,13 +3849,171 @@ class Differ(object):
         """
         source = os.path.abspath(source)
         target = os.path.abspath(target)
-        self._write(PATCH_HEADER)
-        self._write_int(HIGHEST_VERSION)
-        self._diff(source,target)
-        self._write_command(SET_PATH)
-        self._write_bytes("".encode("ascii"))
-        self._write_command(VERIFY_MD5)
-        self._write(calculate_patch_digest(target,hashlib.md5))
+        outfile = self.outfile
+        body = None
+        pool = None
+        if self.version >= 6:
+            #  The table of contents comes before the patch commands, so
+            #  they must be held back until all sections are known.
+            body = tempfile.TemporaryFile()
+            self._sections = []
+            self.outfile = body
+        if self.version >= 4:
+            self._solid = _SolidWriter(self.outfile,self.version)
+            self.outfile = self._solid
+        if self.jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.jobs)
+            self._sequencer = _DiffSequencer(self.outfile,pool,self.jobs*4)
+            self.outfile = self._sequencer
+        try:
+            if body is None:
+                self._write(PATCH_HEADER)
+                self._write_int(self.version)
+            if self.version >= 2:
+                if self._tree.isdir(source) and self._tree.isdir(target):
+                    self._copy_moved_files(source,target)
+                if self._tree.isdir(target):
+                    self._source_root = source
+                    self._target_root = target
+            self._diff(source,target)
+            self._write_command(SET_PATH)
+            self._write_bytes("".encode("ascii"))
+            self._write_verify(calculate_patch_digest(target,self._hash))
+            if self._sequencer is not None:
+                self._sequencer.flush(0)
+            if self._solid is not None:
+                self._solid.flush()
+            if body is not None:
+                outfile.write(PATCH_HEADER)
+                _write_vint(outfile,self.version)
+                if self.version >= 7:
+                    _write_vint(outfile,_hash_id(self.hash_name))
+                for (section,span) in zip(self._sections,self._solid.sections):
+                    (section.offset,end,section.solid_size) = span
+                    section.length = end - section.offset
+                _write_sections(outfile,self._sections)
+                body.seek(0)
+                shutil.copyfileobj(body,outfile)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if body is not None:
+                body.close()
+            self.outfile = outfile
+            self._sequencer = None
+            self._solid = None
+            self._sections = None
+            self._source_root = None
+            self._target_root = None
+            self._written_files.clear()
+            self._tree = _TreeSnapshot(self._hash)
+
+    def _copy_moved_files(self,source,target):
+        """Generate commands to copy moved files into place.
+
+        This finds new files in the target tree whose contents can be found
+        somewhere in the source tree (either exactly, or something close to
+        it) and copies them into place using COPY_FROM_ROOT.  The main diff
+        can then diff against the original file rather than sending the
+        whole thing.
+
+        This is done before anything else so that the copies are taken from
+        the unmodified source files.  We only consider files whose parent
+        directory exists in the source, since anything else will be created
+        from scratch by a MAKEDIR command.
+        """
+        index = _FileIndex(self._tree,source,target)
+        moved = []
+        for (dirpath,dirnames,filenames) in self._tree.walk(target):
+            s_dirpath = os.path.join(source,os.path.relpath(dirpath,target))
+            dirnames[:] = [nm for nm in dirnames
+                           if self._tree.isdir(os.path.join(s_dirpath,nm))]
+            for nm in filenames:
+                if self._tree.exists(os.path.join(s_dirpath,nm)):
+                    continue
+                t_nm = os.path.join(dirpath,nm)
+                s_nm = index.find_source(t_nm)
+                if s_nm is not None:
+                    moved.append((t_nm,s_nm))
+        for (t_nm,s_nm) in moved:
+            self._moved_files[t_nm] = s_nm
+            self._write_command(SET_PATH)
+            self._write_path(_relpath(t_nm,target))
+            self._write_command(COPY_FROM_ROOT)
+            self._write_path(_relpath(s_nm,source))
+        if moved:
+            self._write_command(SET_PATH)
+            self._write_path("")
+
+    def _find_written_file(self,path):
+        """Find an identical file that has already been written by the patch.
+
+        When the same new file appears in several places in the target
+        tree, we only need to generate it once; the other copies can then
+        be copied from it with COPY_FROM_ROOT.  This only works for files
+        in the top-level target tree, not inside zipfiles, since that is
+        the root directory against which COPY_FROM_ROOT paths are resolved.
+        """
+        if not self._is_in_target_root(path):
+            return None
+        candidates = self._written_files.get(self._tree.size(path))
+        if not candidates:
+            return None
+        digest = self._tree.digest(path)
+        for w_path in candidates:
+            if self._tree.digest(w_path) == digest:
+                return w_path
+        return None
+
+    def _add_written_file(self,path):
+        """Note that the patch has written the given file into place."""
+        if not self._is_in_target_root(path):
+            return
+        size = self._tree.size(path)
+        if size >= _FileIndex.MIN_SIZE:
+            self._written_files.setdefault(size,[]).append(path)
+
+    def _write_verify(self,digest):
+        """Write a command to verify the current target against a digest."""
+        if self.version >= 7:
+            self._write_command(VERIFY)
+            self._write_int(_hash_id(self.hash_name))
+        else:
+            self._write_command(VERIFY_MD5)
+        self._write(digest)
+
+    def _begin_section(self,target):
+        """Begin a section of the patch for the given target file.
+
+        Files in the top-level target tree are each patched by their own
+        section, listed in the table of contents along with the digests of
+        the target file and of the source file at the same path.  This
+        writes the SECTION command and returns the index of the new section,
+        or None if the target doesn't get a section.
+        """
+        if self._sections is None or not self._is_in_target_root(target):
+            return None
+        path = _relpath(target,self._target_root)
+        source = os.path.join(self._source_root,path.replace("/",os.sep))
+        if self._tree.isfile(source):
+            s_digest = self._tree.digest(source)
+        else:
+            s_digest = b""
+        i = len(self._sections)
+        self._sections.append(PatchSection(path,None,None,None,s_digest,
+                                           self._tree.digest(target),
+                                           self._tree.mode(target)))
+        self._write_call(self._solid.begin_section,i)
+        self._write_command(SECTION)
+        self._write_int(i)
+        return i
+
+    def _is_in_target_root(self,path):
+        if self._target_root is None or not self._tree.isfile(path):
+            return False
+        return path.startswith(self._target_root + os.sep)
 
     def _diff(self,source,target):
         """Recursively generate patch commands to transform source into target.
@@ -989,9 +4022,9 @@ class Differ(object):
         generates the patch commands for a given (source,target) pair.  The
         main diff() method adds some header and footer commands.
         """
-        if os.path.isdir(target):
+        if self._tree.isdir(target):
             self._diff_dir(source,target)
-        elif os.path.isfile(target):
+        elif self._tree.isfile(target):
             self._diff_file(source,target)
         else:
             #  We can't deal with any other objects for the moment.
@@ -1001,16 +4034,18 @@ class Differ(object):
     def _diff_dir(self,source,target):
         """Generate patch commands for when the target is a directory."""
         #  If it's not already a directoy, make it one.
-        if not os.path.isdir(source):
+        if not self._tree.isdir(source):
             self._write_command(MAKEDIR)
         #  For each new item try to find a sibling to copy/move from.
         #  This might generate a few spurious COPY_FROM and REMOVE commands,
         #  but in return we get a better chance of diffing against something.
         nm_sibnm_map = {}
         sibnm_nm_map = {}
-        for nm in os.listdir(target):
+        for nm in self._tree.listdir(target):
             s_nm = os.path.join(source,nm)
-            if not os.path.exists(s_nm):
+            if not self._tree.exists(s_nm):
+                if os.path.join(target,nm) in self._moved_files:
+                    continue
                 sibnm = self._find_similar_sibling(source,target,nm)
                 if sibnm:
                     nm_sibnm_map[nm] = sibnm
@@ -1025,7 +4060,7 @@ class Differ(object):
             s_nm = os.path.join(source,sibnm)
             self._write_command(JOIN_PATH)
             self._write_path(nm)
-            if os.path.exists(os.path.join(target,sibnm)):
+            if self._tree.exists(os.path.join(target,sibnm)):
                 self._write_command(COPY_FROM)
             elif len(sibnm_nm_map[sibnm]) > 1:
                 self._write_command(COPY_FROM)
@@ -1035,44 +4070,68 @@ class Differ(object):
             sibnm_nm_map[sibnm].remove(nm)
             self._write_command(POP_PATH)
         # Every target item now has a source. Diff against it.
-        for nm in os.listdir(target):
+        for nm in self._tree.listdir(target):
+            t_nm = os.path.join(target,nm)
             try:
                 s_nm = os.path.join(source,nm_sibnm_map[nm])
             except KeyError:
-                s_nm = os.path.join(source,nm)
-            t_nm = os.path.join(target,nm)
-            #  Recursively diff against the selected source.
-            if paths_differ(s_nm,t_nm):
-                self._write_command(JOIN_PATH)
-                self._write_path(nm)
-                self._diff(s_nm,t_nm)
-                self._write_command(POP_PATH)
+                s_nm = self._moved_files.get(t_nm,os.path.join(source,nm))
+            #  Recursively diff against the selected source, unless we've
+            #  already written out a file with identical contents.
+            if self._tree.differs(s_nm,t_nm):
+                section = self._begin_section(t_nm)
+                if section is None:
+                    self._write_command(JOIN_PATH)
+                    self._write_path(nm)
+                verify = self.verify_files and self._is_in_target_root(t_nm)
+                w_nm = self._find_written_file(t_nm)
+                #  Sections have their source digest in the table of contents.
+                if verify and section is None and w_nm is None:
+                    if self._tree.isfile(s_nm):
+                        self._write_verify(self._tree.digest(s_nm))
+                if w_nm is not None:
+                    self._write_command(COPY_FROM_ROOT)
+                    self._write_path(_relpath(w_nm,self._target_root))
+                    t_mod = self._tree.mode(t_nm)
+                    if self._tree.mode(w_nm) != t_mod:
+                        self._write_command(CHMOD)
+                        self._write_int(t_mod)
+                else:
+                    self._diff(s_nm,t_nm)
+                    self._add_written_file(t_nm)
+                if verify:
+                    self._write_verify(self._tree.digest(t_nm))
+                if section is None:
+                    self._write_command(POP_PATH)
+                else:
+                    self._write_command(END)
+                    self._write_call(self._solid.end_section,section)
             #  Clean up .pyc files, as they can be generated automatically
             #  and cause digest verification to fail.
             if nm.endswith(".py"):
-                if not os.path.exists(t_nm+"c"):
+                if not self._tree.exists(t_nm+"c"):
                     self._write_command(JOIN_PATH)
                     self._write_path(nm+"c")
                     self._write_command(REMOVE)
                     self._write_command(POP_PATH)
-                if not os.path.exists(t_nm+"o"):
+                if not self._tree.exists(t_nm+"o"):
                     self._write_command(JOIN_PATH)
                     self._write_path(nm+"o")
                     self._write_command(REMOVE)
                     self._write_command(POP_PATH)
         #  Remove anything that's no longer in the target dir
-        if os.path.isdir(source):
-            for nm in os.listdir(source):
-                if not os.path.exists(os.path.join(target,nm)):
+        if self._tree.isdir(source):
+            for nm in self._tree.listdir(source):
+                if not self._tree.exists(os.path.join(target,nm)):
                     if nm not in sibnm_nm_map:
                         self._write_command(JOIN_PATH)
                         self._write_path(nm)
                         self._write_command(REMOVE)
                         self._write_command(POP_PATH)
         #  Adjust mode if necessary
-        t_mod = os.stat(target).st_mode
-        if os.path.isdir(source):
-            s_mod = os.stat(source).st_mode
+        t_mod = self._tree.mode(target)
+        if self._tree.isdir(source):
+            s_mod = self._tree.mode(source)
             if s_mod != t_mod:
                 self._write_command(CHMOD)
                 self._write_int(t_mod)
@@ -1082,17 +4141,17 @@ class Differ(object):
 
     def _diff_file(self,source,target):
         """Generate patch commands for when the target is a file."""
-        if paths_differ(source,target):
-            if not os.path.isfile(source):
+        if self._tree.differs(source,target):
+            if not self._tree.isfile(source):
                 self._diff_binary_file(source,target)
             elif target.endswith(".zip") and source.endswith(".zip"):
                 self._diff_dotzip_file(source,target)
             else:
                 self._diff_binary_file(source,target)
         #  Adjust mode if necessary
-        t_mod = os.stat(target).st_mode
-        if os.path.isfile(source):
-            s_mod = os.stat(source).st_mode
+        t_mod = self._tree.mode(target)
+        if self._tree.isfile(source):
+            s_mod = self._tree.mode(source)
             if s_mod != t_mod:
                 self._write_command(CHMOD)
                 self._write_int(t_mod)
@@ -1137,7 +4196,14 @@ class Differ(object):
                 self._diff_binary_file(source,target)
             else:
                 try:
-                    self._write_command(PF_REC_ZIP)
+                    if self.version >= 5:
+                        (s_names,t_names) = _changed_zip_members(s_zf,t_zf)
+                        self._write_command(PF_REC_ZIP_RAW)
+                        self._write_int(len(s_names))
+                        for nm in sorted(s_names):
+                            self._write_bytes(_zip_member_key(nm))
+                    else:
+                        self._write_command(PF_REC_ZIP)
                     with _tempdir() as workdir:
                         #  Write commands to transform source metadata file
                         #  into target metadata file.
@@ -1153,10 +4219,20 @@ class Differ(object):
                         #  directory into target contents directory.
                         s_workdir = os.path.join(workdir,"source")
                         t_workdir = os.path.join(workdir,"target")
-                        extract_zipfile(source,s_workdir)
-                        extract_zipfile(target,t_workdir)
+                        os.mkdir(s_workdir)
+                        os.mkdir(t_workdir)
+                        if self.version >= 5:
+                            _extract_zipfile_members(source,s_workdir,s_names)
+                            _extract_zipfile_members(target,t_workdir,t_names)
+                        else:
+                            #  PF_REC_ZIP extracts every member when patching,
+                            #  and some commands (e.g. removing stale .pyc
+                            #  files) depend on seeing the unchanged ones.
+                            extract_zipfile(source,s_workdir)
+                            extract_zipfile(target,t_workdir)
                         self._diff(s_workdir,t_workdir)
                         self._write_command(END)
+                        self._tree.forget(workdir)
                 finally:
                     t_zf.close() 
                     s_zf.close() 
@@ -1167,51 +4243,213 @@ class Differ(object):
 
         This is the per-file diffing method used when we don't know enough
         about the file to do anything fancier.  It's basically a windowed
-        bsdiff.
+        bsdiff.  In chunked mode, large files are first matched up using
+        content-defined chunking so that each window is diffed against the
+        corresponding part of the source file, wherever it has moved to.
         """
-        spos = 0
+        if self.filter_executables and self.version >= 8:
+            if self._tree.isfile(source) and _is_x86_executable(source):
+                if _is_x86_executable(target):
+                    self._diff_x86_file(source,target)
+                    return
+        if self.diff_bytecode and self.version >= 9:
+            if target.endswith((".pyc",".pyo")) and self._tree.isfile(source):
+                if self._diff_pyc_file(source,target):
+                    return
+        self._diff_file_data(source,target)
+
+    def _diff_pyc_file(self,source,target):
+        """Diff .pyc files, allowing for how rebuilding them changes them.
+
+        Every rebuild changes the mtime in the header, which is replaced
+        with PF_SET_HEADER if nothing else has changed.  Compiling from
+        another directory changes the filename in each code object, which
+        is replaced with a PF_REPLACE filter before diffing the rest.
+        Returns False if neither applies, and nothing has been written.
+        """
+        with open(source,"rb") as f:
+            sdata = f.read()
+        with open(target,"rb") as f:
+            tdata = f.read()
+        size = _pyc_header_size(tdata)
+        if size is None or len(sdata) < size or sdata[:4] != tdata[:4]:
+            return False
+        change = _pyc_filename_change(sdata,tdata,size)
+        if change is not None:
+            sdata = sdata.replace(*change)
+        same_code = (sdata[size:] == tdata[size:])
+        if change is None and not same_code:
+            return False
+        if change is not None:
+            self._write_command(PF_REPLACE)
+            self._write_bytes(change[0])
+            self._write_bytes(change[1])
+        if same_code:
+            self._write_command(PF_SET_HEADER)
+            self._write_bytes(tdata[:size])
+        else:
+            with _tempdir() as workdir:
+                s_temp = os.path.join(workdir,"source")
+                with open(s_temp,"wb") as f:
+                    f.write(sdata)
+                self._diff_file_data(s_temp,target)
+        if change is not None:
+            self._write_command(END)
+        return True
+
+    def _diff_x86_file(self,source,target):
+        """Diff x86 executables with their branch targets made absolute.
+
+        Recompiling code shifts the relative targets of calls and jumps
+        throughout the file, which bsdiff copes with badly.  The files are
+        run through _bcj_x86_copy and the results diffed instead.
+        """
+        self._write_command(PF_BCJ_X86)
+        with _tempdir() as workdir:
+            s_temp = os.path.join(workdir,"source")
+            t_temp = os.path.join(workdir,"target")
+            for (path,temp) in ((source,s_temp),(target,t_temp)):
+                with open(path,"rb") as f_in:
+                    with open(temp,"wb") as f_out:
+                        _bcj_x86_copy(f_in,f_out,True)
+            self._diff_file_data(s_temp,t_temp)
+        self._write_command(END)
+
+    def _diff_file_data(self,source,target):
+        """Diff the data of two files, without any filtering."""
+        spos = [0]  # mutable, so it can be updated by diff jobs
         with open(target,"rb") as tfile:
-            if os.path.isfile(source):
+            t_size = os.fstat(tfile.fileno()).st_size
+            if self._tree.isfile(source):
                 sfile = open(source,"rb")
+                s_size = os.fstat(sfile.fileno()).st_size
             else:
                 sfile = None
+                s_size = 0
             try:
-                #  Process the file in diff_window_size blocks.  This
-                #  will produce slightly bigger patches but we avoid
-                #  running out of memory for large files.
-                tdata = tfile.read(self.diff_window_size)
-                if not tdata:
+                if not t_size:
                     #  The file is empty, do a raw insert of zero bytes.
                     self._write_command(PF_INS_RAW)
                     self._write_bytes("".encode("ascii"))
+                elif sfile is None or not self.chunked:
+                    self._diff_file_range(sfile,tfile,spos,0,s_size,0,t_size)
+                elif t_size <= self.diff_window_size:
+                    self._diff_file_range(sfile,tfile,spos,0,s_size,0,t_size)
                 else:
-                    while tdata:
-                        sdata = b""
-                        if sfile is not None:
-                            sdata = sfile.read(self.diff_window_size)
-                        #  Look for a shared prefix.
-                        i = 0; maxi = min(len(tdata),len(sdata))
-                        while i < maxi and tdata[i] == sdata[i]:
-                            i += 1
-                        #  Copy it in directly, unless it's tiny.
-                        if i > 8:
-                            skipbytes = sfile.tell() - len(sdata) - spos
-                            if skipbytes > 0:
-                                self._write_command(PF_SKIP)
-                                self._write_int(skipbytes)
-                                spos += skipbytes
-                            self._write_command(PF_COPY)
-                            self._write_int(i)
-                            tdata = tdata[i:]; sdata = sdata[i:]
-                            spos += i
-                        #  Write the rest of the block as a diff
-                        if tdata:
-                            spos += self._write_file_patch(sdata,tdata)
-                        tdata = tfile.read(self.diff_window_size)
+                    self._diff_file_chunked(sfile,tfile,spos,s_size,t_size)
             finally:
                 if sfile is not None:
                     sfile.close()
 
+    def _diff_file_chunked(self,sfile,tfile,spos,s_size,t_size):
+        """Diff two files by matching up their content-defined chunks.
+
+        Chunks of the target file that appear in the source file are copied
+        directly.  Since the patch protocol can only move forward through
+        the source file, matches are taken in increasing source order.  The
+        gaps between them are diffed against the corresponding gaps in the
+        source file.
+        """
+        s_chunks = list(_iter_chunks(sfile))
+        index = {}
+        for (i,(_,_,digest)) in enumerate(s_chunks):
+            index.setdefault(digest,[]).append(i)
+        #  Find matching chunks, merging runs of consecutive matches.
+        matches = []
+        next_i = 0
+        for (t_offset,length,digest) in _iter_chunks(tfile):
+            candidates = index.get(digest)
+            if not candidates:
+                continue
+            j = bisect.bisect_left(candidates,next_i)
+            if j == len(candidates):
+                continue
+            i = candidates[j]
+            s_offset = s_chunks[i][0]
+            next_i = i + 1
+            if matches:
+                (last_t,last_s,last_len) = matches[-1]
+                if last_t+last_len == t_offset and last_s+last_len == s_offset:
+                    matches[-1] = (last_t,last_s,last_len+length)
+                    continue
+            matches.append((t_offset,s_offset,length))
+        #  Copy in the matches, diffing the gaps between them.
+        t_pos = s_pos = 0
+        for (t_offset,s_offset,length) in matches:
+            if t_offset > t_pos:
+                self._diff_file_range(sfile,tfile,spos,s_pos,s_offset,
+                                                       t_pos,t_offset)
+            self._write_call(_encode_copy,spos,s_offset,length)
+            t_pos = t_offset + length
+            s_pos = s_offset + length
+        if t_pos < t_size:
+            self._diff_file_range(sfile,tfile,spos,s_pos,s_size,t_pos,t_size)
+
+    def _diff_file_range(self,sfile,tfile,spos,s_start,s_end,t_start,t_end):
+        """Diff a range of the target file against a range of the source.
+
+        Any shared prefix or suffix of the two ranges is copied directly.
+        The changed middle section is processed in diff_window_size blocks.
+        This will produce slightly bigger patches but we avoid running out
+        of memory for large files.
+        """
+        prefix = suffix = 0
+        if sfile is not None:
+            prefix = _common_prefix_size_files(sfile,s_start,s_end,
+                                               tfile,t_start,t_end)
+            if prefix > 8:
+                self._write_call(_encode_copy,spos,s_start,prefix)
+                s_start += prefix
+                t_start += prefix
+            suffix = _common_suffix_size_files(sfile,s_start,s_end,
+                                               tfile,t_start,t_end)
+            if suffix > 8:
+                s_end -= suffix
+                t_end -= suffix
+            else:
+                suffix = 0
+        s_pos = s_start
+        t_pos = t_start
+        while t_pos < t_end:
+            tfile.seek(t_pos)
+            tdata = tfile.read(min(self.diff_window_size,t_end - t_pos))
+            if not tdata:
+                raise DiffError("target file changed while diffing")
+            sdata = b""
+            if sfile is not None and s_pos < s_end:
+                sfile.seek(s_pos)
+                sdata = sfile.read(min(self.diff_window_size,s_end - s_pos))
+            self._diff_window(spos,s_pos,sdata,tdata)
+            t_pos += len(tdata)
+            s_pos += len(sdata)
+        if suffix:
+            self._write_call(_encode_copy,spos,s_end,suffix)
+
+    def _diff_window(self,spos,offset,sdata,tdata):
+        """Generate PF_* commands for a single window of a file.
+
+        Here 'offset' is the position of sdata within the source file.
+        """
+        #  Look for a shared prefix, and copy it in directly unless it's tiny.
+        i = _common_prefix_size(sdata,tdata)
+        if i > 8:
+            self._write_call(_encode_copy,spos,offset,i)
+            tdata = tdata[i:]; sdata = sdata[i:]
+            offset += i
+        #  Likewise for a shared suffix.
+        j = _common_suffix_size(sdata,tdata)
+        if j > 8:
+            tdata = tdata[:-j]; sdata = sdata[:-j]
+        else:
+            j = 0
+        #  Write the middle of the block as a diff.  Make sure that we're
+        #  at the right place in the source file before we do so.
+        if tdata:
+            self._write_call(_encode_skip,spos,offset)
+            self._write_file_patch(sdata,tdata,spos)
+        if j:
+            self._write_call(_encode_copy,spos,offset+len(sdata),j)
+
     def _find_similar_sibling(self,source,target,nm):
         """Find a sibling of an entry against which we can calculate a diff.
 
@@ -1224,23 +4462,23 @@ class Differ(object):
         We use some pretty simple heuristics but it can make a big difference.
         """
         t_nm = os.path.join(target,nm)
-        if os.path.isfile(t_nm):
+        if self._tree.isfile(t_nm):
              # For files, I haven't decided on a good heuristic yet...
             return None
-        elif os.path.isdir(t_nm):
+        elif self._tree.isdir(t_nm):
             #  For directories, decide similarity based on the number of
             #  entry names they have in common.  This is very simple but should
             #  work well for the use cases we're facing in esky.
-            if not os.path.isdir(source):
+            if not self._tree.isdir(source):
                 return None
-            t_names = set(os.listdir(t_nm))
+            t_names = set(self._tree.listdir(t_nm))
             best = (2,'')
-            for sibnm in os.listdir(source):
-                if not os.path.isdir(os.path.join(source,sibnm)):
+            for sibnm in self._tree.listdir(source):
+                if not self._tree.isdir(os.path.join(source,sibnm)):
                     continue
-                if os.path.exists(os.path.join(target,sibnm)):
+                if self._tree.exists(os.path.join(target,sibnm)):
                     continue
-                sib_names = set(os.listdir(os.path.join(source,sibnm)))
+                sib_names = set(self._tree.listdir(os.path.join(source,sibnm)))
                 cur = (len(sib_names & t_names),sibnm)
                 if cur > best:
                     best = cur
@@ -1248,34 +4486,866 @@ class Differ(object):
         else:
             return None
 
-    def _write_file_patch(self,sdata,tdata):
+    def _write_file_patch(self,sdata,tdata,spos):
         """Write a series of PF_* commands to generate tdata from sdata.
 
-        This function tries the various PF_* commands to find the one which can
-        generate tdata from sdata with the smallest command size.  Usually that
-        will be BSDIFF4, but you never know :-)
+        The position in the source file, spos[0], is advanced by the amount
+        of source data consumed.  This may happen some time after the call
+        returns if we are diffing in parallel.
+
+        Small pieces of data to be inserted directly are passed back to us
+        rather than being encoded, and we add them to the current solid
+        block.  This happens in order, just after the preceding commands
+        have been written out.
         """
-        options = []
-        #  We could just include the raw data
-        options.append((0,PF_INS_RAW,tdata))
-        #  We could bzip2 the raw data
+        def callback(result):
+            (consumed,shortcuts,payload) = result
+            spos[0] += consumed
+            if payload is not None:
+                self._solid.add_payload(payload)
+            for (name,cost) in shortcuts:
+                stats = self.shortcut_stats.setdefault(name,[0,0])
+                stats[0] += 1
+                if cost is not None:
+                    stats[1] += cost
+        args = (sdata,tdata,self.exhaustive,self.version)
+        self._write_job(_encode_file_patch,args,callback)
+
+    def write_report(self,stream):
+        """Write a report on the diffing shortcuts taken to the given stream.
+
+        This lists how often each shortcut was taken.  When diffing in
+        exhaustive mode, it also shows how many bytes the shortcut would
+        have added to the patch, had it actually been taken.  This counts
+        the time taken to decode the patch, as described in _DECODE_COSTS.
+        """
+        if not self.shortcut_stats:
+            stream.write("no diffing shortcuts were taken\n")
+        for name in sorted(self.shortcut_stats):
+            (count,cost) = self.shortcut_stats[name]
+            if self.exhaustive:
+                msg = "%s: fired %d times, would cost %d bytes\n"
+                stream.write(msg % (name,count,cost))
+            else:
+                stream.write("%s: fired %d times\n" % (name,count))
+
+
+#  Windows of target data smaller than this are always encoded every
+#  possible way, since it's cheap to do so.
+_SHORTCUT_MIN_SIZE = 1024 * 4
+
+#  Rough cost of decoding the data inserted by each PF_INS_* command,
+#  measured in bytes of patch data per byte of output.  These come from
+#  the speed of each decompressor (about 130MB/s for zlib, 35MB/s for lzma
+#  and 16MB/s for bz2) relative to downloading patch data over a 1MB/s
+#  connection.  We'd happily accept a slightly bigger patch that applies
+#  much faster.  The extra block of a bsdiff4 patch costs the same as
+#  inserted data, but the diff block is mostly zeros and so decompresses
+#  an order of magnitude faster whatever the compression.
+_DECODE_COSTS = {
+    PF_INS_RAW: 0,
+    PF_INS_ZLIB: 1.0 / 128,
+    PF_INS_LZMA: 1.0 / 32,
+    PF_INS_BZ2: 1.0 / 16,
+}
+_DIFF_DECODE_COST = 1.0 / 256
+
+
+def _file_patch_commands(version):
+    """Get the PF_* commands that may be used to encode file data.
+
+    This depends on the patch protocol version being generated, and on
+    whether we have the lzma module available.
+    """
+    commands = [PF_INS_RAW,PF_INS_BZ2,PF_BSDIFF4]
+    if version >= 3:
+        commands.append(PF_INS_ZLIB)
+        if lzma is not None:
+            commands.extend((PF_INS_LZMA,PF_BSDIFF4_LZMA))
+    return commands
+
+
+def _find_shortcuts(sdata,tdata,commands):
+    """Find encodings that are unlikely to win for the given data.
+
+    Trying every encoding for every window is the most expensive part of
+    diffing.  This function makes some cheap estimates and returns a list
+    of (name,cmds) pairs, each naming a shortcut and the PF_* commands
+    that it says not to bother trying:
+
+      * if there's no source data, bsdiff can't beat plain compression;
+      * if a sample of the target data is incompressible, compressing
+        it won't help;
+      * if none of a sample of target snippets appear in the source, bsdiff
+        won't do any better than plain compression;
+      * if all of them appear in the source, bsdiff will almost certainly
+        beat plain compression;
+      * if we can use lzma, it will almost certainly beat zlib.  It
+        doesn't always beat bz2 though, so that still gets tried.
+
+    Only shortcuts affecting the given list of commands are returned.
+    """
+    shortcuts = []
+    if len(tdata) < _SHORTCUT_MIN_SIZE:
+        return shortcuts
+    compressors = (PF_INS_BZ2,PF_INS_ZLIB,PF_INS_LZMA)
+    differs = (PF_BSDIFF4,PF_BSDIFF4_LZMA)
+    #  Probe the compressibility of a few samples of the data.
+    step = len(tdata) // 4
+    sample = b"".join(tdata[i:i+1024*2] for i in xrange(0,step*4,step))
+    if len(zlib.compress(sample,1)) > len(sample) * 0.95:
+        shortcuts.append(("incompressible",compressors))
+    #  Estimate the similarity of target to source, by looking for a
+    #  few short snippets of the target data in the source data.  Data
+    #  such as compiled code often has only short runs in common with its
+    #  previous version, which bsdiff can still make good use of.  So we
+    #  only call the data dissimilar if very short snippets can't be found.
+    if not sdata:
+        shortcuts.append(("no-source",differs))
+    else:
+        step = len(tdata) // 16
+        found_short = found_long = 0
+        for i in xrange(0,step*16,step):
+            if sdata.find(tdata[i:i+8]) != -1:
+                found_short += 1
+                if sdata.find(tdata[i:i+32]) != -1:
+                    found_long += 1
+        if found_short == 0:
+            shortcuts.append(("dissimilar",differs))
+        elif found_long == 16:
+            shortcuts.append(("similar",compressors))
+    if PF_INS_LZMA in commands:
+        shortcuts.append(("prefer-lzma",(PF_INS_ZLIB,)))
+    shortcuts = [(name,tuple(cmd for cmd in cmds if cmd in commands))
+                 for (name,cmds) in shortcuts]
+    return [(name,cmds) for (name,cmds) in shortcuts if cmds]
+
+
+def _encode_file_patch(sdata,tdata,exhaustive=False,version=HIGHEST_VERSION):
+    """Encode a series of PF_* commands to generate tdata from sdata.
+
+    This function tries the various PF_* commands to find the one which can
+    generate tdata from sdata with the smallest command size.  Usually that
+    will be one of the BSDIFF4 variants, but you never know :-)  Commands
+    that are slow to decode are penalised according to _DECODE_COSTS, so
+    we won't pick one of those just to save a handful of bytes.
+
+    Unless 'exhaustive' is true, commands that are unlikely to win are not
+    tried; see _find_shortcuts for details.  In exhaustive mode every
+    command is tried, and we calculate how many bytes each shortcut would
+    have cost if it had been taken.
+
+    Only commands supported by the given patch version are used.  If it
+    supports solid blocks and the best option is to insert a small amount
+    of compressed data, then no commands are encoded.  Instead the data is
+    returned so the caller can add it to a solid block.
+
+    It returns a tuple ((consumed,shortcuts,payload),data) giving the number
+    of bytes of source data consumed by the commands, a list of (name,cost)
+    pairs for the shortcuts found, any data to be added to a solid block,
+    and the encoded commands themselves.
+    This is a module-level function so that it can be run in a worker
+    process when diffing in parallel.
+    """
+    commands = _file_patch_commands(version)
+    shortcuts = _find_shortcuts(sdata,tdata,commands)
+    skipped = set(cmd for (_,cmds) in shortcuts for cmd in cmds)
+    def wanted(cmd):
+        return cmd in commands and (exhaustive or cmd not in skipped)
+    options = []
+    decode_costs = {}
+    for cmd in _DECODE_COSTS:
+        decode_costs[cmd] = len(tdata) * _DECODE_COSTS[cmd]
+    #  We could just include the raw data
+    options.append((0,PF_INS_RAW,tdata))
+    #  We could compress the raw data in various ways
+    if wanted(PF_INS_BZ2):
         options.append((0,PF_INS_BZ2,bz2.compress(tdata)))
-        #  We could bsdiff4 the data, if we have an appropriate module
-        if bsdiff4.diff is not None:
-            patch_data = bsdiff4.diff(sdata,tdata)
-            # remove the 8 header bytes, we know it's BSDIFF4 format
-            options.append((len(sdata),PF_BSDIFF4,len(sdata),patch_data[8:]))
-        #  Find the option with the smallest data and use that.
-        options = [(len(cmd[-1]),cmd) for cmd in options]
-        options.sort()
-        best_option = options[0][1]
-        self._write_command(best_option[1])
-        for arg in best_option[2:]:
-            if isinstance(arg,(str,unicode,bytes)):
-                self._write_bytes(arg)
+    if wanted(PF_INS_ZLIB):
+        options.append((0,PF_INS_ZLIB,zlib.compress(tdata,9)))
+    if wanted(PF_INS_LZMA):
+        options.append((0,PF_INS_LZMA,_lzma_compress(tdata)))
+    #  We could bsdiff4 the data, if we have an appropriate module.
+    #  The raw blocks are calculated once and then compressed each way.
+    if wanted(PF_BSDIFF4) or wanted(PF_BSDIFF4_LZMA):
+        blocks = _bsdiff4_diff_blocks(sdata,tdata)
+        if blocks is not None:
+            diff_size = len(blocks[0]) + len(blocks[1])
+            for (cmd,compressor) in ((PF_BSDIFF4,PF_INS_BZ2),
+                                     (PF_BSDIFF4_LZMA,PF_INS_LZMA)):
+                decode_costs[cmd] = diff_size * _DIFF_DECODE_COST + \
+                                    len(blocks[2]) * _DECODE_COSTS[compressor]
+            if wanted(PF_BSDIFF4):
+                patch_data = _bsdiff4_pack(blocks,len(tdata),bz2.compress)
+                options.append((len(sdata),PF_BSDIFF4,len(sdata),patch_data))
+            if wanted(PF_BSDIFF4_LZMA):
+                patch_data = _bsdiff4_pack(blocks,len(tdata),_lzma_compress)
+                options.append((len(sdata),PF_BSDIFF4_LZMA,len(sdata),patch_data))
+    #  Find the option with the lowest overall cost and use that.
+    options = [(len(cmd[-1]) + int(decode_costs[cmd[1]]),cmd)
+               for cmd in options]
+    options.sort()
+    best_option = options[0][1]
+    #  Work out what each shortcut would have cost, if we can.
+    costs = []
+    for (name,cmds) in shortcuts:
+        if not exhaustive:
+            costs.append((name,None))
+        elif best_option[1] not in cmds:
+            costs.append((name,0))
+        else:
+            for (score,option) in options:
+                if option[1] not in skipped:
+                    costs.append((name,score - options[0][0]))
+                    break
+    if version >= 4 and len(tdata) <= SOLID_FILE_SIZE:
+        if best_option[1] in (PF_INS_BZ2,PF_INS_ZLIB,PF_INS_LZMA):
+            return ((0,costs,tdata),b"")
+    out = BytesIO()
+    _write_vint(out,best_option[1])
+    for arg in best_option[2:]:
+        if isinstance(arg,(str,unicode,bytes)):
+            _write_vint(out,len(arg))
+            out.write(arg)
+        else:
+            _write_vint(out,arg)
+    return ((best_option[0],costs,None),out.getvalue())
+
+
+def _encode_skip(spos,offset):
+    """Encode a PF_SKIP command to move to the given source offset.
+
+    This advances the position in the source file, spos[0], to the given
+    offset.  If we're already there then nothing is encoded.  We can only
+    move forward through the source file, never backward.
+    """
+    skipbytes = offset - spos[0]
+    if skipbytes < 0:
+        raise DiffError("can't move backwards in source file")
+    if not skipbytes:
+        return b""
+    out = BytesIO()
+    _write_vint(out,PF_SKIP)
+    _write_vint(out,skipbytes)
+    spos[0] += skipbytes
+    return out.getvalue()
+
+
+def _encode_copy(spos,offset,n):
+    """Encode PF_* commands to copy n bytes from the given source offset.
+
+    This skips forward in the source file if necessary, and advances the
+    position in the source file, spos[0], past the copied data.
+    """
+    out = BytesIO()
+    out.write(_encode_skip(spos,offset))
+    _write_vint(out,PF_COPY)
+    _write_vint(out,n)
+    spos[0] += n
+    return out.getvalue()
+
+
+def _common_prefix_size(data1,data2):
+    """Find the length of the common prefix of two bytestrings.
+
+    Rather than comparing one byte at a time, this compares increasingly
+    large blocks and then does a binary search within the first block that
+    differs.  That way all the heavy lifting happens at C speed.
+    """
+    size = min(len(data1),len(data2))
+    lo = 0
+    block = 64
+    while lo < size:
+        hi = min(lo + block,size)
+        if data1[lo:hi] != data2[lo:hi]:
+            break
+        lo = hi
+        block = min(block * 2,_COMPARE_BLOCK_SIZE)
+    else:
+        return size
+    #  The first difference is somewhere in data[lo:hi].
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if data1[lo:mid] == data2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def _common_suffix_size(data1,data2):
+    """Find the length of the common suffix of two bytestrings.
+
+    This works just like _common_prefix_size, but from the other end.
+    """
+    len1 = len(data1)
+    len2 = len(data2)
+    size = min(len1,len2)
+    lo = 0
+    block = 64
+    while lo < size:
+        hi = min(lo + block,size)
+        if data1[len1-hi:len1-lo] != data2[len2-hi:len2-lo]:
+            break
+        lo = hi
+        block = min(block * 2,_COMPARE_BLOCK_SIZE)
+    else:
+        return size
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if data1[len1-mid:len1-lo] == data2[len2-mid:len2-lo]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def _common_prefix_size_files(file1,start1,end1,file2,start2,end2):
+    """Find the length of the common prefix of two ranges of files."""
+    size = 0
+    max_size = min(end1 - start1,end2 - start2)
+    while size < max_size:
+        n = min(_COMPARE_BLOCK_SIZE,max_size - size)
+        file1.seek(start1 + size)
+        data1 = file1.read(n)
+        file2.seek(start2 + size)
+        data2 = file2.read(n)
+        if data1 != data2 or len(data1) != n:
+            return size + _common_prefix_size(data1,data2)
+        size += n
+    return size
+
+
+def _common_suffix_size_files(file1,start1,end1,file2,start2,end2):
+    """Find the length of the common suffix of two ranges of files."""
+    size = 0
+    max_size = min(end1 - start1,end2 - start2)
+    while size < max_size:
+        n = min(_COMPARE_BLOCK_SIZE,max_size - size)
+        file1.seek(end1 - size - n)
+        data1 = file1.read(n)
+        file2.seek(end2 - size - n)
+        data2 = file2.read(n)
+        if data1 != data2 or len(data1) != n:
+            return size + _common_suffix_size(data1,data2)
+        size += n
+    return size
+
+
+def _iter_chunks(f):
+    """Split a file into content-defined chunks.
+
+    This generates (offset,length,digest) tuples covering the entire file.
+    Chunk boundaries are found using a "gear" rolling hash over the last
+    32 bytes of data, so they depend only on the local file contents; an
+    insertion or deletion only changes the chunks around it, rather than
+    shifting every later chunk as fixed-size blocks would.
+    """
+    f.seek(0)
+    buf = bytearray()
+    buf_offset = 0
+    eof = False
+    while not eof:
+        data = f.read(CHUNK_MAX_SIZE * 16)
+        if data:
+            buf.extend(data)
+        else:
+            eof = True
+        pos = 0
+        while pos < len(buf):
+            end = _find_chunk_boundary(buf,pos,eof)
+            if end is None:
+                break
+            digest = hashlib.md5(bytes(buf[pos:end])).digest()
+            yield (buf_offset + pos,end - pos,digest)
+            pos = end
+        del buf[:pos]
+        buf_offset += pos
+
+
+def _find_chunk_boundary(buf,pos,eof):
+    """Find the end of the chunk starting at buf[pos].
+
+    Returns None if more data is needed to find the boundary.
+    """
+    size = len(buf)
+    limit = pos + CHUNK_MAX_SIZE
+    if limit > size:
+        if not eof:
+            return None
+        limit = size
+    start = pos + CHUNK_MIN_SIZE
+    if start >= limit:
+        return limit
+    gear = _CHUNK_GEAR
+    mask = _CHUNK_MASK
+    h = 0
+    #  The hash only depends on the previous 32 bytes, so we can skip
+    #  straight to near the minimum chunk size.
+    for i in xrange(start - 32,start):
+        h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+    for i in xrange(start,limit):
+        h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+        if not h & mask:
+            return i + 1
+    return limit
+
+
+class _DiffSequencer(object):
+    """File-like object writing patch data in order, as diff jobs complete.
+
+    When diffing in parallel, the expensive per-file encoding work is sent
+    to a process pool.  This object queues up the results of those jobs,
+    along with any data written directly, and writes it all to the real
+    output stream in the original order.  The result is byte-for-byte
+    identical to diffing serially.
+    """
+
+    def __init__(self,stream,pool,max_pending):
+        self.stream = stream
+        self.pool = pool
+        self.max_pending = max_pending
+        self._queue = collections.deque()
+        self._num_pending = 0
+
+    def write(self,data):
+        if self._queue:
+            self._queue.append(("data",data,None))
+        else:
+            self.stream.write(data)
+
+    def add_call(self,func,*args):
+        """Write func(*args) once all previously-queued data is written."""
+        if self._queue:
+            self._queue.append(("call",func,args))
+        else:
+            self.stream.write(func(*args))
+
+    def add_job(self,func,args,callback):
+        """Run func(*args) in the pool, writing its result data in order."""
+        result = self.pool.apply_async(func,args)
+        self._queue.append(("job",result,callback))
+        self._num_pending += 1
+        self.flush(self.max_pending)
+
+    def flush(self,max_pending=None):
+        """Write out as much queued data as is ready.
+
+        If max_pending is given, this waits for jobs to complete until no
+        more than that number are still pending.
+        """
+        while self._queue:
+            (kind,a,b) = self._queue[0]
+            if kind == "job":
+                if not a.ready():
+                    if max_pending is None:
+                        break
+                    if self._num_pending <= max_pending:
+                        break
+                (result,data) = a.get()
+                self._num_pending -= 1
+                self.stream.write(data)
+                b(result)
+            elif kind == "call":
+                self.stream.write(a(*b))
             else:
-                self._write_int(arg)
-        return best_option[0]
+                self.stream.write(a)
+            self._queue.popleft()
+
+
+class _SolidWriter(object):
+    """File-like object gathering small pieces of data into solid blocks.
+
+    Payloads added to this object are inserted into the target file using
+    PF_INS_SOLID commands, which take their data from the preceding
+    SOLID_BLOCK command.  While a block is being filled we hold back all
+    data written to this object, since the SOLID_BLOCK command must come
+    before the commands that use it.  When the block is full it is
+    compressed and written out, followed by the held-back data.
+
+    This object also tracks the sections of the patch, since it knows
+    where the held-back data will end up in the output stream.  A section
+    can be skipped by discarding the number of solid bytes it uses, so
+    blocks must never appear inside a section.  We therefore hold back
+    data from the start of each section.  If the section is written out
+    before it ends, any further payloads in that section are inserted
+    individually instead.
+    """
+
+    def __init__(self,stream,version):
+        self.stream = stream
+        self.version = version
+        self.sections = []
+        self._pending = BytesIO()
+        self._holding = False
+        self._payloads = []
+        self._payload_size = 0
+        self._marks = []
+        self._section = None
+        self._section_written = False
+
+    def write(self,data):
+        if self._holding:
+            self._pending.write(data)
+            if self._pending.tell() > _SOLID_MAX_PENDING:
+                self.flush()
+        else:
+            self.stream.write(data)
+
+    def add_payload(self,data):
+        """Insert the given data into the target using the solid block."""
+        if self._section_written:
+            (cmd,cdata) = _compress_payload(data,self.version)
+            _write_vint(self.stream,cmd)
+            _write_vint(self.stream,len(cdata))
+            self.stream.write(cdata)
+            return
+        self._holding = True
+        self._payloads.append(data)
+        self._payload_size += len(data)
+        _write_vint(self._pending,PF_INS_SOLID)
+        _write_vint(self._pending,len(data))
+        if self._section is not None:
+            self.sections[self._section][2] += len(data)
+        if self._payload_size >= SOLID_BLOCK_SIZE:
+            self.flush()
+
+    def begin_section(self,i):
+        """Note that section i of the patch starts at this position."""
+        assert i == len(self.sections)
+        self.sections.append([None,None,0])
+        self._section = i
+        self._section_written = False
+        self._holding = True
+        self._mark(i,0)
+        return b""
+
+    def end_section(self,i):
+        """Note that section i of the patch ends at this position."""
+        self._mark(i,1)
+        self._section = None
+        self._section_written = False
+        if not self._payloads:
+            self.flush()
+        return b""
+
+    def _mark(self,i,j):
+        if self._holding:
+            self._marks.append((i,j,self._pending.tell()))
+        else:
+            self.sections[i][j] = self.stream.tell()
+
+    def flush(self):
+        """Write out the current solid block and any held-back data."""
+        if self._payloads:
+            data = b"".join(self._payloads)
+            self.stream.write(_encode_solid_block(data,self.version))
+        if self._holding:
+            if self._marks:
+                start = self.stream.tell()
+                for (i,j,offset) in self._marks:
+                    self.sections[i][j] = start + offset
+                self._marks = []
+            self.stream.write(self._pending.getvalue())
+            self._pending = BytesIO()
+            self._holding = False
+            self._payloads = []
+            self._payload_size = 0
+            if self._section is not None:
+                self._section_written = True
+
+
+def _encode_solid_block(data,version):
+    """Encode a SOLID_BLOCK command containing the given data.
+
+    The data is compressed using whichever PF_INS_* command gives the
+    lowest overall cost, just like for data in an individual file.
+    """
+    (cmd,cdata) = _compress_payload(data,version)
+    out = BytesIO()
+    _write_vint(out,SOLID_BLOCK)
+    _write_vint(out,cmd)
+    _write_vint(out,len(cdata))
+    out.write(cdata)
+    return out.getvalue()
+
+
+def _compress_payload(data,version):
+    """Compress data using the PF_INS_* command with the lowest cost.
+
+    Returns a tuple (cmd,cdata) giving the command and compressed data.
+    """
+    commands = _file_patch_commands(version)
+    options = [(len(data),PF_INS_RAW,data)]
+    compressors = ((PF_INS_BZ2,bz2.compress),
+                   (PF_INS_ZLIB,lambda d: zlib.compress(d,9)),
+                   (PF_INS_LZMA,_lzma_compress))
+    for (cmd,compress) in compressors:
+        if cmd in commands:
+            cdata = compress(data)
+            score = len(cdata) + int(len(data) * _DECODE_COSTS[cmd])
+            options.append((score,cmd,cdata))
+    options.sort()
+    (_,cmd,cdata) = options[0]
+    return (cmd,cdata)
+
+
+class _TreeSnapshot(object):
+    """Cached view of the files and directories being diffed.
+
+    Diffing asks the same questions about each path many times over: does
+    it exist, is it a directory, what's in it, does it differ from some
+    other path?  This object answers them from a single scan of each
+    directory, remembering the type, size and mode of each entry.  Content
+    digests are calculated only when needed, and the result of comparing
+    two paths is remembered, so that each subtree is read and compared at
+    most once no matter how deeply it's nested.
+
+    The trees must not change while the snapshot is in use.
+    """
+
+    def __init__(self,hash=hashlib.md5):
+        self.hash = hash
+        self._entries = {}
+        self._listings = {}
+        self._digests = {}
+        self._differs = {}
+
+    def _stat(self,path):
+        """Get a tuple (kind,size,mode) for the given path, or None."""
+        try:
+            return self._entries[path]
+        except KeyError:
+            pass
+        #  If we've scanned the parent directory, we know it doesn't exist.
+        if os.path.dirname(path) in self._listings:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry = None
+        else:
+            entry = (_stat_kind(st.st_mode),st.st_size,st.st_mode)
+        self._entries[path] = entry
+        return entry
+
+    def exists(self,path):
+        return self._stat(path) is not None
+
+    def isdir(self,path):
+        entry = self._stat(path)
+        return entry is not None and entry[0] == "dir"
+
+    def isfile(self,path):
+        entry = self._stat(path)
+        return entry is not None and entry[0] == "file"
+
+    def size(self,path):
+        return self._stat(path)[1]
+
+    def mode(self,path):
+        return self._stat(path)[2]
+
+    def listdir(self,path):
+        """List the names in the given directory, in sorted order."""
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+        names = []
+        if _scandir is not None:
+            for entry in _scandir(path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    info = None
+                else:
+                    info = (_stat_kind(st.st_mode),st.st_size,st.st_mode)
+                self._entries[os.path.join(path,entry.name)] = info
+                names.append(entry.name)
+        else:
+            for nm in os.listdir(path):
+                self._entries.pop(os.path.join(path,nm),None)
+                self._stat(os.path.join(path,nm))
+                names.append(nm)
+        names.sort()
+        self._listings[path] = names
+        return names
+
+    def walk(self,top):
+        """Walk the given directory tree top-down, like os.walk.
+
+        The names are given in sorted order, and the caller may remove
+        entries from the list of subdirectories to avoid walking them.
+        """
+        dirnames = []
+        filenames = []
+        for nm in self.listdir(top):
+            if self.isdir(os.path.join(top,nm)):
+                dirnames.append(nm)
+            else:
+                filenames.append(nm)
+        yield (top,dirnames,filenames)
+        for nm in dirnames:
+            for item in self.walk(os.path.join(top,nm)):
+                yield item
+
+    def digest(self,path):
+        """Get the content digest of the given file."""
+        try:
+            return self._digests[path]
+        except KeyError:
+            digest = calculate_digest(path,self.hash)
+            self._digests[path] = digest
+            return digest
+
+    def differs(self,path1,path2):
+        """Check whether two paths differ, as per paths_differ()."""
+        key = (path1,path2)
+        try:
+            return self._differs[key]
+        except KeyError:
+            pass
+        if self.isdir(path1):
+            if not self.isdir(path2):
+                result = True
+            else:
+                names = self.listdir(path1)
+                if names != self.listdir(path2):
+                    result = True
+                else:
+                    result = False
+                    for nm in names:
+                        if self.differs(os.path.join(path1,nm),
+                                        os.path.join(path2,nm)):
+                            result = True
+                            break
+        elif self.isfile(path1):
+            if not self.isfile(path2):
+                result = True
+            elif self.size(path1) != self.size(path2):
+                result = True
+            elif path1 in self._digests and path2 in self._digests:
+                result = (self._digests[path1] != self._digests[path2])
+            else:
+                result = _file_contents_differ(path1,path2)
+        else:
+            result = self.exists(path2)
+        self._differs[key] = result
+        return result
+
+    def forget(self,path):
+        """Forget everything known about the given path and its contents."""
+        prefix = path + os.sep
+        for cache in (self._entries,self._listings,self._digests):
+            for p in list(cache):
+                if p == path or p.startswith(prefix):
+                    del cache[p]
+        for (p1,p2) in list(self._differs):
+            if p1 == path or p1.startswith(prefix):
+                del self._differs[(p1,p2)]
+            elif p2 == path or p2.startswith(prefix):
+                del self._differs[(p1,p2)]
+
+
+def _stat_kind(mode):
+    """Classify a st_mode value as "dir", "file" or "other"."""
+    if stat.S_ISDIR(mode):
+        return "dir"
+    if stat.S_ISREG(mode):
+        return "file"
+    return "other"
+
+
+class _FileIndex(object):
+    """Index of the files in a source tree, for finding moved files.
+
+    Files are indexed by size, and content digests are only calculated for
+    files whose size matches that of a file we're looking for.  Everything
+    is looked up through the given _TreeSnapshot, so nothing is stat'ed or
+    hashed more than once.  For finding near-duplicates, we compare the sets
+    of content-defined chunks of files that have been removed from the target
+    tree; this is only done for files with the same extension and a similar
+    size, to keep the cost down.
+    """
+
+    #  Minimum size of file worth looking for.
+    MIN_SIZE = 64
+    #  Minimum size of file worth looking for near-duplicates of.
+    MIN_SIMILAR_SIZE = CHUNK_MIN_SIZE * 4
+    #  Minimum proportion of shared chunks to count as a near-duplicate.
+    MIN_SIMILARITY = 0.2
+
+    def __init__(self,tree,source,target):
+        self._tree = tree
+        self._by_size = {}
+        self._removed_by_ext = {}
+        self._sketches = {}
+        for (dirpath,dirnames,filenames) in tree.walk(source):
+            t_dirpath = os.path.join(target,os.path.relpath(dirpath,source))
+            for nm in filenames:
+                path = os.path.join(dirpath,nm)
+                if not tree.isfile(path):
+                    continue
+                size = tree.size(path)
+                if size < self.MIN_SIZE:
+                    continue
+                self._by_size.setdefault(size,[]).append(path)
+                if not tree.exists(os.path.join(t_dirpath,nm)):
+                    ext = os.path.splitext(nm)[1]
+                    self._removed_by_ext.setdefault(ext,[]).append((size,path))
+
+    def find_source(self,path):
+        """Find a source file against which the given file can be diffed."""
+        size = self._tree.size(path)
+        if size < self.MIN_SIZE:
+            return None
+        #  Look for an exact match, preferring ones with the same name.
+        candidates = self._by_size.get(size,())
+        if candidates:
+            digest = self._tree.digest(path)
+            matches = [s_path for s_path in candidates
+                       if self._tree.digest(s_path) == digest]
+            if matches:
+                nm = os.path.basename(path)
+                for s_path in matches:
+                    if os.path.basename(s_path) == nm:
+                        return s_path
+                return matches[0]
+        #  Look for a similar file that has been removed from the tree.
+        if size < self.MIN_SIMILAR_SIZE:
+            return None
+        ext = os.path.splitext(path)[1]
+        best = (self.MIN_SIMILARITY,None)
+        sketch = None
+        for (s_size,s_path) in self._removed_by_ext.get(ext,()):
+            if s_size < size // 2 or s_size > size * 2:
+                continue
+            if sketch is None:
+                sketch = self._get_sketch(path)
+            s_sketch = self._get_sketch(s_path)
+            shared = len(sketch & s_sketch)
+            similarity = shared / float(len(sketch | s_sketch))
+            if similarity > best[0]:
+                best = (similarity,s_path)
+        return best[1]
+
+    def _get_sketch(self,path):
+        try:
+            return self._sketches[path]
+        except KeyError:
+            with open(path,"rb") as f:
+                sketch = set(digest for (_,_,digest) in _iter_chunks(f))
+            self._sketches[path] = sketch
+            return sketch
+
+
+def _relpath(path,root):
+    """Get the given path relative to the root, in patch format.
+
+    Paths in the patch stream always use forward slashes.
+    """
+    return os.path.relpath(path,root).replace(os.sep,"/")
 
 
 class _tempdir(object):
@@ -1341,6 +5411,32 @@ def main(args):
                       help="set the window size for diffing files")
     parser.add_option("","--dry-run",dest="dry_run",action="store_true",
                       help="print commands instead of executing them")
+    parser.add_option("-j","--jobs",dest="jobs",metavar="N",type="int",
+                      help="use N workers for diffing or patching files")
+    parser.add_option("","--chunked",dest="chunked",action="store_true",
+                      help="match up chunks of large files before diffing")
+    parser.add_option("","--patch-version",dest="patch_version",metavar="N",
+                      type="int",
+                      help="generate a patch for the given protocol version")
+    parser.add_option("","--exhaustive",dest="exhaustive",action="store_true",
+                      help="try every encoding to get the smallest patch")
+    parser.add_option("","--hash",dest="hash_name",metavar="NAME",
+                      help="use hash algorithm NAME to verify files")
+    parser.add_option("","--verify-files",dest="verify_files",
+                      action="store_true",
+                      help="verify each file as it's patched")
+    parser.add_option("","--no-bcj",dest="filter_executables",
+                      action="store_false",default=True,
+                      help="don't filter x86 executables before diffing")
+    parser.add_option("","--no-bytecode",dest="diff_bytecode",
+                      action="store_false",default=True,
+                      help="don't treat .pyc files specially when diffing")
+    parser.add_option("","--report",dest="report",action="store_true",
+                      help="report on diffing shortcuts taken, to stderr")
+    parser.add_option("-o","--output",dest="output",metavar="FILE",
+                      help="write squashed patch to FILE")
+    parser.add_option("","--checkpoint",dest="checkpoint",metavar="FILE",
+                      help="record patching progress in FILE, for resuming")
     (opts,args) = parser.parse_args(args)
     if opts.deep_zipped:
         opts.zipped = True
@@ -1386,7 +5482,17 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            write_patch(source,target,stream,diff_window_size=opts.diff_window)
+            differ = Differ(stream,diff_window_size=opts.diff_window,
+                            jobs=opts.jobs,chunked=opts.chunked,
+                            version=opts.patch_version,
+                            exhaustive=opts.exhaustive,
+                            verify_files=opts.verify_files,
+                            hash_name=opts.hash_name,
+                            filter_executables=opts.filter_executables,
+                            diff_bytecode=opts.diff_bytecode)
+            differ.diff(source,target)
+            if opts.report:
+                differ.write_report(sys.stderr)
         elif cmd == "patch":
             #  Patch a file or directory.
             #  If --zipped is specified, the target is unzipped to a temporary
@@ -1406,7 +5512,8 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            apply_patch(target,stream,dry_run=opts.dry_run)
+            apply_patch(target,stream,dry_run=opts.dry_run,jobs=opts.jobs,
+                        checkpoint=opts.checkpoint)
             if opts.zipped and target_zip is not None:
                 target_dir = os.path.dirname(target_zip)
                 (fd,target_temp) = tempfile.mkstemp(dir=target_dir)
@@ -1422,6 +5529,35 @@ def main(args):
                     os.unlink(target_zip)
                     time.sleep(0.01)
                 really_rename(target_temp,target_zip)
+        elif cmd == "list":
+            #  List the files patched by a patch, using its table of contents.
+            if len(args) > 1:
+                stream = open(args[1],"rb")
+            else:
+                stream = sys.stdin
+            sections = read_patch_toc(stream)
+            if sections is None:
+                raise ValueError("patch has no table of contents")
+            for section in sections:
+                if section.source_digest:
+                    s_digest = section.source_digest.encode("hex")
+                else:
+                    s_digest = "-"
+                print "%s %s:%s %d %s" % (section.hash_name,s_digest,
+                                       section.target_digest.encode("hex"),
+                                       section.length,section.path)
+        elif cmd == "squash":
+            #  Combine several patches into one.
+            patches = [open(nm,"rb") for nm in args[1:]]
+            try:
+                if opts.output:
+                    stream = open(opts.output,"wb")
+                else:
+                    stream = sys.stdout
+                squash_patches(patches,stream)
+            finally:
+                for patch in patches:
+                    patch.close()
         else:
             raise ValueError("invalid command: " + cmd)
     finally:
@@ -0,0 +1,64 @@
+"""
+
+  esky.tests.bench_bsdiff:  benchmark for the pure-python bsdiff4 patcher.
+
+This times how quickly bsdiff4_py can apply a patch to a large window of
+data, which is where it spends its time when no native bsdiff4 module is
+available.  The source is random data and the target has scattered edits
+plus an insertion.  Pass the window sizes to try, in megabytes, e.g.
+"python -m esky.tests.bench_bsdiff 4 16".  A native bsdiff4 module is
+needed to create the patches.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+
+import esky.patch
+from esky.patch import bsdiff4_py
+
+
+def make_target(source):
+    """Make a target from the given source with scattered edits."""
+    insert_at = len(source) // 4
+    target = bytearray(source[:insert_at] + os.urandom(300) +
+                       source[insert_at:])
+    for i in xrange(0,len(target),997):
+        target[i] = (target[i] + i) % 256
+    return bytes(target)
+
+
+def main(args):
+    if bsdiff4_py.diff is None:
+        print "a native bsdiff4 module is needed to create the patches"
+        return 1
+    if args:
+        sizes = [int(arg) for arg in args]
+    else:
+        sizes = [4,16]
+    if esky.patch._get_numpy():
+        print "adding bytes with numpy"
+    else:
+        print "adding bytes with big integers"
+    for size in sizes:
+        source = os.urandom(size * 1024 * 1024)
+        target = make_target(source)
+        patch = bsdiff4_py.diff(source,target)
+        best = None
+        for _ in xrange(3):
+            t_start = time.time()
+            result = bsdiff4_py.patch(source,patch)
+            t_taken = time.time() - t_start
+            if best is None or t_taken < best:
+                best = t_taken
+        assert result == target
+        print "%3dMB window  patched in %.2fs: %.1f MB/s" % (
+              size,best,len(target) / best / (1024 * 1024))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""
+
+  esky.tests.bench_patch:  microbenchmark for decoding patch commands.
+
+This times how quickly the Patcher can read and dispatch a stream of small
+path-manipulation commands, which is where patches for trees with many files
+spend a lot of their time.  The patch is read from a file opened both with
+and without buffering.  Run it as "python -m esky.tests.bench_patch".
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import tempfile
+
+import esky.patch
+from esky.patch import PATCH_HEADER, JOIN_PATH, POP_PATH, _write_vint
+from esky.util import really_rmtree
+
+
+def write_path_commands(stream,num_paths):
+    """Write a version 1 patch consisting of num_paths path commands."""
+    stream.write(PATCH_HEADER)
+    _write_vint(stream,1)
+    for i in xrange(num_paths):
+        path = ("subdir%d/file%d.py" % (i % 100,i)).encode("utf8")
+        _write_vint(stream,JOIN_PATH)
+        _write_vint(stream,len(path))
+        stream.write(path)
+        _write_vint(stream,POP_PATH)
+        _write_vint(stream,POP_PATH)
+    return num_paths * 3
+
+
+def main(args):
+    if args:
+        num_paths = int(args[0])
+    else:
+        num_paths = 100000
+    workdir = tempfile.mkdtemp()
+    try:
+        patchfile = os.path.join(workdir,"patch")
+        with open(patchfile,"wb") as f:
+            num_commands = write_path_commands(f,num_paths)
+        target = os.path.join(workdir,"target")
+        os.mkdir(target)
+        for (name,buffering) in (("buffered",-1),("unbuffered",0)):
+            best = None
+            for _ in xrange(3):
+                with open(patchfile,"rb",buffering) as f:
+                    t_start = time.time()
+                    esky.patch.apply_patch(target,f)
+                    t_taken = time.time() - t_start
+                if best is None or t_taken < best:
+                    best = t_taken
+            print "%-10s  %d commands in %.3fs: %d commands/sec" % (
+                  name,num_commands,best,num_commands / best)
+    finally:
+        really_rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -14,6 +14,10 @@ import threading
 import tempfile
 import urllib2
 import hashlib
+import random
+import struct
+import py_compile
+from io import BytesIO
 import tarfile
 import time
 from contextlib import contextmanager
@@ -29,7 +33,8 @@ from esky.bdist_esky import Executable, bdist_esky
 import esky.bdist_esky
 from esky.util import extract_zipfile, deep_extract_zipfile, get_platform, \
                       ESKY_CONTROL_DIR, files_differ, ESKY_APPDATA_DIR, \
-                      really_rmtree, LOCAL_HTTP_PORT
+                      really_rmtree, link_or_copy_tree, copy_file_data, \
+                      LOCAL_HTTP_PORT
 from esky.fstransact import FSTransaction
 import pytest
 
@@ -413,6 +418,33 @@ class TestEsky(unittest.TestCase):
         really_rmtree(appdir)
 
 
+  def test_prepare_version_lock(self):
+    """Test that a version can only be prepared by one finder at a time."""
+    appdir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(appdir,ESKY_APPDATA_DIR,"testapp-0.1",ESKY_CONTROL_DIR))
+        open(os.path.join(appdir,ESKY_APPDATA_DIR,"testapp-0.1",ESKY_CONTROL_DIR,"bootstrap-manifest.txt"),"wb").close()
+        e = esky.Esky(appdir,"http://example.com/downloads/")
+        finder = e.version_finder
+        vdir = esky.bootstrap.join_app_version(e.name,"0.2",e.platform)
+        statedir = os.path.join(finder._workdir(e,"unpack"),vdir)
+        os.mkdir(statedir)
+        open(os.path.join(statedir,"progress.txt"),"wb").close()
+        lock = finder._lock_statedir(statedir)
+        try:
+            self.assertRaises(esky.EskyLockedError,
+                              finder._prepare_version,e,"0.2",[])
+            #  The other attempt's files are left alone.
+            assert os.path.exists(os.path.join(statedir,"progress.txt"))
+        finally:
+            finder._unlock_statedir(statedir,lock)
+        assert not os.path.exists(statedir + ".lock")
+        lock = finder._lock_statedir(statedir)
+        finder._unlock_statedir(statedir,lock)
+    finally:
+        really_rmtree(appdir)
+
+
 class TestFSTransact(unittest.TestCase):
     """Testcases for FSTransact."""
 
@@ -654,6 +686,25 @@ class TestPatch(unittest.TestCase):
     def tearDown(self):
         really_rmtree(self.workdir)
 
+    def test_command_reader(self):
+        values = [0,1,127,128,300,2**14,2**40,5]
+        data = BytesIO()
+        for x in values:
+            esky.patch._write_vint(data,x)
+            data.write("x" * (x % 200))
+        data = data.getvalue()
+        #  Small buffers make values straddle the buffer boundaries.
+        for buffer_size in (1,2,3,7,64,1024):
+            reader = esky.patch._CommandReader(BytesIO(data),buffer_size)
+            for x in values:
+                self.assertEquals(reader.read_vint(),x)
+                if x % 2:
+                    self.assertEquals(reader.read(x % 200),"x" * (x % 200))
+                else:
+                    reader.seek(x % 200)
+            self.assertRaises(EOFError,reader.read_vint)
+            self.assertEquals(reader.read(10),"")
+
     def test_patch_bigfile(self):
         tdir = tempfile.mkdtemp()
         try:
@@ -676,6 +727,124 @@ class TestPatch(unittest.TestCase):
         finally:
             really_rmtree(tdir)
 
+    def test_patch_bigfile_streaming(self):
+        orig_stream_size = esky.patch.BSDIFF4_STREAM_SIZE
+        esky.patch.BSDIFF4_STREAM_SIZE = 1024
+        tdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(1024*300)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(data[:1000] + os.urandom(100) + data[1010:])
+            with open(os.path.join(tdir,"patch"),"wb") as f:
+                esky.patch.write_patch(os.path.join(tdir,"source"),os.path.join(tdir,"target"),f,diff_window_size=1024*1024)
+            with open(os.path.join(tdir,"patch"),"rb") as f:
+                esky.patch.apply_patch(os.path.join(tdir,"source"),f)
+            self.assertEquals(esky.patch.calculate_digest(os.path.join(tdir,"source")),
+                              esky.patch.calculate_digest(os.path.join(tdir,"target")))
+        finally:
+            esky.patch.BSDIFF4_STREAM_SIZE = orig_stream_size
+            really_rmtree(tdir)
+
+    def test_patch_shared_prefix_and_suffix(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(1024*1024)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(data[:500000] + os.urandom(1000) + data[500010:])
+            patch = BytesIO()
+            esky.patch.write_patch(os.path.join(tdir,"source"),os.path.join(tdir,"target"),patch,diff_window_size=1024*64)
+            self.assertTrue(len(patch.getvalue()) < 1024*2)
+            esky.patch.apply_patch(os.path.join(tdir,"source"),BytesIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(os.path.join(tdir,"source")),
+                              esky.patch.calculate_digest(os.path.join(tdir,"target")))
+        finally:
+            really_rmtree(tdir)
+
+    def test_patch_versions(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            #  Data repeated at long range compresses better with lzma.
+            data = os.urandom(1024*200)
+            extra = os.urandom(1024*100)
+            for nm in ("source","target"):
+                os.mkdir(os.path.join(tdir,nm))
+            with open(os.path.join(tdir,"source","changed"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target","changed"),"wb") as f:
+                f.write(data[:1024*100] + extra*2 + data[1024*100:])
+            with open(os.path.join(tdir,"target","new"),"wb") as f:
+                f.write(extra*3)
+            sizes = []
+            orig_lzma = esky.patch.lzma
+            for version in xrange(1,esky.patch.HIGHEST_VERSION+1):
+                patch = BytesIO()
+                esky.patch.write_patch(os.path.join(tdir,"source"),os.path.join(tdir,"target"),patch,version=version,exhaustive=True)
+                sizes.append(len(patch.getvalue()))
+                patched = os.path.join(tdir,"patched")
+                shutil.copytree(os.path.join(tdir,"source"),patched)
+                #  Older patches must not need the lzma module
+                if version < 3:
+                    esky.patch.lzma = None
+                try:
+                    esky.patch.apply_patch(patched,BytesIO(patch.getvalue()))
+                finally:
+                    esky.patch.lzma = orig_lzma
+                self.assertEquals(esky.patch.calculate_digest(patched),
+                                  esky.patch.calculate_digest(os.path.join(tdir,"target")))
+                really_rmtree(patched)
+            if esky.patch.lzma is not None:
+                self.assertTrue(sizes[-1] < sizes[0])
+        finally:
+            really_rmtree(tdir)
+
+    def test_diff_shortcuts(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(os.urandom(1024*100))
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(os.urandom(1024*100))
+            patches = []
+            for exhaustive in (False,True):
+                patch = BytesIO()
+                differ = esky.patch.Differ(patch,exhaustive=exhaustive)
+                differ.diff(os.path.join(tdir,"source"),os.path.join(tdir,"target"))
+                self.assertEquals(differ.shortcut_stats["incompressible"][0],1)
+                report = BytesIO()
+                differ.write_report(report)
+                self.assertTrue("incompressible" in report.getvalue())
+                patches.append(patch.getvalue())
+            self.assertEquals(patches[0],patches[1])
+            esky.patch.apply_patch(os.path.join(tdir,"source"),BytesIO(patches[0]))
+            self.assertEquals(esky.patch.calculate_digest(os.path.join(tdir,"source")),
+                              esky.patch.calculate_digest(os.path.join(tdir,"target")))
+        finally:
+            really_rmtree(tdir)
+
+    def test_patch_bigfile_chunked(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(1024*1024)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(data[:1000] + os.urandom(1024*100) + data[1000:-1000] + os.urandom(10) + data[-1000:])
+            patches = []
+            for chunked in (False,True):
+                patch = BytesIO()
+                esky.patch.write_patch(os.path.join(tdir,"source"),os.path.join(tdir,"target"),patch,diff_window_size=1024*64,chunked=chunked)
+                patches.append(patch.getvalue())
+            self.assertTrue(len(patches[1]) < len(patches[0]) / 2)
+            esky.patch.apply_patch(os.path.join(tdir,"source"),BytesIO(patches[1]))
+            self.assertEquals(esky.patch.calculate_digest(os.path.join(tdir,"source")),
+                              esky.patch.calculate_digest(os.path.join(tdir,"target")))
+        finally:
+            really_rmtree(tdir)
+
     def test_diffing_back_and_forth(self):
         for (tf1,_) in self._TEST_FILES:
             for (tf2,_) in self._TEST_FILES:
@@ -690,6 +859,644 @@ class TestPatch(unittest.TestCase):
                 self.assertEquals(esky.patch.calculate_digest(path1),
                                   esky.patch.calculate_digest(path2))
 
+    def test_parallel_diff_matches_serial(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        serial = BytesIO()
+        esky.patch.write_patch(path1,path2,serial,diff_window_size=1024*8)
+        parallel = BytesIO()
+        esky.patch.write_patch(path1,path2,parallel,diff_window_size=1024*8,jobs=3)
+        self.assertEquals(serial.getvalue(),parallel.getvalue())
+        esky.patch.apply_patch(path1,BytesIO(parallel.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
+    def test_patch_solid_blocks(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        unsolid = BytesIO()
+        esky.patch.write_patch(path1,path2,unsolid,version=3)
+        solid = BytesIO()
+        esky.patch.write_patch(path1,path2,solid,version=4)
+        self.assertTrue(len(solid.getvalue()) < len(unsolid.getvalue()))
+        #  Use tiny blocks, so that many are needed.
+        orig_block_size = esky.patch.SOLID_BLOCK_SIZE
+        esky.patch.SOLID_BLOCK_SIZE = 1024*8
+        try:
+            patch = BytesIO()
+            esky.patch.write_patch(path1,path2,patch,version=4)
+        finally:
+            esky.patch.SOLID_BLOCK_SIZE = orig_block_size
+        esky.patch.apply_patch(path1,BytesIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+
+    def test_patch_files_moved_between_dirs(self):
+        data = os.urandom(1024*200)
+        for nm in ("a","b"):
+            os.makedirs(os.path.join(self.src_dir,nm))
+            os.makedirs(os.path.join(self.tgt_dir,nm))
+        with open(os.path.join(self.src_dir,"a","big.bin"),"wb") as f:
+            f.write(data)
+        with open(os.path.join(self.src_dir,"a","other.bin"),"wb") as f:
+            f.write(data[::-1])
+        with open(os.path.join(self.tgt_dir,"b","moved.bin"),"wb") as f:
+            f.write(data[:1000] + os.urandom(10) + data[1000:])
+        with open(os.path.join(self.tgt_dir,"b","copied.bin"),"wb") as f:
+            f.write(data[::-1])
+        with open(os.path.join(self.tgt_dir,"a","other.bin"),"wb") as f:
+            f.write(data[::-1])
+        patches = []
+        for version in (1,2):
+            patch = BytesIO()
+            esky.patch.write_patch(self.src_dir,self.tgt_dir,patch,version=version)
+            patches.append(patch.getvalue())
+        self.assertTrue(len(patches[1]) < 1024*2)
+        self.assertTrue(len(patches[0]) > 1024*200)
+        for patch in patches:
+            work_dir = os.path.join(self.workdir,"work")
+            shutil.copytree(self.src_dir,work_dir)
+            esky.patch.apply_patch(work_dir,BytesIO(patch))
+            self.assertEquals(esky.patch.calculate_digest(work_dir),
+                              esky.patch.calculate_digest(self.tgt_dir))
+            really_rmtree(work_dir)
+
+    def test_tree_snapshot_matches_paths_differ(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        with open(os.path.join(path2,"setup.py"),"rb") as f:
+            data = f.read()
+        with open(os.path.join(path1,"setup2.py"),"wb") as f:
+            f.write(data)
+        with open(os.path.join(path2,"setup2.py"),"wb") as f:
+            f.write(data[:-1] + b"X")
+        tree = esky.patch._TreeSnapshot()
+        for (dirpath,dirnames,filenames) in os.walk(path2):
+            for nm in dirnames + filenames:
+                t_nm = os.path.join(dirpath,nm)
+                s_nm = os.path.join(path1,os.path.relpath(t_nm,path2))
+                self.assertEquals(tree.differs(s_nm,t_nm),
+                                  esky.patch.paths_differ(s_nm,t_nm))
+                self.assertEquals(tree.differs(t_nm,s_nm),
+                                  esky.patch.paths_differ(t_nm,s_nm))
+        self.assertTrue(tree.differs(path1,path2))
+        self.assertTrue(tree.differs(os.path.join(path1,"setup2.py"),
+                                     os.path.join(path2,"setup2.py")))
+
+    def test_patch_duplicate_new_files(self):
+        data = os.urandom(1024*200)
+        for nm in ("a","b","c"):
+            os.makedirs(os.path.join(self.tgt_dir,nm))
+            with open(os.path.join(self.tgt_dir,nm,"new.bin"),"wb") as f:
+                f.write(data)
+        os.chmod(os.path.join(self.tgt_dir,"c","new.bin"),0755)
+        #  Zipfile contents can't refer to files outside the zipfile.
+        for (path,members) in ((self.src_dir,["one"]),(self.tgt_dir,["one","two"])):
+            os.makedirs(os.path.join(path,"z"))
+            zf = zipfile.ZipFile(os.path.join(path,"z","data.zip"),"w")
+            for member in members:
+                zf.writestr(member,data)
+            zf.close()
+        patches = []
+        for version in (1,2):
+            patch = BytesIO()
+            esky.patch.write_patch(self.src_dir,self.tgt_dir,patch,version=version)
+            patches.append(patch.getvalue())
+        self.assertTrue(len(patches[1]) < 1024*450)
+        self.assertTrue(len(patches[0]) > 1024*750)
+        for patch in patches:
+            work_dir = os.path.join(self.workdir,"work")
+            shutil.copytree(self.src_dir,work_dir)
+            esky.patch.apply_patch(work_dir,BytesIO(patch))
+            self.assertEquals(esky.patch.calculate_digest(work_dir),
+                              esky.patch.calculate_digest(self.tgt_dir))
+            mode = os.stat(os.path.join(work_dir,"c","new.bin")).st_mode
+            self.assertEquals(mode & 0777,0755)
+            really_rmtree(work_dir)
+
+    def test_patch_zipfile_members(self):
+        data = [os.urandom(1024*4).encode("hex") for i in xrange(20)]
+        for path in (self.src_dir,self.tgt_dir):
+            os.makedirs(path)
+        s_zf = zipfile.ZipFile(os.path.join(self.src_dir,"lib.zip"),"w",
+                               zipfile.ZIP_DEFLATED)
+        for i in xrange(20):
+            s_zf.writestr("pkg%d/mod%d.py" % (i % 3,i),data[i])
+        s_zf.writestr("stored.py",data[0])
+        s_zf.writestr("removed.py",data[1])
+        s_zf.writestr("gone/removed.py",data[2])
+        s_zf.close()
+        t_zf = zipfile.ZipFile(os.path.join(self.tgt_dir,"lib.zip"),"w",
+                               zipfile.ZIP_DEFLATED)
+        for i in xrange(20):
+            if i == 7:
+                t_zf.writestr("pkg1/mod7.py",data[i][:100] + "X" + data[i])
+            else:
+                t_zf.writestr("pkg%d/mod%d.py" % (i % 3,i),data[i])
+        t_zf.writestr("pkg2/new.py",data[3])
+        t_zf.writestr(zipfile.ZipInfo("stored.py"),data[0])
+        t_zf.close()
+        for version in (1,4,5):
+            patch = BytesIO()
+            esky.patch.write_patch(self.src_dir,self.tgt_dir,patch,version=version)
+            work_dir = os.path.join(self.workdir,"work")
+            shutil.copytree(self.src_dir,work_dir)
+            esky.patch.apply_patch(work_dir,BytesIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(work_dir),
+                              esky.patch.calculate_digest(self.tgt_dir))
+            really_rmtree(work_dir)
+
+    def test_patch_parallel_apply(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        #  Identical new files are copied from the first one written.
+        data = os.urandom(1024*100)
+        for nm in ("dup1.bin","dup2.bin"):
+            with open(os.path.join(path2,"enchant",nm),"wb") as f:
+                f.write(data)
+        orig_block_size = esky.patch.SOLID_BLOCK_SIZE
+        esky.patch.SOLID_BLOCK_SIZE = 1024*8
+        try:
+            patch = BytesIO()
+            esky.patch.write_patch(path1,path2,patch)
+        finally:
+            esky.patch.SOLID_BLOCK_SIZE = orig_block_size
+        #  Use small batches, so sections are spread across the workers.
+        orig_batch_count = esky.patch._SECTION_BATCH_COUNT
+        esky.patch._SECTION_BATCH_COUNT = 3
+        try:
+            patcher = esky.patch.Patcher(path1,BytesIO(patch.getvalue()),jobs=4)
+            patcher.patch()
+        finally:
+            esky.patch._SECTION_BATCH_COUNT = orig_batch_count
+        self.assertEquals(esky.patch.calculate_digest(path1),
+                          esky.patch.calculate_digest(path2))
+        #  Sections are counted as finished once they've been applied.
+        sections = esky.patch.read_patch_toc(BytesIO(patch.getvalue()))
+        self.assertEquals(sorted(patcher._finished_sections),
+                          range(len(sections)))
+
+    def test_patch_sections(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        orig_block_size = esky.patch.SOLID_BLOCK_SIZE
+        esky.patch.SOLID_BLOCK_SIZE = 1024*8
+        try:
+            patch = BytesIO()
+            esky.patch.write_patch(path1,path2,patch)
+        finally:
+            esky.patch.SOLID_BLOCK_SIZE = orig_block_size
+        patch = patch.getvalue()
+        sections = esky.patch.read_patch_toc(BytesIO(patch))
+        self.assertTrue(len(sections) > 10)
+        for section in sections:
+            t_path = os.path.join(path2,section.path)
+            self.assertEquals(esky.patch.calculate_digest(t_path),
+                              section.target_digest)
+        changed = [s for s in sections if s.source_digest and s.solid_size]
+        new = [s for s in sections if not s.source_digest]
+        self.assertTrue(changed and new)
+        #  Files that are already patched are skipped, even when the patch
+        #  can't be seeked.
+        class Stream(object):
+            def __init__(self,data):
+                self.read = BytesIO(data).read
+        work_dir = os.path.join(self.workdir,"work")
+        shutil.copytree(path1,work_dir)
+        for section in (changed[0],new[0]):
+            shutil.copy2(os.path.join(path2,section.path),
+                         os.path.join(work_dir,section.path))
+        esky.patch.apply_patch(work_dir,Stream(patch))
+        self.assertEquals(esky.patch.calculate_digest(work_dir),
+                          esky.patch.calculate_digest(path2))
+        really_rmtree(work_dir)
+        #  Unexpected files are detected before anything is changed.
+        shutil.copytree(path1,work_dir)
+        with open(os.path.join(work_dir,changed[-1].path),"ab") as f:
+            f.write("junk")
+        self.assertRaises(esky.patch.PatchError,esky.patch.apply_patch,
+                          work_dir,BytesIO(patch))
+        self.assertEquals(esky.patch.calculate_digest(os.path.join(work_dir,changed[0].path)),
+                          changed[0].source_digest)
+        really_rmtree(work_dir)
+
+    def test_patch_hardlinked_tree(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        patch = BytesIO()
+        esky.patch.write_patch(path1,path2,patch)
+        digest1 = esky.patch.calculate_digest(path1)
+        mode1 = os.stat(os.path.join(path1,"LICENSE.txt")).st_mode
+        work_dir = os.path.join(self.workdir,"work")
+        link_or_copy_tree(path1,work_dir)
+        if os.stat(os.path.join(work_dir,"LICENSE.txt")).st_nlink < 2:
+            raise unittest.SkipTest("hard links not supported")
+        esky.patch.apply_patch(work_dir,BytesIO(patch.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(work_dir),
+                          esky.patch.calculate_digest(path2))
+        #  Changing the mode of a linked file must not affect the original.
+        chmod = BytesIO()
+        chmod.write(esky.patch.PATCH_HEADER)
+        esky.patch._write_vint(chmod,1)
+        esky.patch._write_vint(chmod,esky.patch.JOIN_PATH)
+        esky.patch._write_vint(chmod,len("LICENSE.txt"))
+        chmod.write("LICENSE.txt")
+        esky.patch._write_vint(chmod,esky.patch.CHMOD)
+        esky.patch._write_vint(chmod,0700)
+        esky.patch.apply_patch(work_dir,BytesIO(chmod.getvalue()))
+        self.assertEquals(os.stat(os.path.join(work_dir,"LICENSE.txt")).st_mode & 0777,
+                          0700)
+        #  The linked source tree is left untouched.
+        self.assertEquals(esky.patch.calculate_digest(path1),digest1)
+        self.assertEquals(os.stat(os.path.join(path1,"LICENSE.txt")).st_mode,mode1)
+
+    def test_patch_resume_from_checkpoint(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        #  Moved files can't simply be re-applied when resuming.
+        shutil.copy(os.path.join(path1,"setup.py"),os.path.join(path2,"moved.py"))
+        os.unlink(os.path.join(path2,"setup.py"))
+        class InterruptedPatcher(esky.patch.Patcher):
+            def _read_command(self):
+                self.num_commands -= 1
+                if self.num_commands < 0:
+                    raise KeyboardInterrupt
+                return super(InterruptedPatcher,self)._read_command()
+        work_dir = os.path.join(self.workdir,"work")
+        checkpoint = os.path.join(self.workdir,"checkpoint")
+        #  Checkpoint as often as possible, so we know where we'll resume.
+        orig_interval = esky.patch.CHECKPOINT_INTERVAL
+        esky.patch.CHECKPOINT_INTERVAL = 0
+        try:
+            for version in (4,6):
+                patch = BytesIO()
+                esky.patch.write_patch(path1,path2,patch,version=version)
+                shutil.copytree(path1,work_dir)
+                patcher = InterruptedPatcher(work_dir,BytesIO(patch.getvalue()))
+                patcher.num_commands = total = 1000000
+                patcher.patch()
+                total -= patcher.num_commands
+                really_rmtree(work_dir)
+                for num_commands in (5,20,50,100,150):
+                    shutil.copytree(path1,work_dir)
+                    patcher = InterruptedPatcher(work_dir,BytesIO(patch.getvalue()),
+                                                 checkpoint=checkpoint)
+                    patcher.num_commands = num_commands
+                    self.assertRaises(KeyboardInterrupt,patcher.patch)
+                    self.assertTrue(os.path.exists(checkpoint))
+                    patcher = InterruptedPatcher(work_dir,BytesIO(patch.getvalue()),
+                                                 checkpoint=checkpoint)
+                    patcher.num_commands = 1000000
+                    patcher.patch()
+                    #  Only the commands after the checkpoint were applied.
+                    self.assertTrue(1000000 - patcher.num_commands
+                                    <= total - num_commands + 10)
+                    self.assertEquals(esky.patch.calculate_digest(work_dir),
+                                      esky.patch.calculate_digest(path2))
+                    self.assertFalse(os.path.exists(checkpoint))
+                    really_rmtree(work_dir)
+            #  Real files that look like temp files are left alone when
+            #  resuming, wherever the patch was interrupted.
+            source = os.path.join(self.workdir,"lookalike-source")
+            target = os.path.join(self.workdir,"lookalike-target")
+            for (path,data) in ((source,"old"),(target,"new")):
+                os.mkdir(path)
+                with open(os.path.join(path,"foo"),"wb") as f:
+                    f.write(data * 100)
+                with open(os.path.join(path,"foo.new"),"wb") as f:
+                    f.write("not a temp file")
+            patch = BytesIO()
+            esky.patch.write_patch(source,target,patch)
+            for num_commands in xrange(1,8):
+                shutil.copytree(source,work_dir)
+                patcher = InterruptedPatcher(work_dir,BytesIO(patch.getvalue()),
+                                             checkpoint=checkpoint)
+                patcher.num_commands = num_commands
+                try:
+                    patcher.patch()
+                except KeyboardInterrupt:
+                    patcher = esky.patch.Patcher(work_dir,BytesIO(patch.getvalue()),
+                                                 checkpoint=checkpoint)
+                    patcher.patch()
+                self.assertEquals(esky.patch.calculate_digest(work_dir),
+                                  esky.patch.calculate_digest(target))
+                really_rmtree(work_dir)
+        finally:
+            esky.patch.CHECKPOINT_INTERVAL = orig_interval
+
+    def test_patch_digests(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        digest2 = esky.patch.calculate_digest(path2,jobs=1)
+        self.assertEquals(esky.patch.calculate_digest(path2,jobs=4),digest2)
+        #  The patcher only hashes on several threads when asked to.
+        for (jobs,expected) in ((None,1),(3,3)):
+            patcher = esky.patch.Patcher(path1,BytesIO(),jobs=jobs)
+            self.assertEquals(patcher._digester.jobs,expected)
+        #  Files written by the patcher aren't read again to verify them.
+        hashed = []
+        orig_hash_file = esky.patch._Digester._hash_file
+        def _hash_file(self,path):
+            hashed.append(path)
+            return orig_hash_file(self,path)
+        esky.patch._Digester._hash_file = _hash_file
+        try:
+            patch = BytesIO()
+            esky.patch.write_patch(path1,path2,patch,version=4)
+            del hashed[:]
+            esky.patch.apply_patch(path1,BytesIO(patch.getvalue()))
+        finally:
+            esky.patch._Digester._hash_file = orig_hash_file
+        self.assertEquals(esky.patch.calculate_digest(path1),digest2)
+        self.assertTrue(os.path.join(path1,"README.txt") not in hashed)
+        self.assertTrue(os.path.join(path1,"enchant","tokenize","en.py") not in hashed)
+        self.assertTrue(os.path.join(path1,"LICENSE.txt") in hashed)
+        #  The file list is found in the control dir of the version.
+        ctrl_dir = os.path.join(self.workdir,"app",ESKY_APPDATA_DIR,"app-0.1",
+                                ESKY_CONTROL_DIR)
+        os.makedirs(ctrl_dir)
+        with open(os.path.join(ctrl_dir,esky.patch.ESKY_FILELIST),"w") as f:
+            f.write('["b.txt", "a.txt"]')
+        self.assertEquals(esky.patch.load_filelist(os.path.join(self.workdir,"app")),
+                          ["a.txt","b.txt"])
+
+    def test_patch_verify_files(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        for version in (5,6):
+            patch = BytesIO()
+            esky.patch.write_patch(path1,path2,patch,version=version,
+                                   verify_files=True)
+            source = os.path.join(self.workdir,"source%d" % (version,))
+            shutil.copytree(path1,source)
+            esky.patch.apply_patch(source,BytesIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(source),
+                              esky.patch.calculate_digest(path2))
+            #  Bad files are reported by name, before they are changed.
+            bad = os.path.join(self.workdir,"bad%d" % (version,))
+            shutil.copytree(path1,bad)
+            for nm in ("README.txt","TODO.txt"):
+                with open(os.path.join(bad,nm),"ab") as f:
+                    f.write("corrupted")
+            try:
+                esky.patch.apply_patch(bad,BytesIO(patch.getvalue()))
+            except esky.patch.PatchVerifyError, e:
+                paths = e.paths
+            else:
+                assert False, "patch should have failed"
+            if version < 6:
+                #  Without a table of contents, patching stops at the first.
+                self.assertEquals(paths,["README.txt"])
+            else:
+                self.assertEquals(paths,["README.txt","TODO.txt"])
+                self.assertFalse(files_differ(os.path.join(bad,"MANIFEST.in"),
+                                              os.path.join(path1,"MANIFEST.in")))
+            self.assertFalse(files_differ(os.path.join(bad,"enchant","__init__.py"),
+                                          os.path.join(path1,"enchant","__init__.py")))
+
+    def test_patch_hash_algorithms(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz","pyenchant-1.6.0.tar.gz")
+        path1 = os.path.join(path1,"pyenchant-1.2.0")
+        path2 = os.path.join(path2,"pyenchant-1.6.0")
+        #  Use small blocks so that the tree hashes have several of them.
+        orig_block_size = esky.patch._TREE_HASH_BLOCK_SIZE
+        esky.patch._TREE_HASH_BLOCK_SIZE = 1024
+        try:
+            readme = os.path.join(path2,"README.txt")
+            with open(readme,"rb") as f:
+                data = f.read()
+            self.assertTrue(len(data) > 2048)
+            hash = esky.patch.get_hash("sha1-tree")
+            d = hash()
+            for i in xrange(0,len(data),700):
+                d.update(data[i:i+700])
+            self.assertEquals(d.digest(),esky.patch.calculate_digest(readme,hash,jobs=1))
+            self.assertEquals(d.digest(),esky.patch.calculate_digest(readme,hash,jobs=4))
+            for hash_name in ("sha256","sha1-tree"):
+                patch = BytesIO()
+                esky.patch.write_patch(path1,path2,patch,hash_name=hash_name,
+                                       verify_files=True)
+                patch = patch.getvalue()
+                sections = esky.patch.read_patch_toc(BytesIO(patch))
+                hash = esky.patch.get_hash(hash_name)
+                for section in sections:
+                    self.assertEquals(section.hash_name,hash_name)
+                    t_path = os.path.join(path2,section.path)
+                    self.assertEquals(esky.patch.calculate_digest(t_path,hash),
+                                      section.target_digest)
+                source = os.path.join(self.workdir,hash_name)
+                shutil.copytree(path1,source)
+                esky.patch.apply_patch(source,BytesIO(patch),jobs=2)
+                self.assertEquals(esky.patch.calculate_digest(source),
+                                  esky.patch.calculate_digest(path2))
+                #  Bad files are reported with the hash that was used.
+                bad = os.path.join(self.workdir,"bad-" + hash_name)
+                shutil.copytree(path1,bad)
+                with open(os.path.join(bad,"README.txt"),"ab") as f:
+                    f.write("corrupted")
+                try:
+                    esky.patch.apply_patch(bad,BytesIO(patch))
+                except esky.patch.PatchVerifyError, e:
+                    self.assertEquals(e.hash_name,hash_name)
+                    self.assertTrue(hash_name in str(e))
+                else:
+                    assert False, "patch should have failed"
+        finally:
+            esky.patch._TREE_HASH_BLOCK_SIZE = orig_block_size
+        #  Other hashes can't be used without the VERIFY command.
+        self.assertRaises(esky.patch.DiffError,esky.patch.write_patch,
+                          path1,path2,BytesIO(),hash_name="sha256",version=6)
+        self.assertRaises(esky.patch.DiffError,esky.patch.write_patch,
+                          path1,path2,BytesIO(),hash_name="whirlpool")
+
+    def test_patch_x86_executables(self):
+        #  Relative branches can be converted back and forth whatever the data.
+        orig_chunk_size = esky.patch._BCJ_CHUNK_SIZE
+        esky.patch._BCJ_CHUNK_SIZE = 7
+        try:
+            data = os.urandom(1024) + "\xe8\x00\x00\xe9" * 100 + "\xe8"
+            for encode in (True,False):
+                out = BytesIO()
+                esky.patch._bcj_x86_copy(BytesIO(data),out,encode)
+                back = BytesIO()
+                esky.patch._bcj_x86_copy(BytesIO(out.getvalue()),back,not encode)
+                self.assertEquals(back.getvalue(),data)
+        finally:
+            esky.patch._BCJ_CHUNK_SIZE = orig_chunk_size
+        #  A fake x86-64 ELF file, in which code is inserted into the middle
+        #  and the code after it calls functions before it.
+        def write_exe(path,extra):
+            rnd = random.Random(42)
+            sizes = [64] * 400
+            sizes[250] += extra
+            data = bytearray("\x7fELF\x02\x01\x01" + "\x00" * 9 + "\x02\x00\x3e\x00")
+            data += "\x00" * (4096 - len(data))
+            starts = []
+            for size in sizes:
+                starts.append(len(data))
+                data += "\x90" * size
+            for (i,start) in enumerate(starts):
+                for j in xrange(8):
+                    pos = start + j * 5
+                    target = starts[rnd.randrange(200)]
+                    data[pos:pos+5] = "\xe8" + struct.pack("<i",target - pos - 5)
+            os.mkdir(os.path.dirname(path))
+            with open(path,"wb") as f:
+                f.write(data)
+        paths = []
+        for (i,extra) in enumerate((0,37,50)):
+            paths.append(os.path.join(self.workdir,str(i)))
+            write_exe(os.path.join(paths[-1],"app.exe"),extra)
+        self.assertTrue(esky.patch._is_x86_executable(os.path.join(paths[0],"app.exe")))
+        sizes = []
+        for filter_executables in (False,True):
+            patch = BytesIO()
+            esky.patch.write_patch(paths[0],paths[1],patch,
+                                   filter_executables=filter_executables)
+            sizes.append(len(patch.getvalue()))
+            target = os.path.join(self.workdir,"target%s" % (filter_executables,))
+            shutil.copytree(paths[0],target)
+            esky.patch.apply_patch(target,BytesIO(patch.getvalue()))
+            self.assertEquals(esky.patch.calculate_digest(target),
+                              esky.patch.calculate_digest(paths[1]))
+        self.assertTrue(sizes[1] < sizes[0] / 2)
+        #  The filter can be turned off from the command-line.
+        patchfile = os.path.join(self.workdir,"no-bcj.patch")
+        esky.patch.main(["--no-bcj","diff",paths[0],paths[1],patchfile])
+        with open(patchfile,"rb") as f:
+            self.assertEquals(len(f.read()),sizes[0])
+        #  Filtered patches can be squashed together.
+        patches = []
+        for i in xrange(2):
+            patch = BytesIO()
+            esky.patch.write_patch(paths[i],paths[i+1],patch)
+            patches.append(BytesIO(patch.getvalue()))
+        squashed = BytesIO()
+        esky.patch.squash_patches(patches,squashed)
+        esky.patch.apply_patch(paths[0],BytesIO(squashed.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(paths[0]),
+                          esky.patch.calculate_digest(paths[2]))
+
+    def test_patch_bytecode(self):
+        #  Replacing in chunks finds occurrences that span the chunks.
+        orig_chunk_size = esky.patch._REPLACE_CHUNK_SIZE
+        esky.patch._REPLACE_CHUNK_SIZE = 5
+        try:
+            data = "abcabcbcab" * 20 + os.urandom(100) + "abc"
+            for (old,new) in (("abc","x"),("bca","wxyz"),("c","")):
+                out = BytesIO()
+                esky.patch._replace_copy(BytesIO(data),out,old,new)
+                self.assertEquals(out.getvalue(),data.replace(old,new))
+        finally:
+            esky.patch._REPLACE_CHUNK_SIZE = orig_chunk_size
+        #  Rebuilding only changes the header, while building elsewhere
+        #  changes the filename in every code object.  A string constant
+        #  that equals the old filename must survive the move.
+        source = "".join("def func%d(x):\n    return x + %d\n\n" % (i,i)
+                         for i in xrange(200))
+        source += "NAME = '/build/one/mod1.py'\n"
+        paths = []
+        builds = ((1000000000,"/build/one",source),
+                  (1100000000,"/build/one",source),
+                  (1200000000,"/build/somewhere/else",source + "x = 1\n"))
+        for (i,(mtime,builddir,code)) in enumerate(builds):
+            paths.append(os.path.join(self.workdir,str(i)))
+            os.mkdir(paths[-1])
+            for nm in ("mod1","mod2"):
+                py_path = os.path.join(paths[-1],nm + ".py")
+                with open(py_path,"wb") as f:
+                    f.write(code if nm == "mod1" else source)
+                os.utime(py_path,(mtime,mtime))
+                py_compile.compile(py_path,py_path+"c",builddir+"/"+nm+".py")
+                os.unlink(py_path)
+        with open(os.path.join(paths[1],"mod1.pyc"),"rb") as f:
+            sdata = f.read()
+        with open(os.path.join(paths[2],"mod1.pyc"),"rb") as f:
+            tdata = f.read()
+        size = esky.patch._pyc_header_size(tdata)
+        (old,new) = esky.patch._pyc_filename_change(sdata,tdata,size)
+        self.assertEquals(old,"s" + struct.pack("<i",18) + "/build/one/mod1.py")
+        self.assertEquals(new[:1],"s")
+        for i in xrange(2):
+            sizes = []
+            for diff_bytecode in (False,True):
+                patch = BytesIO()
+                esky.patch.write_patch(paths[i],paths[i+1],patch,
+                                       diff_bytecode=diff_bytecode)
+                sizes.append(len(patch.getvalue()))
+                target = os.path.join(self.workdir,"target%d%s" % (i,diff_bytecode))
+                shutil.copytree(paths[i],target)
+                esky.patch.apply_patch(target,BytesIO(patch.getvalue()))
+                self.assertEquals(esky.patch.calculate_digest(target),
+                                  esky.patch.calculate_digest(paths[i+1]))
+            self.assertTrue(sizes[1] < sizes[0])
+            #  It can be turned off from the command-line.
+            patchfile = os.path.join(self.workdir,"no-bytecode%d.patch" % (i,))
+            esky.patch.main(["--no-bytecode","diff",paths[i],paths[i+1],
+                             patchfile])
+            with open(patchfile,"rb") as f:
+                self.assertEquals(len(f.read()),sizes[0])
+        #  These patches can be squashed together.
+        patches = []
+        for i in xrange(2):
+            patch = BytesIO()
+            esky.patch.write_patch(paths[i],paths[i+1],patch)
+            patches.append(BytesIO(patch.getvalue()))
+        squashed = BytesIO()
+        esky.patch.squash_patches(patches,squashed)
+        esky.patch.apply_patch(paths[0],BytesIO(squashed.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(paths[0]),
+                          esky.patch.calculate_digest(paths[2]))
+
+    def test_squash_patches(self):
+        paths = []
+        data = [os.urandom(1024).encode("hex") for i in xrange(4)]
+        for (i,version) in enumerate(("1.2.0","1.5.2","1.6.0")):
+            tf = tarfile.open(os.path.join(self.tfdir,"pyenchant-%s.tar.gz"
+                                                      % (version,)),"r:gz")
+            try:
+                tf.extractall(os.path.join(self.workdir,str(i)))
+            finally:
+                tf.close()
+            path = os.path.join(self.workdir,str(i),"pyenchant-"+version)
+            #  Each version changes one zipfile member and drops another.
+            zf = zipfile.ZipFile(os.path.join(path,"lib.zip"),"w",
+                                 zipfile.ZIP_DEFLATED)
+            for j in xrange(4):
+                if j == i:
+                    zf.writestr("mod%d.py" % (j,),data[j][:50]+"X"+data[j])
+                elif j != 3 - i:
+                    zf.writestr("mod%d.py" % (j,),data[j])
+            zf.close()
+            paths.append(path)
+        #  A file that moves around, and then has its mode changed.
+        shutil.copy(os.path.join(paths[0],"setup.py"),
+                    os.path.join(paths[1],"moved.py"))
+        os.mkdir(os.path.join(paths[2],"newdir"))
+        shutil.copy(os.path.join(paths[0],"setup.py"),
+                    os.path.join(paths[2],"newdir","moved.py"))
+        os.chmod(os.path.join(paths[2],"setup.py"),0700)
+        patches = []
+        for (source,target) in ((0,1),(1,2),(2,0),(0,2)):
+            patch = BytesIO()
+            esky.patch.write_patch(paths[source],paths[target],patch)
+            patches.append(patch.getvalue())
+        squashed = BytesIO()
+        esky.patch.squash_patches([BytesIO(p) for p in patches],squashed)
+        self.assertTrue(len(squashed.getvalue()) < sum(map(len,patches)))
+        work_dir = os.path.join(self.workdir,"work")
+        shutil.copytree(paths[0],work_dir)
+        esky.patch.apply_patch(work_dir,BytesIO(squashed.getvalue()))
+        self.assertEquals(esky.patch.calculate_digest(work_dir),
+                          esky.patch.calculate_digest(paths[2]))
+        self.assertEquals(os.stat(os.path.join(work_dir,"setup.py")).st_mode & 0777,
+                          0700)
+
     def test_apply_patch_old(self):
         '''uses the old method which calculates the digest for the entire
         folder when comparing, application has no filelist'''
@@ -893,7 +1700,39 @@ class TestPatch_pybsdiff(TestPatch):
     def tearDown(self):
         esky.patch.bsdiff4 = self.__orig_bsdiff4
         return super(TestPatch_pybsdiff,self).tearDown()
-    
+
+    def test_patch_matches_native(self):
+        if esky.patch.bsdiff4_py.diff is None:
+            raise unittest.SkipTest("no native bsdiff4 module")
+        source = os.urandom(1024*200)
+        target = bytearray(source[:1024*50] + os.urandom(300) + source[1024*50:])
+        for i in xrange(0,len(target),997):
+            target[i] = (target[i] + i) % 256
+        target = bytes(target)
+        patch = esky.patch.bsdiff4_py.diff(source,target)
+        self.assertEquals(esky.patch.bsdiff4_py.patch(source,patch),target)
+
+    def test_add_bytes(self):
+        #  Long enough to be added in several chunks, with a run of zeros.
+        size = esky.patch._ADD_CHUNK_SIZE * 2 + 17
+        diff = os.urandom(size - 1000) + b"\x00" * 1000
+        orig = os.urandom(size)
+        expected = bytes(bytearray((x + y) % 256 for (x,y) in
+                                   zip(bytearray(diff),bytearray(orig))))
+        orig_numpy = esky.patch._numpy
+        try:
+            #  Force the SWAR code, then the numpy code if we can.
+            esky.patch._numpy = False
+            self.assertEquals(esky.patch._add_bytes(diff,orig),expected)
+            self.assertEquals(esky.patch._add_bytes(diff[-1000:],orig[:1000]),
+                              orig[:1000])
+            esky.patch._numpy = None
+            if not esky.patch._get_numpy():
+                raise unittest.SkipTest("numpy not available")
+            self.assertEquals(esky.patch._add_bytes(diff,orig),expected)
+        finally:
+            esky.patch._numpy = orig_numpy
+
         
 
 class TestFilesDiffer(unittest.TestCase):
@@ -922,3 +1761,37 @@ class TestFilesDiffer(unittest.TestCase):
     def tearDown(self):
         really_rmtree(self.tdir)
 
+
+class TestCopyFileData(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        really_rmtree(self.tdir)
+
+    def test_copy_file_data(self):
+        data = os.urandom(1024*100)
+        source = os.path.join(self.tdir,"source")
+        target = os.path.join(self.tdir,"target")
+        with open(source,"wb") as f:
+            f.write(data)
+        #  Large and small copies between real files, at arbitrary offsets.
+        with open(source,"rb") as fsrc:
+            with open(target,"wb") as fdst:
+                fdst.write("head")
+                fsrc.seek(7)
+                self.assertEquals(copy_file_data(fsrc,fdst,1024*50),1024*50)
+                self.assertEquals(fsrc.tell(),7+1024*50)
+                self.assertEquals(copy_file_data(fsrc,fdst,10),10)
+                fdst.write("tail")
+                self.assertEquals(copy_file_data(fsrc,fdst),len(data)-7-1024*50-10)
+                self.assertEquals(copy_file_data(fsrc,fdst,1024*50),0)
+        with open(target,"rb") as f:
+            self.assertEquals(f.read(),"head"+data[7:7+1024*50+10]+"tail"+data[7+1024*50+10:])
+        #  Objects that aren't real files are copied through python.
+        fsrc = BytesIO(data)
+        fdst = BytesIO()
+        self.assertEquals(copy_file_data(fsrc,fdst,1024*70),1024*70)
+        self.assertEquals(fdst.getvalue(),data[:1024*70])
+
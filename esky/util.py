@@ -106,6 +106,16 @@ def zipfile():
     import zipfile
     return zipfile
 
+@lazy_import
+def struct():
+    import struct
+    return struct
+
+@lazy_import
+def ctypes():
+    import ctypes
+    return ctypes
+
 @lazy_import
 def itertools():
     import itertools
@@ -138,11 +148,6 @@ if sys.version_info[:2] < (3, 4):
     def marshal():
         import marshal
         return marshal
-        
-    @lazy_import
-    def struct():
-        import struct
-        return struct
 else:
     @lazy_import
     def importlib():
@@ -351,7 +356,8 @@ def deep_extract_zipfile(source,target,name_filter=None):
 
 
 
-def create_zipfile(source,target,get_zipinfo=None,members=None,compress=None):
+def create_zipfile(source,target,get_zipinfo=None,members=None,compress=None,
+                   raw_source=None):
     """Bundle the contents of a given directory into a zipfile.
 
     The argument 'source' names the directory to read, while 'target' names
@@ -368,6 +374,10 @@ def create_zipfile(source,target,get_zipinfo=None,members=None,compress=None):
 
     If the optional argument 'compress' is given, it must be a bool indicating
     whether to compress the files by default.  The default is no compression.
+
+    If the optional argument 'raw_source' is given, it must be a ZipFile
+    object.  Any members that don't exist in the source directory will be
+    copied from this zipfile without being decompressed.
     """
     if not compress:
         compress_type = zipfile.ZIP_STORED
@@ -390,6 +400,13 @@ def create_zipfile(source,target,get_zipinfo=None,members=None,compress=None):
             else:
                 zinfo = None
             fpath = os.path.join(source,fpath)
+        if raw_source is not None and not os.path.lexists(fpath):
+            if isinstance(zinfo,zipfile.ZipInfo):
+                copy_zipfile_member(raw_source,zinfo.filename,zf,zinfo)
+            else:
+                nm = fpath[len(source)+1:].replace(os.sep,"/")
+                copy_zipfile_member(raw_source,nm,zf,zinfo)
+            continue
         if os.path.islink(fpath):
             # For information about adding symlinks to a zip file, see
             # https://mail.python.org/pipermail/python-list/2005-June/322180.html
@@ -417,6 +434,58 @@ def create_zipfile(source,target,get_zipinfo=None,members=None,compress=None):
     zf.close()
 
 
+def copy_zipfile_member(source,name,target,zinfo=None):
+    """Copy a member from one zipfile into another, without recompressing it.
+
+    The arguments 'source' and 'target' must be ZipFile objects opened for
+    reading and writing respectively, and 'name' the name of the member to
+    copy from 'source'.  If given, the optional argument 'zinfo' must be a
+    ZipInfo object or name giving the filename, timestamp and attributes
+    for the new member; its size, checksum and compression are always taken
+    from the source member.
+    """
+    s_zinfo = source.getinfo(name)
+    if zinfo is None:
+        zinfo = s_zinfo
+    elif isinstance(zinfo,basestring):
+        t_zinfo = zipfile.ZipInfo(zinfo,s_zinfo.date_time)
+        t_zinfo.external_attr = s_zinfo.external_attr
+        zinfo = t_zinfo
+    t_zinfo = zipfile.ZipInfo(zinfo.filename,zinfo.date_time)
+    for attr in ("comment","extra","create_system","create_version",
+                 "extract_version","reserved","volume","internal_attr",
+                 "external_attr"):
+        setattr(t_zinfo,attr,getattr(zinfo,attr))
+    t_zinfo.compress_type = s_zinfo.compress_type
+    t_zinfo.CRC = s_zinfo.CRC
+    t_zinfo.compress_size = s_zinfo.compress_size
+    t_zinfo.file_size = s_zinfo.file_size
+    #  The sizes go in the local header, so no trailing data descriptor.
+    t_zinfo.flag_bits = s_zinfo.flag_bits & ~0x08
+    #  Find the start of the compressed data by skipping the local header.
+    source.fp.seek(s_zinfo.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile("truncated file header: %s" % (name,))
+    header = struct.unpack(zipfile.structFileHeader,header)
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("bad magic number for file header")
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                   header[zipfile._FH_EXTRA_FIELD_LENGTH],1)
+    t_zinfo.header_offset = target.fp.tell()
+    target.fp.write(t_zinfo.FileHeader())
+    remaining = s_zinfo.compress_size
+    while remaining > 0:
+        data = source.fp.read(min(remaining,1024*64))
+        if not data:
+            raise zipfile.BadZipfile("truncated data for %s" % (name,))
+        target.fp.write(data)
+        remaining -= len(data)
+    target.filelist.append(t_zinfo)
+    target.NameToInfo[t_zinfo.filename] = t_zinfo
+    target._didModify = True
+
+
 _CACHED_PLATFORM = None
 def get_platform():
     """Get the platform identifier for the current platform.
@@ -570,6 +639,185 @@ def really_rmtree(path):
             shutil.rmtree(path)
 
 
+#  The FICLONE ioctl from linux/fs.h, for sharing file data copy-on-write.
+_FICLONE = 0x40049409
+
+#  Size of chunks used when copying file data through python.
+_COPY_CHUNK_SIZE = 1024 * 256
+
+#  Ranges smaller than this aren't worth a trip into the kernel to copy.
+_MIN_KERNEL_COPY = 1024 * 16
+
+_copy_file_range = None
+
+def _get_copy_file_range():
+    """Lazily look up the copy_file_range function from libc.
+
+    This returns False if it's not available, e.g. because we're not
+    on linux or the libc is too old to provide it.
+    """
+    global _copy_file_range
+    if _copy_file_range is None:
+        _copy_file_range = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(None,use_errno=True)
+                func = libc.copy_file_range
+            except (ImportError,EnvironmentError,AttributeError):
+                pass
+            else:
+                off_p = ctypes.POINTER(ctypes.c_longlong)
+                func.argtypes = (ctypes.c_int,off_p,ctypes.c_int,off_p,
+                                 ctypes.c_size_t,ctypes.c_uint)
+                func.restype = ctypes.c_ssize_t
+                _copy_file_range = func
+    return _copy_file_range
+
+
+def copy_file_data(fsrc,fdst,n=None):
+    """Copy n bytes from file object fsrc to fdst, or up to EOF if n is None.
+
+    Data is copied from the current position of each file, and both are
+    left positioned just after the copied data.  On linux the kernel is
+    asked to do the copy with copy_file_range, so the data never passes
+    through python (and may be shared rather than duplicated, on some
+    filesystems).  Otherwise it's copied a chunk at a time.  The number
+    of bytes copied is returned.
+    """
+    copied = 0
+    func = _get_copy_file_range()
+    if func and (n is None or n >= _MIN_KERNEL_COPY):
+        try:
+            in_fd = fsrc.fileno()
+            out_fd = fdst.fileno()
+        except (AttributeError,EnvironmentError,ValueError):
+            pass
+        else:
+            fdst.flush()
+            in_off = ctypes.c_longlong(fsrc.tell())
+            out_off = ctypes.c_longlong(fdst.tell())
+            unsupported = False
+            while n is None or copied < n:
+                if n is None:
+                    size = 1024 * 1024 * 1024
+                else:
+                    size = min(n - copied,1024 * 1024 * 1024)
+                res = func(in_fd,ctypes.byref(in_off),
+                           out_fd,ctypes.byref(out_off),size,0)
+                if res < 0:
+                    err = ctypes.get_errno()
+                    if copied == 0 and err in (errno.ENOSYS,errno.EXDEV,
+                                               errno.EINVAL,errno.EBADF,
+                                               errno.EOPNOTSUPP):
+                        unsupported = True
+                        break
+                    raise OSError(err,os.strerror(err))
+                if res == 0:
+                    break
+                copied += res
+            if not unsupported:
+                fsrc.seek(in_off.value)
+                fdst.seek(out_off.value)
+                return copied
+    while n is None or copied < n:
+        if n is None:
+            size = _COPY_CHUNK_SIZE
+        else:
+            size = min(n - copied,_COPY_CHUNK_SIZE)
+        data = fsrc.read(size)
+        if not data:
+            break
+        fdst.write(data)
+        copied += len(data)
+    return copied
+
+
+def reflink_file(source,target):
+    """Make target a copy-on-write clone of source, if possible.
+
+    This only works on filesystems that support sharing data between files
+    (e.g. btrfs or xfs on linux).  It returns True if the clone was made,
+    and False if it's not supported; the mode and times of source are
+    copied over to the new file.
+    """
+    if not fcntl or not hasattr(fcntl,"ioctl") or \
+       not sys.platform.startswith("linux"):
+        return False
+    with open(source,"rb") as fs:
+        with open(target,"wb") as ft:
+            try:
+                fcntl.ioctl(ft.fileno(),_FICLONE,fs.fileno())
+            except (EnvironmentError,ValueError):
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.unlink(target)
+        return False
+    shutil.copystat(source,target)
+    return True
+
+
+def copy_file(source,target):
+    """Like shutil.copy2, but letting the kernel copy the data if possible.
+
+    The new file is a copy-on-write clone where the filesystem supports it,
+    and is otherwise copied using copy_file_data.
+    """
+    if not reflink_file(source,target):
+        with open(source,"rb") as fsrc:
+            with open(target,"wb") as fdst:
+                copy_file_data(fsrc,fdst)
+        shutil.copystat(source,target)
+
+
+def copy_tree(source,target):
+    """Like shutil.copytree, but copying each file with copy_file."""
+    _copy_tree(source,target,copy_file,())
+
+
+def link_or_copy_file(source,target):
+    """Make target a copy of source, sharing its storage where possible.
+
+    This tries a hard link, and falls back to copy_file.  Since a hard link
+    shares everything with the source file, the result must only be
+    replaced and never modified in-place.
+    """
+    if not os.path.islink(source):
+        try:
+            os.link(source,target)
+        except (AttributeError,EnvironmentError):
+            pass
+        else:
+            return
+    copy_file(source,target)
+
+
+def link_or_copy_tree(source,target,copy_dirs=()):
+    """Like shutil.copytree, but sharing file storage where possible.
+
+    Files are created with link_or_copy_file, except those in any directory
+    named in "copy_dirs", which are always copied.  This is useful for
+    control files that are locked or edited in-place.
+    """
+    _copy_tree(source,target,link_or_copy_file,copy_dirs)
+
+
+def _copy_tree(source,target,copy_function,copy_dirs):
+    os.makedirs(target)
+    for nm in os.listdir(source):
+        s_path = os.path.join(source,nm)
+        t_path = os.path.join(target,nm)
+        if os.path.isdir(s_path):
+            if nm in copy_dirs:
+                copy_tree(s_path,t_path)
+            else:
+                _copy_tree(s_path,t_path,copy_function,copy_dirs)
+        else:
+            copy_function(s_path,t_path)
+    shutil.copystat(source,target)
+
+
 def compile_to_bytecode(source_code, compile_filename=None):
     """Given source_code, return its compiled bytecode."""
     if sys.version_info[:2] < (3, 1):